@@ -1,2 +1,27 @@
-from basebox import monkey
-monkey.patch()
+import sys
+
+
+class _CuisinePatcher(object):
+    '''
+    Import hook that patches cuisine (see basebox.monkey) as soon as it's
+    imported, so that importing basebox is enough to make cuisine's
+    mode_local work properly, without importing fabric and cuisine up front.
+    '''
+
+    def find_module(self, fullname, path=None):
+        if fullname == 'cuisine':
+            return self
+
+    def load_module(self, fullname):
+        sys.meta_path.remove(self)
+        __import__(fullname)
+        from basebox import monkey
+        monkey.patch()
+        return sys.modules[fullname]
+
+
+if 'cuisine' in sys.modules:
+    from basebox import monkey
+    monkey.patch()
+else:
+    sys.meta_path.append(_CuisinePatcher())
@@ -0,0 +1,405 @@
+'''
+Non-blocking lifecycle operations for many vagrant contexts at once.
+
+VagrantContext runs its commands through fabric, one at a time, and leans on
+fabric's global `env` to do so.  AsyncVagrantContext instead returns
+operations: generators that yield the commands they need run, which gather()
+runs as local subprocesses from a single event loop.  Nothing here touches
+fabric's `env`, so any number of contexts can be driven concurrently:
+
+    contexts = [AsyncVagrantContext(d) for d in directories]
+    gather(*[ctx.up() for ctx in contexts], limit=20)
+    statuses = gather(*[ctx.status() for ctx in contexts])
+
+Operations can be combined by writing generators of your own.  A generator
+may yield a Command, another operation, or a list of either (which run
+concurrently), and is resumed with the result; it finishes with a value by
+raising Return(value), since Python 2 generators can't return one:
+
+    def rebuild(ctx):
+        yield ctx.destroy(force=True)
+        yield ctx.up()
+        raise Return((yield ctx.ssh_config()))
+
+Cached state is shared with VagrantContext (see basebox.state), so the two
+can be used on the same directory.  Commands only ever run on this machine.
+'''
+import collections
+import errno
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+import types
+
+from fabric.operations import _AttributeString
+
+from . import profile
+from .state import ContextState
+from .vagrant import VagrantContext, parse_ssh_config, parse_status
+
+
+class Return(Exception):
+    '''Raised by an operation to finish with `value`.'''
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Command(object):
+    '''
+    A shell command for the event loop to run.  Yielding one from an
+    operation resumes it with the command's output, which has the same
+    attributes (return_code, stderr, failed, etc.) as fabric's.  Unless
+    `warn_only` is set, a failed command raises an exception in the operation
+    instead.  Commands marked `exclusive` wait for any other exclusive
+    command with the same `cwd` to finish before they start.
+    '''
+
+    def __init__(self, command, cwd=None, env=None, warn_only=False,
+                 exclusive=False):
+        self.command = command
+        self.cwd = cwd
+        self.env = env or {}
+        self.warn_only = warn_only
+        self.exclusive = exclusive
+
+    def __repr__(self):
+        return '<Command %r>' % self.command
+
+
+def gather(*operations, **kwargs):
+    '''
+    Run `operations` (generators, Commands, or lists of them) concurrently,
+    and return their results in order once they've all finished.
+
+    Keyword arguments:
+    limit -- the most commands to run at once (no limit by default)
+    return_exceptions -- if set, the exception raised by an operation is
+        returned as its result; otherwise the first one is raised, but only
+        after every other operation has finished
+    '''
+    limit = kwargs.pop('limit', None)
+    return_exceptions = kwargs.pop('return_exceptions', False)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s' %
+                        ', '.join(sorted(kwargs)))
+
+    loop = _Loop(limit=limit)
+    results = [None] * len(operations)
+    errors = []
+    for idx, operation in enumerate(operations):
+        def done(value, error, idx=idx):
+            if error is None:
+                results[idx] = value
+            elif return_exceptions:
+                results[idx] = error[1]
+            else:
+                errors.append(error)
+        loop.wait_for(operation, done)
+    loop.run()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class AsyncVagrantContext(object):
+    '''
+    Non-blocking counterpart to VagrantContext for the VM lifecycle: each
+    method returns an operation for gather() to run, rather than running
+    anything itself.
+    '''
+
+    state_ttl = VagrantContext.state_ttl
+
+    def __init__(self, directory, loglevel='ERROR'):
+        self.directory = os.path.abspath(directory)
+        self.loglevel = loglevel
+        self.state = ContextState(self.directory)
+
+    def cached(self, vm, key):
+        return self.state.get(vm, key, max_age=self.state_ttl.get(key))
+
+    def command(self, cmd, warn_only=False, exclusive=False):
+        '''Return a Command that runs `cmd` in the context's directory.'''
+        return Command(cmd, cwd=self.directory,
+                       env={'VAGRANT_LOG': self.loglevel},
+                       warn_only=warn_only, exclusive=exclusive)
+
+    def uuid(self, vm=None):
+        '''
+        Return the VM's UUID from the cache or the .vagrant file, or None if
+        it hasn't been created.  This only reads files, so it isn't an
+        operation.
+        '''
+        uuid = self.cached(vm, 'uuid')
+        if not uuid:
+            try:
+                runinfo = json.load(open(os.path.join(self.directory,
+                                                      '.vagrant')))
+            except IOError:
+                return None
+            uuid = runinfo['active'].get(vm or 'default')
+            if uuid:
+                self.state.set(vm, 'uuid', uuid)
+        return uuid
+
+    def up(self, vm=None, provision=False):
+        return self._up('vagrant up', vm=vm, provision=provision)
+
+    def reload(self, vm=None, provision=False):
+        return self._up('vagrant reload', vm=vm, provision=provision)
+
+    def halt(self, vm=None, force=False):
+        return self._down('vagrant halt', vm=vm, force=force)
+
+    def destroy(self, vm=None, force=False):
+        return self._down('vagrant destroy', vm=vm, force=force)
+
+    def suspend(self, vm=None):
+        return self._run('vagrant suspend %s' % (vm or '',), vm=vm)
+
+    def resume(self, vm=None):
+        return self._run('vagrant resume %s' % (vm or '',), vm=vm)
+
+    def _up(self, cmd, vm=None, provision=False):
+        if vm:
+            cmd += ' ' + vm
+        cmd += ' --%sprovision' % ('' if provision else 'no-',)
+        result = yield self._run(cmd, vm=vm,
+                                 exclusive=self._rewrites_runfile())
+        self.uuid(vm=vm)  # cache UUID
+        raise Return(result)
+
+    def _down(self, cmd, vm=None, force=False):
+        destroy = cmd == 'vagrant destroy'
+        keep = () if destroy else ('uuid',)
+        if vm:
+            cmd += ' ' + vm
+        if force:
+            cmd += ' --force'
+        return self._run(cmd, vm=vm, keep=keep,
+                         exclusive=destroy and self._rewrites_runfile())
+
+    def _run(self, cmd, vm=None, keep=('uuid',), exclusive=False):
+        '''
+        Run a command that changes the state of `vm`, dropping its cached
+        state whether or not the command succeeds.
+        '''
+        try:
+            result = yield self.command(cmd, exclusive=exclusive)
+        finally:
+            self.state.invalidate(vm=vm, keep=keep)
+        raise Return(result)
+
+    def _rewrites_runfile(self):
+        # Vagrant 1.0 keeps every VM's UUID in the one .vagrant file and
+        # rewrites it whole, so its ups and destroys in a directory mustn't
+        # overlap (see VagrantContext._runfile_lock).
+        return not os.path.isdir(os.path.join(self.directory, '.vagrant'))
+
+    def status(self, vm=None):
+        status_map = self.cached(ContextState.ALL, 'status')
+        if status_map and (not vm or vm in status_map):
+            raise Return(status_map.get(vm) if vm else status_map)
+
+        status_map = parse_status((yield self.command(
+            'vagrant status %s' % (vm or '',))))
+        if not vm:
+            self.state.set(ContextState.ALL, 'status', status_map)
+        raise Return(status_map.get(vm) if vm else status_map)
+
+    def ssh_config(self, vm=None):
+        cached = self.cached(vm, 'ssh_config')
+        if cached:
+            raise Return(dict(cached))
+
+        ssh_info = parse_ssh_config((yield self.command(
+            'vagrant ssh-config %s' % (vm or '',))))
+        self.state.set(vm, 'ssh_config', ssh_info)
+        raise Return(dict(ssh_info))
+
+
+class _Task(object):
+    '''Drives an operation, resuming it as what it yields completes.'''
+
+    def __init__(self, loop, operation, callback):
+        self.loop = loop
+        self.operation = operation
+        self.callback = callback
+
+    def step(self, value=None, error=None):
+        try:
+            if error is not None:
+                yielded = self.operation.throw(*error)
+            else:
+                yielded = self.operation.send(value)
+        except Return as e:
+            self.callback(e.value, None)
+        except StopIteration:
+            self.callback(None, None)
+        except Exception:
+            self.callback(None, sys.exc_info())
+        else:
+            self.loop.wait_for(yielded, self.step)
+
+
+class _Process(object):
+
+    def __init__(self, command, popen, callback):
+        self.command = command
+        self.popen = popen
+        self.callback = callback
+        self.start = time.time()
+        self.output = {popen.stdout.fileno(): [], popen.stderr.fileno(): []}
+        self.open = set(self.output)
+
+
+class _Loop(object):
+    '''
+    Runs operations' commands as subprocesses, polling their output pipes
+    from a single thread, and resumes operations as their commands finish.
+    '''
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.ready = collections.deque()
+        self.queued = collections.deque()
+        self.running = set()
+        self.exclusive = set()  # cwds with an exclusive command running
+        self.fds = {}
+        self.poller = select.poll()
+
+    def wait_for(self, item, callback):
+        '''Call callback(value, exc_info) once `item` has completed.'''
+        if isinstance(item, Command):
+            self.queued.append((item, callback))
+        elif isinstance(item, types.GeneratorType):
+            task = _Task(self, item, callback)
+            self.ready.append(task.step)
+        elif isinstance(item, (list, tuple)):
+            self._wait_all(item, callback)
+        else:
+            try:
+                raise TypeError('Operations must yield Commands, generators '
+                                'or lists of them, not %r' % (item,))
+            except TypeError:
+                error = sys.exc_info()
+            self.ready.append(lambda: callback(None, error))
+
+    def _wait_all(self, items, callback):
+        if not items:
+            self.ready.append(lambda: callback([], None))
+            return
+
+        results = [None] * len(items)
+        errors = []
+        remaining = [len(items)]
+        for idx, item in enumerate(items):
+            def done(value, error, idx=idx):
+                results[idx] = value
+                if error is not None:
+                    errors.append(error)
+                remaining[0] -= 1
+                if not remaining[0]:
+                    callback(results, errors[0] if errors else None)
+            self.wait_for(item, done)
+
+    def run(self):
+        while self.ready or self.queued or self.running:
+            while self.ready:
+                self.ready.popleft()()
+            self._start_queued()
+            if self.running:
+                self._poll()
+
+    def _start_queued(self):
+        # Commands held back by a running exclusive command keep their place
+        # in the queue.  One is always running, so the loop can't stall.
+        waiting = collections.deque()
+        while self.queued and (not self.limit or
+                               len(self.running) < self.limit):
+            command, callback = self.queued.popleft()
+            if command.exclusive and command.cwd in self.exclusive:
+                waiting.append((command, callback))
+            else:
+                self._start(command, callback)
+        waiting.extend(self.queued)
+        self.queued = waiting
+
+    def _start(self, command, callback):
+        environ = dict(os.environ)
+        environ.update(command.env)
+        try:
+            popen = subprocess.Popen(command.command, shell=True,
+                                     cwd=command.cwd, env=environ,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, close_fds=True)
+        except OSError:
+            error = sys.exc_info()
+            self.ready.append(lambda: callback(None, error))
+            return
+
+        process = _Process(command, popen, callback)
+        self.running.add(process)
+        if command.exclusive:
+            self.exclusive.add(command.cwd)
+        for fd in process.output:
+            self.fds[fd] = process
+            self.poller.register(fd, select.POLLIN | select.POLLHUP)
+
+    def _poll(self):
+        try:
+            events = self.poller.poll()
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd, _ in events:
+            process = self.fds[fd]
+            data = os.read(fd, 65536)
+            if data:
+                process.output[fd].append(data)
+                continue
+
+            self.poller.unregister(fd)
+            del self.fds[fd]
+            process.open.discard(fd)
+            if not process.open:
+                self._finish(process)
+
+    def _finish(self, process):
+        self.running.discard(process)
+        if process.command.exclusive:
+            self.exclusive.discard(process.command.cwd)
+        popen = process.popen
+        return_code = popen.wait()
+        stdout = ''.join(process.output[popen.stdout.fileno()])
+        stderr = ''.join(process.output[popen.stderr.fileno()])
+        popen.stdout.close()
+        popen.stderr.close()
+
+        # Shaped like the result of fabric's local(capture=True)
+        result = _AttributeString(stdout.strip())
+        result.stderr = _AttributeString(stderr.strip())
+        result.command = result.real_command = process.command.command
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        profile.record_command(process.command.command, process.start,
+                               time.time() - process.start, result)
+
+        error = None
+        if result.failed and not process.command.warn_only:
+            try:
+                raise Exception('%s failed with exit code %s:\n%s' % (
+                    process.command.command, return_code,
+                    result.stderr or result))
+            except Exception:
+                error = sys.exc_info()
+        self.ready.append(lambda: process.callback(result, error))
@@ -1,33 +1,52 @@
 import contextlib
+import hashlib
+import inspect
+import json
+import re
+import shutil
+import tarfile
 import urlparse
 import types
 from functools import wraps
 
 from cuisine import *
 from fabric.api import env, settings
-from fabric.colors import green, red
+from fabric.colors import green
 from fabric.contrib import console
-from peak.util.proxies import ObjectProxy
+from peak.util.proxies import LazyProxy, ObjectProxy
 import jinja2
-from .vagrant import VagrantBox, installed_boxes
-from .util import default_to_local
+from .vagrant import (VagrantBox, installed_boxes, add_box, remove_box,
+    replace_box, box_staging_dir, install_box_dir, direct_box_installs)
+from .vagrant import vagrant_home as default_vagrant_home
+from .cache import BuildCache, cache_root
+from .download import DownloadCache
+from .package import (VFILE_COPY_FROM_BASE, VFILE_NONE, VFILE_STRATEGY_MAP,
+    VFILE_USE_CURRENT)
+from .pool import BoxPool
+from .profile import phase, phased
+from .util import default_to_local, file_lock, run
 
 
-VFILE_NONE = 0
-VFILE_USE_CURRENT = 1
-VFILE_COPY_FROM_BASE = 2
-VFILE_STRATEGY_MAP = {
-    'inherit': VFILE_COPY_FROM_BASE,
-    'none': VFILE_NONE,
-    'current': VFILE_USE_CURRENT
-}
+_template_env = None
 
 
-TEMPLATE_ENV = jinja2.Environment(loader=jinja2.ChoiceLoader([
-        jinja2.PackageLoader('basebox'),
-        jinja2.FileSystemLoader([os.getcwd()])
-        ])
-    )
+def template_env():
+    '''
+    Return the jinja2 environment that Vagrantfile templates are loaded from,
+    creating it on first use.
+    '''
+    global _template_env
+    if _template_env is None:
+        _template_env = jinja2.Environment(loader=jinja2.ChoiceLoader([
+            jinja2.PackageLoader('basebox'),
+            jinja2.FileSystemLoader([os.getcwd()])
+            ]))
+    return _template_env
+
+
+# Also available as a module attribute, for existing callers; it's still
+# only created when first used
+TEMPLATE_ENV = LazyProxy(template_env)
 
 
 def resolve_package_vagrantfile(vfile, box):
@@ -61,7 +80,7 @@ def resolve_package_vagrantfile(vfile, box):
 
 
 def get_inherited_vagrantfile(basebox, vagrant_home=None):
-    vagrant_home = vagrant_home or os.environ.get('VAGRANT_HOME', '$HOME/.vagrant.d')
+    vagrant_home = vagrant_home or default_vagrant_home()
     basefile = os.path.join(vagrant_home, 'boxes', basebox, 'include/_Vagrantfile')
     return basefile if file_exists(basefile) else None
 
@@ -89,6 +108,25 @@ class BaseboxDecorator(ObjectProxy):
                    Defaults to 'http://files.vagrantup.com/precise64.box'.
      package_as -- Package output file.
      package_vagrantfile -- Vagrantfile to package with the box.
+     compression -- Compression for the package, 'none' (the default) or
+                   'gzip', which needs `native_package`.
+     native_package -- Package the box with VBoxManage and basebox's own
+                   archiver rather than `vagrant package`, and with vagrant
+                   1.0, install it (or a cached build of it) by moving it
+                   into vagrant's box directory (see
+                   VagrantContext.package()).  Defaults to False.
+     zerofill   -- Zero the free disk space of the VM before packaging.
+     linked_clone -- Build in a linked clone of a master VM for the base box,
+                   rather than a full import (see tempbox()).
+     use_cache  -- Whether to reuse a previous build of the same box from the
+                   build cache (see basebox.cache.BuildCache).  Defaults to
+                   False.  The cache key covers the base box, the decorated
+                   function's source and arguments, and the Vagrantfile, but
+                   not the source of other functions it calls or the files it
+                   uploads.
+
+    A build served from the cache doesn't run the decorated function, and
+    returns None.
 
     Additionally, the @basebox decorator exposes the operations and information
     of the box it is building via an instance of VagrantContext, so wrapped
@@ -115,9 +153,10 @@ class BaseboxDecorator(ObjectProxy):
                 if self.__subject__ is not None:
                     return func(*a, **kw)
 
-                # Helper to read parameters from keyword args
+                # Helper to read parameters from keyword args, leaving the
+                # decorator's own alone for the next build
                 def readarg(arg, default=None):
-                    return kw.pop(arg, kwargs.pop(arg, None)) or default
+                    return kw.pop(arg, kwargs.get(arg)) or default
 
                 # Allow overrides in the functions keyword args also
                 install_as = readarg('install_as', func.func_name)
@@ -125,23 +164,67 @@ class BaseboxDecorator(ObjectProxy):
                 package_vfile = readarg('package_vagrantfile',
                                               VFILE_COPY_FROM_BASE)
                 package_as = readarg('package_as')
+                compression = readarg('compression', 'none')
+                native_package = readarg('native_package', False)
+                if isinstance(native_package, basestring):  # from fab args
+                    native_package = native_package.lower() in ('true', 'yes',
+                                                                '1')
+                zerofill = readarg('zerofill', False)
+                linked_clone = readarg('linked_clone', False)
+                use_cache = readarg('use_cache', False)
+                if isinstance(use_cache, basestring):  # e.g. from fab args
+                    use_cache = use_cache.lower() not in ('false', 'no', '0')
+                base = base if isinstance(base, Base) else Base(base)
+
+                # Reuse a previous build from identical inputs if possible
+                cache = BuildCache() if use_cache and is_local() else None
+                if cache:
+                    cache_key = cache.key(
+                        base.identity(),
+                        inspect.getsource(func),
+                        repr(a),
+                        repr(sorted(kw.items())),
+                        render_vagrantfile(base, for_key=True),
+                        repr(package_vfile),
+                        compression,
+                        native_package)
+                    with cache.used(cache_key) as cached:
+                        if cached:
+                            print green('Using cached build: %s' % cached)
+                            install_box_file(cached, install_as=install_as,
+                                             package_as=package_as,
+                                             direct=native_package)
+                            return None
 
                 # Create a temporary vagrant context, connect to it, and
                 # execute the context
-                with tempbox(base=base) as box:
-                    self.__subject__ = box
-
-                    # Connect to box and execute
-                    with box.connect():
-                        result = func(*a, **kw)
-
-                    # Determine how to package the box
-                    vfile_text = resolve_package_vagrantfile(package_vfile, box)
-                    box.package(vagrantfile=vfile_text,
-                                install_as=install_as,
-                                output=package_as)
-
-                    return result
+                try:
+                    with tempbox(base=base, linked_clone=linked_clone) as box:
+                        self.__subject__ = box
+
+                        # Connect to box and execute
+                        with box.connect(), phase('provision'):
+                            result = func(*a, **kw)
+
+                        # Determine how to package the box
+                        vfile_text = resolve_package_vagrantfile(package_vfile, box)
+                        # The build cache needs a package file, even if one
+                        # wasn't asked for
+                        output = package_as or ('package.box' if cache else None)
+                        box.package(vagrantfile=vfile_text,
+                                    install_as=install_as,
+                                    output=output,
+                                    compression=compression,
+                                    zerofill=zerofill,
+                                    native=native_package)
+                        if cache:
+                            cache.put(cache_key, os.path.join(
+                                box.directory, package_as or 'package.box'))
+
+                        return result
+                finally:
+                    # Let the next build through
+                    self.__subject__ = None
 
             return wrapper
 
@@ -157,7 +240,8 @@ basebox = BaseboxDecorator()
 @contextlib.contextmanager
 def tempbox(base='http://files.vagrantup.com/precise64.box',
             vfile_template='Vagrantfile.default',
-            vfile_template_context=None):
+            vfile_template_context=None,
+            linked_clone=False):
     '''
     Creates a temporary Vagrant box based on `base`, yielding a VagrantContext,
     then cleans it up after the context executes.
@@ -168,10 +252,12 @@ def tempbox(base='http://files.vagrantup.com/precise64.box',
                    + the URL of a remote box file
                    + an instance of Base, which the previous strings get
                      wrapped with anyways
+    `linked_clone` -- Create the box's VMs as linked clones of a master VM
+                   kept for the base box (see ensure_master()), instead of
+                   importing the base box's disk for each one.
     '''
     base = base if isinstance(base, Base) else Base(base)
-    vfile_template = TEMPLATE_ENV.get_template(vfile_template)
-    vfile_template_context = vfile_template_context or {}
+    build_dir = None
 
     # In a temp directory, create, build, and package a basic box
     try:
@@ -183,12 +269,14 @@ def tempbox(base='http://files.vagrantup.com/precise64.box',
         try:
             vagrant = VagrantBox(build_dir)
 
-            # Render the Vagrantfile template
-            vfile_template_context.update({'box': base.name,
-                                           'box_url': base.url,
-                                           'ssh': {}})
-            vagrantfile = vfile_template.render(vfile_template_context)
-            vagrant.rewrite_vagrantfile(vagrantfile)
+            vagrant.rewrite_vagrantfile(render_vagrantfile(
+                base, vfile_template, vfile_template_context))
+
+            if linked_clone:
+                master = ensure_master(base.name)
+                for box_name in vagrant.list_boxes():
+                    VagrantBox(vagrant.context, box_name).link_clone(
+                        master, MASTER_SNAPSHOT)
 
             vagrant.basebox = base.name
             yield vagrant
@@ -205,14 +293,154 @@ def tempbox(base='http://files.vagrantup.com/precise64.box',
         base.clean()
 
 
+MASTER_SNAPSHOT = 'basebox-master'
+
+
+@phased('ensure master')
+def ensure_master(box_name):
+    '''
+    Ensure that a master VM, imported from the installed box `box_name` and
+    snapshotted as MASTER_SNAPSHOT, is registered with VirtualBox for
+    tempboxes to be linked-cloned from, and return its name.
+
+    Masters are named after the box and the modification time of its OVF
+    file, so re-adding a box results in a fresh master.  The master itself
+    is never booted.  Masters left over from boxes that have since been
+    re-added or removed are deleted along the way (see reap_masters()).
+    '''
+    master, ovf = master_name(box_name)
+    if not master:
+        raise ValueError("Couldn't find an OVF file for box: %s" % box_name)
+
+    with _masters_locked():
+        if '"%s"' % master not in run('VBoxManage list vms'):
+            print green('Creating master VM for linked clones: %s' % master)
+            run('VBoxManage import %s --vsys 0 --vmname %s' % (ovf, master))
+            run('VBoxManage snapshot %s take %s' % (master, MASTER_SNAPSHOT))
+        _reap_masters()
+
+    return master
+
+
+def master_name(box_name):
+    '''
+    Return the name of the master VM for the installed box `box_name` (see
+    ensure_master()) and the OVF file it's imported from, or (None, None) if
+    the box has no OVF file.
+    '''
+    box_dir = os.path.join(default_vagrant_home(), 'boxes',
+                           box_name.replace('/', '-VAGRANTSLASH-'))
+    for root, _, files in os.walk(box_dir):
+        if 'box.ovf' in files:
+            ovf = os.path.join(root, 'box.ovf')
+            break
+    else:
+        return None, None
+
+    stamp = hashlib.sha1('%s:%s' % (ovf, os.stat(ovf).st_mtime)).hexdigest()
+    return ('basebox-master-%s-%s' % (re.sub('[^\w.-]', '_', box_name),
+                                      stamp[:8]), ovf)
+
+
+@phased('reap masters')
+def reap_masters():
+    '''
+    Delete the master VMs of boxes that are no longer installed, or have been
+    re-added since their master was created.  Masters that linked clones
+    still depend on are left for a later call.
+    '''
+    with _masters_locked():
+        _reap_masters()
+
+
+def _reap_masters():
+    current = set(master_name(box)[0] for box in installed_boxes())
+    for line in run('VBoxManage list vms').splitlines():
+        match = re.match(r'"(basebox-master-[^"]+)"', line.strip())
+        if match and match.group(1) not in current:
+            with settings(warn_only=True):
+                if run('VBoxManage unregistervm %s --delete' %
+                       match.group(1)).succeeded:
+                    print green('Removed stale master VM: %s' %
+                                match.group(1))
+
+
+@contextlib.contextmanager
+def _masters_locked():
+    # Serialize master creation and removal between concurrent builds
+    lockdir = cache_root()
+    if not os.path.isdir(lockdir):
+        os.makedirs(lockdir)
+    with file_lock(os.path.join(lockdir, 'masters.lock')):
+        yield
+
+
+def render_vagrantfile(base, vfile_template='Vagrantfile.default',
+                       vfile_template_context=None, for_key=False):
+    '''
+    Render the Vagrantfile for a box built on `base` (an instance of Base).
+    `vfile_template` may be a template name or a jinja2 template.
+
+    With `for_key`, the box is identified by the string it was specified with
+    rather than the name it's installed under, which can vary from build to
+    build.  This is suitable for cache keys but not for actual use.
+    '''
+    if not isinstance(vfile_template, jinja2.Template):
+        vfile_template = template_env().get_template(vfile_template)
+
+    context = dict(vfile_template_context or {})
+    context.update({'box': base.box_string if for_key else base.name,
+                    'box_url': base.url,
+                    'ssh': context.get('ssh', {})})
+    return vfile_template.render(context)
+
+
+def install_box_file(box_file, install_as=None, package_as=None,
+                     direct=False):
+    '''
+    Install an existing box file as `install_as` and/or copy it to
+    `package_as`, as though it had just been built.  With `direct`, and
+    vagrant 1.0 on the local machine, the box is unpacked straight into
+    vagrant's box directory (see install_box_dir()) rather than with `vagrant
+    box add`, which would copy the whole file before unpacking it.
+    '''
+    if install_as and direct and direct_box_installs():
+        print green('Installing box: %s' % install_as)
+        staging_dir = box_staging_dir()
+        try:
+            tarfile.open(box_file).extractall(staging_dir)
+            install_box_dir(install_as, staging_dir)
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+    elif install_as:
+        replace_box(install_as, box_file)
+    if package_as:
+        shutil.copyfile(box_file, package_as)
+
+
 class Base(object):
     '''
     Given a string representing a box name, file path, or URL, determines
     which one it is and provides methods to temporarily install a box if needed
     and clean it up later.
+
+    Boxes at http(s) URLs are fetched through the local download cache (see
+    basebox.download.DownloadCache) unless `download_cache` is False.  A
+    checksum to verify the download against can be given in the URL's
+    fragment, e.g. 'http://example.com/base.box#sha256=<hex digest>'.
+
+    When building locally, temporarily installed boxes are shared through the
+    box pool (see basebox.pool.BoxPool) unless `pool` is False, so that they
+    stay installed between builds instead of being added and removed every
+    time.  Boxes at URLs are only pooled when they're fetched through the
+    download cache, which tells when they've changed.
     '''
-    def __init__(self, string):
+    def __init__(self, string, download_cache=True, pool=True):
         self.box_string = string
+        self.download_cache = download_cache
+        self.pool = BoxPool() if pool and is_local() else None
+        self.pool_key = None
 
         if self.box_string in installed_boxes():
             self.name = self.box_string
@@ -222,7 +450,7 @@ class Base(object):
             self.basename = self.box_string
         else:
             self.name = None
-            self.url = string
+            self.url = urlparse.urldefrag(string)[0]
             self.originally_installed = False
             self.installed = False
 
@@ -232,18 +460,103 @@ class Base(object):
                 path = urlparse.urlsplit(string).path
                 self.basename = os.path.basename(os.path.splitext(path)[0])
 
+    def identity(self):
+        '''
+        Describe the base box precisely enough to tell when it has changed,
+        for use in build cache keys.  A box at a URL is fetched into the
+        download cache to find out which version of it the server has.
+        '''
+        if self.originally_installed:
+            box_dir = os.path.join(default_vagrant_home(), 'boxes', self.name)
+            mtime = os.stat(box_dir).st_mtime if os.path.isdir(box_dir) else None
+            return ['box', self.name, mtime]
+        elif file_exists(self.box_string) and os.path.isfile(self.box_string):
+            st = os.stat(self.box_string)
+            return ['file', os.path.abspath(self.box_string), st.st_size,
+                    st.st_mtime]
+        else:
+            return ['url', self.box_string, self.version()]
+
+    @phased('ensure base')
     def ensure(self):
-        if not self.installed:
+        # Pooled boxes are keyed on their identity, which for a box at a URL
+        # includes the version the server has (revalidating the download
+        # cache's copy), so a changed box gets pooled afresh.  Boxes at URLs
+        # whose version can't be told aren't pooled.
+        identity = None
+        if self.pool and not self.installed:
+            identity = self.identity()
+        if identity and (identity[0] != 'url' or identity[-1]):
+            self.pool_key = json.dumps(identity)
+            self.name = self.pool.acquire(self.pool_key, self.basename,
+                                          self._install)
+            self.installed = True
+        elif not self.installed:
             self.name = self.name or self.find_unique_name()
             print green('Installing temporary box: %s' % self.name)
-            run('vagrant box add %s %s' % (self.name, self.box_string))
+            with self.fetched() as location:
+                add_box(self.name, location)
             self.installed = True
         pass
 
+    def fetch(self):
+        '''
+        Return the location to add the box from, downloading it into the local
+        download cache first where possible.
+        '''
+        if not self.cacheable():
+            return self.box_string
+        return DownloadCache().fetch(*self._download())
+
+    @contextlib.contextmanager
+    def fetched(self):
+        '''
+        Like fetch(), but as a context manager that keeps the downloaded box
+        from being evicted from the download cache until the block exits.
+        '''
+        if not self.cacheable():
+            yield self.box_string
+        else:
+            with DownloadCache().fetched(*self._download()) as path:
+                yield path
+
+    def version(self):
+        '''
+        Identify the version of a box at a URL (see DownloadCache.version()),
+        revalidating the download cache's copy of it first.  None if the box
+        isn't fetched through the download cache.
+        '''
+        if not self.cacheable():
+            return None
+        self.fetch()
+        return DownloadCache().version(urlparse.urldefrag(self.box_string)[0])
+
+    def cacheable(self):
+        '''Whether the box is fetched through the download cache.'''
+        url = urlparse.urldefrag(self.box_string)[0]
+        return bool(self.download_cache and is_local() and
+                    urlparse.urlsplit(url).scheme in ('http', 'https'))
+
+    def _download(self):
+        # The URL, and the checksum to verify it against from its fragment
+        url, fragment = urlparse.urldefrag(self.box_string)
+        checksum_type, _, checksum = fragment.partition('=')
+        return url, checksum or None, checksum_type or 'sha256'
+
+    def _install(self, name):
+        print green('Installing pooled box: %s' % name)
+        with self.fetched() as location:
+            add_box(name, location)
+
+    @phased('clean base')
     def clean(self):
-        if self.installed and not self.originally_installed:
+        if self.pool_key:
+            self.pool.release(self.pool_key)
+            self.pool_key = None
+            self.installed = False
+        elif self.installed and not self.originally_installed:
             print green('Removing temporary box: %s' % self.name)
-            run('vagrant box remove %s' % self.name)
+            remove_box(self.name)
 
     def find_unique_name(self):
         box_name = self.basename
@@ -0,0 +1,110 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from .util import file_lock
+
+
+def cache_root():
+    return (os.environ.get('BASEBOX_CACHE_DIR') or
+            os.path.expanduser('~/.basebox/cache'))
+
+
+class BuildCache(object):
+    '''
+    Content-addressed cache of built .box files, so that rebuilding a box
+    from identical inputs can skip booting and provisioning a VM entirely.
+
+    Entries are keyed by a hash of everything that determines the build's
+    output (see key()).  Whenever an entry is stored, least recently used
+    entries are evicted until the cache fits in `max_bytes`, except for
+    entries in use (see used()).
+
+    The cache lives on the local machine, under $BASEBOX_CACHE_DIR/builds
+    (~/.basebox/cache/builds by default), and its size budget can be set
+    with $BASEBOX_BUILD_CACHE_BYTES.
+    '''
+    default_max_bytes = 20 * 1024 ** 3
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or os.path.join(cache_root(), 'builds')
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('BASEBOX_BUILD_CACHE_BYTES',
+                                           self.default_max_bytes))
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        '''Hash `parts`, which must be JSON serializable, into a cache key.'''
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.box' % key)
+
+    @contextlib.contextmanager
+    def used(self, key):
+        '''
+        Context manager yielding the path of the cached box for `key`, or
+        None on a miss.  The box isn't evicted by other processes until the
+        block exits.
+        '''
+        path = self.path(key)
+        if not os.path.isdir(self.directory):
+            yield None
+            return
+        with file_lock(path + '.lock', shared=True):
+            if not os.path.exists(path):
+                yield None
+                return
+            os.utime(path, None)  # mark as recently used
+            yield path
+
+    def put(self, key, box_file):
+        '''Store a copy of `box_file` under `key` and return its path.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Copy to a temp file and rename it into place, so that concurrent
+        # builds never see a partial entry.
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        os.close(fd)
+        try:
+            shutil.copyfile(box_file, tmppath)
+            os.rename(tmppath, self.path(key))
+        except:
+            os.unlink(tmppath)
+            raise
+
+        self.evict(keep=key)
+        return self.path(key)
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used entries until within the size budget,
+        skipping entries that are in use.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.box') and name != '%s.box' % keep:
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:  # evicted by another process meanwhile
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        if keep and os.path.exists(self.path(keep)):
+            total += os.path.getsize(self.path(keep))
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.directory, name)
+            with file_lock(path + '.lock', blocking=False) as locked:
+                if not locked:
+                    continue
+                if os.path.exists(path):
+                    os.unlink(path)
+            total -= size
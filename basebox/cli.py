@@ -1,27 +1,46 @@
 import argparse
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
-import pkg_resources
 import re
 import StringIO
 import sys
+import time
+import traceback
 import types
 
-from basebox.build import (basebox, tempbox, VFILE_STRATEGY_MAP,
-    resolve_package_vagrantfile, TEMPLATE_ENV)
-from cuisine import mode_local, mode_remote
-import fabric.main
-import fabric.state
-import ssh
+# Only lightweight modules are imported up front, so that `basebox --version`
+# and `--help` return quickly.  Fabric, cuisine, jinja2 and the build
+# machinery are imported by the commands that use them.
+from basebox.package import COMPRESSORS, VFILE_STRATEGY_MAP
+from basebox.profile import phase, profiling
 
 
 LOG = logging.getLogger('basebox')
 LOG.level = logging.WARNING
 LOG.addHandler(logging.StreamHandler())
 
+DEFAULT_BASE = 'https://files.vagrantup.com/precise64.box'
+
 
 def main(args=None):
 
+    # Dispatch to subcommands
+    argv = sys.argv[1:] if args is None else args
+    if argv and argv[0] == 'build-many':
+        return build_many(argv[1:])
+
+    # Profile the whole build if asked to (see --profile)
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument('--profile')
+    with profiling(profile_parser.parse_known_args(argv)[0].profile):
+        return build(args)
+
+
+def build(args=None):
+    '''Build a box as described by the command line (see main()).'''
     parser = argparse.ArgumentParser(
         add_help=False,
         description='''
@@ -30,7 +49,8 @@ executing fabric tasks.  %(prog)s is implemented as a thin wrapper around
 fabric's 'fab' command.  It creates a temporary vagrant environment, configures
 fabric to connect to it, then hands off execution to fabric, which runs its
 tasks against the environment.  When finished, it packages and/or installs the
-built box according to the arguments provided.''')
+built box according to the arguments provided.  To run several builds at once,
+see '%(prog)s build-many --help'.''')
 
     meta = parser.add_argument_group(title='optional arguments')
     meta.add_argument('-h', '--help',
@@ -43,6 +63,13 @@ built box according to the arguments provided.''')
         help='''show program's version number and exit'''
         )
 
+    meta.add_argument('--profile',
+        help='''Write a trace of the commands run during the build, in Chrome's
+            trace event format, to PROFILE_FILE (viewable in chrome://tracing),
+            and print a summary of where the time went.''',
+        metavar='PROFILE_FILE'
+        )
+
     meta.add_argument('--log-level',
         help='Level for logging program output',
         default='warning',
@@ -59,14 +86,13 @@ built box according to the arguments provided.''')
         help='''Vagrant base box to build with.  Defaults to vagrant's
             precise64 box, also available at
             https://files.vagrantup.com/precise64.box''',
-        default='https://files.vagrantup.com/precise64.box'
+        default=DEFAULT_BASE
         )
 
     main.add_argument('--vagrantfile-template',
         # help='Jinja template for rendering Vagrantfile to build with',
         help=argparse.SUPPRESS,
-        default=TEMPLATE_ENV.get_template('Vagrantfile.default'),
-        type=TEMPLATE_ENV.get_template
+        default='Vagrantfile.default'
         )
 
     main.add_argument('--package-as',
@@ -86,11 +112,62 @@ built box according to the arguments provided.''')
         metavar='(VFILE_PATH|VFILE_STRING|inherit|none)'
         )
 
+    main.add_argument('--compression',
+        help='''Compression for the package file, which needs
+            --native-package.  Gzipped boxes are compressed on all CPUs, but
+            need vagrant 1.1 or later.  Defaults to 'none'.''',
+        choices=sorted(COMPRESSORS),
+        default='none'
+        )
+
+    main.add_argument('--native-package',
+        help='''Package the box with VBoxManage and basebox's own archiver,
+            rather than with `vagrant package`, which is much faster for large
+            disks.  With vagrant 1.0, the box (or a cached build of it) is
+            also installed by moving it into vagrant's box directory, rather
+            than with `vagrant box add`.''',
+        action='store_true'
+        )
+
+    main.add_argument('--zerofill',
+        help='''Zero the free space on the build VM's disk before packaging,
+            to shrink the package.''',
+        action='store_true'
+        )
+
     main.add_argument('--install-as',
         help='Install the built box to vagrant as BOXNAME',
         metavar='BOXNAME'
         )
 
+    main.add_argument('--linked-clone',
+        help='''Create the build VMs as linked clones of a master VM for the
+            base box, instead of importing the base box for each one.''',
+        action='store_true'
+        )
+
+    main.add_argument('--cache',
+        help='''Reuse an identical build from the build cache instead of
+            building the box, and add the build to the cache.  Builds are
+            identified by the base box, the fabfile's Python source, the
+            arguments and the Vagrantfile, but not by templates or other files
+            the fabfile uses, so don't use this when those change.''',
+        action='store_true'
+        )
+
+    main.add_argument('--parallel',
+        help='''Boot up to N vagrant hosts at once.  If N is omitted, all hosts
+            are booted at once.  Defaults to booting hosts one at a time.
+            With vagrant 1.0, which keeps every host's state in one file,
+            `vagrant up` still runs for one host at a time.  (Use '-P' for
+            fabric's parallel execution mode.)''',
+        metavar='N',
+        nargs='?',
+        type=int,
+        const=0,
+        default=1
+        )
+
     # Arguments shared with fabric
     shared = parser.add_argument_group(title='shared arguments',
         description='''These arguments are arguments to fabric, but
@@ -138,10 +215,12 @@ built box according to the arguments provided.''')
     if '--' in fab_args:
         fab_args.remove('--')
 
-    # Flatten host-role entries and map bidirectionally
+    # Flatten host-role entries and map bidirectionally.  Without any hosts,
+    # build a single box under vagrant's default name.
     host_roles = {}
     roledefs = {}
-    for host, roles in [tpl for sublist in args.hosts for tpl in sublist]:
+    hosts = args.hosts or [[('default', [])]]
+    for host, roles in [tpl for sublist in hosts for tpl in sublist]:
         if roles:
             LOG.info('Host <%s> specified with roles: %s' % (host, roles))
         else:
@@ -166,10 +245,25 @@ built box according to the arguments provided.''')
         parser.print_help()
     elif args.version:
         print_version()
+    elif args.compression != 'none' and not args.native_package:
+        print '--compression needs --native-package.'
     else:
         if not (args.install_as or args.package_as):
             print 'No action specified (you should use --install-as or --package-as).'
         else:
+            from basebox.build import (tempbox, Base, template_env,
+                resolve_package_vagrantfile, render_vagrantfile,
+                install_box_file)
+            from basebox.cache import BuildCache
+            from basebox.vagrant import ssh_config_entry
+            from cuisine import mode_local, mode_remote
+            import fabric.main
+            import fabric.state
+            import ssh
+
+            vfile_template = template_env().get_template(
+                args.vagrantfile_template)
+
             # Replace sys.argv to simulate calling fabric as a CLI script
             argv_original = sys.argv
             stderr_original = sys.stderr
@@ -195,7 +289,8 @@ built box according to the arguments provided.''')
             fabfile_original = fabric.state.env.fabfile
             if args.fabfile:
                 fabric.state.env.fabfile = args.fabfile
-            if not fabric.main.find_fabfile():
+            fabfile = fabric.main.find_fabfile()
+            if not fabfile:
                 print ("Fabric couldn't find any fabfiles! (You may want to "
                     "change directories or specify the -f option)")
                 raise SystemExit
@@ -213,9 +308,33 @@ built box according to the arguments provided.''')
                 }
 
             mode_local()
-            with tempbox(base=args.base, 
-                         vfile_template=args.vagrantfile_template,
-                         vfile_template_context=vfile_ctx) as default_box:
+            base = Base(args.base)
+
+            # Reuse a previous build from identical inputs if possible
+            cache = BuildCache() if args.cache else None
+            if cache:
+                cache_key = cache.key(
+                    base.identity(),
+                    fabfile_digest(fabfile),
+                    fab_args,
+                    render_vagrantfile(base, vfile_template,
+                                       vfile_ctx, for_key=True),
+                    repr(args.package_vagrantfile),
+                    args.compression,
+                    args.native_package)
+                with cache.used(cache_key) as cached:
+                    if cached:
+                        print 'Using cached build: %s' % cached
+                        install_box_file(cached, install_as=args.install_as,
+                                         package_as=args.package_as,
+                                         direct=args.native_package)
+                        sys.argv = argv_original
+                        return
+
+            with tempbox(base=base,
+                         vfile_template=vfile_template,
+                         vfile_template_context=vfile_ctx,
+                         linked_clone=args.linked_clone) as default_box:
 
                 context = default_box.context
 
@@ -225,16 +344,14 @@ built box according to the arguments provided.''')
                 ssh_configs = ssh_conf._config
             
                 # Add a host entry to SSH config for each vagrant box
-                for box_name in context.list_boxes():
-                    box = context[box_name]
-                    box.up()
-
-                    ssh_settings = box.ssh_config()
+                with phase('boot'):
+                    booted = boot_boxes(context, args.parallel)
+                for box_name, ssh_settings in booted:
                     ssh_settings.update({
                         'host': box_name,
                         'stricthostkeychecking': 'no'
                         })
-                    ssh_configs.append(ssh_settings)
+                    ssh_configs.append(ssh_config_entry(ssh_settings))
 
                 fabric.api.settings.use_ssh_config = True
                 fabric.api.env._ssh_config = ssh_conf
@@ -243,7 +360,7 @@ built box according to the arguments provided.''')
                 fabric.state.env.roledefs = roledefs
 
                 # Hand execution over to fabric
-                with mode_remote():
+                with mode_remote(), phase('fabric'):
                     try:
                         fabric.main.main()
                     except SystemExit as e:  # Raised when fabric finishes.
@@ -252,15 +369,187 @@ built box according to the arguments provided.''')
                             raise
                         pass
 
-                vfile = resolve_package_vagrantfile(args.package_vagrantfile)
+                vfile = resolve_package_vagrantfile(args.package_vagrantfile,
+                                                    default_box)
+                # The build cache needs a package file, even if one wasn't
+                # asked for
+                output = args.package_as or ('package.box' if cache else None)
                 context.package(vagrantfile=vfile,
                                 install_as=args.install_as,
-                                output=args.package_as)
+                                output=output,
+                                compression=args.compression,
+                                zerofill=args.zerofill,
+                                native=args.native_package)
+                if cache:
+                    cache.put(cache_key, os.path.join(
+                        context.directory, args.package_as or 'package.box'))
 
             sys.argv = argv_original
 
 
+def build_many(args=None):
+    '''
+    Run several builds described by a JSON manifest, in parallel.  Usage:
+
+    >>> basebox build-many manifest.json --parallel 4
+
+    The manifest is a list of builds, each an object with the keys:
+
+     name       -- Name to report the build under.  Defaults to install_as or
+                   package_as.
+     base       -- Base box, as for --base.
+     fabfile    -- Fabfile to run, relative to the manifest.
+     tasks      -- List of fabric tasks (with arguments) to run.
+     hosts      -- List of hosts, as for -H.
+     install_as, package_as, package_vagrantfile -- As for the options of
+                   the same names.
+     args       -- List of any other arguments to pass to basebox.
+
+    Each build runs in its own worker process, so fabric's global state is
+    isolated between them.  Base boxes that need to be added to vagrant are
+    added once, before any builds start, and shared between the builds that
+    use them.  A summary of each build's status and duration is printed at
+    the end, and the command fails if any build failed.
+    '''
+    parser = argparse.ArgumentParser(prog='basebox build-many',
+        description='Run several builds described by a JSON manifest.')
+    parser.add_argument('manifest',
+        help='JSON file listing the builds to run'
+        )
+    parser.add_argument('--parallel',
+        help='''Run up to N builds at once.  Defaults to the number of
+            CPUs.''',
+        metavar='N',
+        type=int,
+        default=multiprocessing.cpu_count()
+        )
+    parser.add_argument('--profile',
+        help='''Write a trace of the commands run by all of the builds to
+            PROFILE_FILE, as for the --profile option of a single build.''',
+        metavar='PROFILE_FILE'
+        )
+    args = parser.parse_args(args=args)
+
+    from basebox.build import Base
+    from basebox.parallel import parallel_map
+    from cuisine import mode_local
+
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    builds = json.load(open(args.manifest))
+
+    with profiling(args.profile):
+        mode_local()
+        bases = {}
+        try:
+            # Add each distinct base box once, up front
+            for build in builds:
+                base_string = build.get('base', DEFAULT_BASE)
+                if base_string not in bases:
+                    bases[base_string] = Base(base_string)
+                    bases[base_string].ensure()
+
+            def run_build(build):
+                build_args = ['--base', bases[build.get('base', DEFAULT_BASE)].name]
+                if build.get('fabfile'):
+                    build_args += ['-f', os.path.join(manifest_dir,
+                                                      build['fabfile'])]
+                for option in ['install_as', 'package_as', 'package_vagrantfile']:
+                    if build.get(option):
+                        build_args += ['--%s' % option.replace('_', '-'),
+                                       build[option]]
+                if build.get('hosts'):
+                    build_args += ['-H'] + build['hosts']
+                build_args += build.get('args', []) + ['--'] + build.get('tasks', [])
+
+                start = time.time()
+                try:
+                    main(build_args)
+                    return time.time() - start, None
+                except (Exception, SystemExit):
+                    return time.time() - start, traceback.format_exc()
+
+            results = parallel_map(run_build, builds, pool_size=args.parallel)
+        finally:
+            for base in bases.values():
+                base.clean()
+
+    # Summarize
+    failed = False
+    print ''
+    print '%-40s %-8s %10s' % ('BUILD', 'STATUS', 'SECONDS')
+    for build, result, error in results:
+        name = (build.get('name') or build.get('install_as') or
+                build.get('package_as'))
+        elapsed, error = result or (None, error)
+        failed = failed or bool(error)
+        print '%-40s %-8s %10s' % (name, 'failed' if error else 'ok',
+                                   '%.1f' % elapsed if elapsed else '-')
+        if error:
+            LOG.error('Build <%s> failed:%s%s' % (name, os.linesep, error))
+
+    if failed:
+        raise SystemExit(1)
+
+
+def boot_boxes(context, parallel=1):
+    '''
+    Bring up every box in `context`, at most `parallel` at a time (or all at
+    once if `parallel` is 0), and return a list of (box_name, ssh_config)
+    tuples.  Every box gets the chance to boot before any failures are
+    reported.  The context serializes the `vagrant up`s themselves where
+    vagrant needs it (see VagrantContext._runfile_lock()).
+    '''
+    from basebox.parallel import parallel_map
+    from basebox.vagrant import VagrantBox
+
+    def boot(box_name):
+        box = VagrantBox(context, box_name=box_name)
+        box.up()
+        return box.ssh_config()
+
+    box_names = context.list_boxes()
+    if parallel == 1:
+        results = []
+        for box_name in box_names:
+            try:
+                results.append((box_name, boot(box_name), None))
+            except (Exception, SystemExit):
+                results.append((box_name, None, traceback.format_exc()))
+    else:
+        results = parallel_map(boot, box_names, pool_size=parallel)
+
+    failures = [(box_name, error) for box_name, _, error in results if error]
+    for box_name, error in failures:
+        LOG.error('Failed to boot host <%s>:%s%s' % (box_name, os.linesep,
+                                                     error))
+    if failures:
+        raise SystemExit('Failed to boot hosts: %s' %
+                         ', '.join(box_name for box_name, _ in failures))
+
+    return [(box_name, ssh_settings) for box_name, ssh_settings, _ in results]
+
+
+def fabfile_digest(fabfile):
+    '''
+    Hash the contents of a fabfile, or of every python module in it if it's a
+    package, for use in build cache keys.
+    '''
+    digest = hashlib.sha1()
+    if os.path.isdir(fabfile):
+        paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(fabfile)
+                       for name in names if name.endswith('.py'))
+    else:
+        paths = [fabfile]
+
+    for path in paths:
+        digest.update(path)
+        digest.update(open(path).read())
+    return digest.hexdigest()
+
+
 def print_version():
+    import pkg_resources
     from .version import __version__
     print 'basebox %s' % __version__
     for pkg in ['fabric', 'ssh', 'cuisine']:
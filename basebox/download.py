@@ -0,0 +1,270 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+import urllib2
+import urlparse
+
+from fabric.colors import green, red
+
+from .cache import cache_root
+from .util import file_lock
+
+
+class DownloadCache(object):
+    '''
+    Local cache of downloaded files (typically base boxes), so that builds
+    from a box URL don't download it again every time.
+
+    Downloads are streamed to disk in chunks and resumed with HTTP range
+    requests if interrupted.  Cached files are revalidated against the
+    server with their ETag/Last-Modified headers before reuse, and used as-is
+    if the server can't be reached.  Files the server sent neither header
+    for are reused for `ttl` seconds after they were downloaded.  Least
+    recently used files are evicted to keep the cache within `max_bytes`,
+    except for files in use (see fetched()).
+
+    The cache lives under $BASEBOX_CACHE_DIR/downloads (by default
+    ~/.basebox/cache/downloads), and its size budget and TTL can be set with
+    $BASEBOX_DOWNLOAD_CACHE_BYTES and $BASEBOX_DOWNLOAD_TTL.
+    '''
+    default_max_bytes = 20 * 1024 ** 3
+    default_ttl = 24 * 60 * 60
+    chunk_size = 1024 * 1024
+
+    def __init__(self, directory=None, max_bytes=None, ttl=None):
+        self.directory = directory or os.path.join(cache_root(), 'downloads')
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('BASEBOX_DOWNLOAD_CACHE_BYTES',
+                                           self.default_max_bytes))
+        if ttl is None:
+            ttl = float(os.environ.get('BASEBOX_DOWNLOAD_TTL',
+                                       self.default_ttl))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def path(self, url):
+        key = hashlib.sha1(url).hexdigest()[:16]
+        basename = os.path.basename(urlparse.urlsplit(url).path) or 'download'
+        return os.path.join(self.directory, '%s-%s' % (key, basename))
+
+    def fetch(self, url, checksum=None, checksum_type='sha256'):
+        '''
+        Return the path of a local copy of `url`, downloading it if it isn't
+        cached or has changed.  If `checksum` is given, the file's
+        `checksum_type` digest must match it, or ValueError is raised.
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        path = self.path(url)
+        with self._locked(path):
+            meta = self._read_meta(path)
+            if os.path.exists(path) and self._is_fresh(url, meta):
+                print green('Using cached download: %s' % path)
+            else:
+                meta = self._download(url, path, meta)
+
+            if checksum:
+                actual = meta.get('checksums', {}).get(checksum_type)
+                if not actual:
+                    actual = self._digest(path, checksum_type)
+                    meta.setdefault('checksums', {})[checksum_type] = actual
+                    self._write_meta(path, meta)
+                if actual != checksum.lower():
+                    os.unlink(path)
+                    raise ValueError('Checksum mismatch for %s: expected %s '
+                                     '%s, got %s' % (url, checksum_type,
+                                                     checksum, actual))
+
+            os.utime(path, None)  # mark as recently used
+            self.evict(keep=path)
+        return path
+
+    @contextlib.contextmanager
+    def fetched(self, url, checksum=None, checksum_type='sha256'):
+        '''
+        Like fetch(), but as a context manager that keeps the local copy from
+        being evicted by other processes until the block exits.
+        '''
+        while True:
+            path = self.fetch(url, checksum=checksum,
+                              checksum_type=checksum_type)
+            with self._locked(path, shared=True):
+                # Another process may have evicted it after fetch() returned
+                if os.path.exists(path):
+                    yield path
+                    return
+
+    def version(self, url):
+        '''
+        Identify the cached copy of `url` by the ETag or Last-Modified header
+        it was downloaded with, or by its sha256 digest if the server sent
+        neither.  None if `url` isn't cached.
+        '''
+        path = self.path(url)
+        if not os.path.exists(path):
+            return None
+        with self._locked(path):
+            meta = self._read_meta(path)
+            version = meta.get('etag') or meta.get('last_modified')
+            if not version and os.path.exists(path):
+                checksums = meta.setdefault('checksums', {})
+                if 'sha256' not in checksums:
+                    checksums['sha256'] = self._digest(path, 'sha256')
+                    self._write_meta(path, meta)
+                version = 'sha256:' + checksums['sha256']
+            return version
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used files until within the size budget,
+        skipping files that are being fetched or used.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            filepath = os.path.join(self.directory, name)
+            if os.path.splitext(name)[1] in ('.json', '.lock', '.part'):
+                continue
+            if filepath != keep:
+                try:
+                    st = os.stat(filepath)
+                except OSError:  # evicted by another process meanwhile
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+
+        total = sum(size for _, size, _ in entries)
+        if keep and os.path.exists(keep):
+            total += os.path.getsize(keep)
+
+        for _, size, filepath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with self._locked(filepath, blocking=False) as locked:
+                if not locked:
+                    continue
+                for stale in (filepath, filepath + '.json'):
+                    if os.path.exists(stale):
+                        os.unlink(stale)
+            total -= size
+
+    def _is_fresh(self, url, meta):
+        '''Revalidate a cached copy of `url` with a conditional request.'''
+        if not (meta.get('etag') or meta.get('last_modified')):
+            return time.time() - meta.get('downloaded', 0) < self.ttl
+
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return e.code == 304
+        except urllib2.URLError as e:
+            print red("Couldn't revalidate %s (%s), using cached copy" %
+                      (url, e.reason))
+            return True
+
+        # Servers that ignore conditional requests still send validators
+        headers = response.info()
+        return bool((meta.get('etag') and
+                     headers.get('ETag') == meta['etag']) or
+                    (meta.get('last_modified') and
+                     headers.get('Last-Modified') == meta['last_modified']))
+
+    def _download(self, url, path, meta):
+        # The partial download keeps its own validators, as the ones in
+        # path + '.json' describe the complete copy at `path` until the
+        # download finishes and replaces it.
+        partial = path + '.part'
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+
+        # Resume a partial download only if it's of the same version of the
+        # file, which If-Range makes the server check for us.
+        request = urllib2.Request(url)
+        partial_meta = self._read_meta(partial)
+        validator = (partial_meta.get('etag') or
+                     partial_meta.get('last_modified'))
+        if offset and validator:
+            request.add_header('Range', 'bytes=%s-' % offset)
+            request.add_header('If-Range', validator)
+        else:
+            offset = 0
+
+        response = urllib2.urlopen(request)
+        if response.getcode() != 206:
+            offset = 0
+
+        # Record validators before downloading, so an interrupted download
+        # can be resumed.
+        headers = response.info()
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+        self._write_meta(partial, meta)
+
+        expected = _expected_size(headers, offset)
+        print green('Downloading %s%s' %
+                    (url, ' (resuming at %s bytes)' % offset if offset else ''))
+        with open(partial, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+
+        # Servers closing the connection early look like the end of the file,
+        # so leave short downloads to be resumed next time.
+        if expected is not None and offset != expected:
+            raise IOError('Incomplete download of %s: got %s of %s bytes' %
+                          (url, offset, expected))
+
+        meta['downloaded'] = time.time()
+        self._write_meta(partial, meta)
+        os.rename(partial, path)
+        os.rename(partial + '.json', path + '.json')
+        return meta
+
+    def _digest(self, path, checksum_type):
+        digest = hashlib.new(checksum_type)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _read_meta(self, path):
+        try:
+            return json.load(open(path + '.json'))
+        except (IOError, ValueError):
+            return {}
+
+    def _write_meta(self, path, meta):
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    def _locked(self, path, shared=False, blocking=True):
+        # Serialize downloads and eviction of the same file between processes,
+        # while letting any number of them use it.
+        return file_lock(path + '.lock', shared=shared, blocking=blocking)
+
+
+def _expected_size(headers, offset):
+    '''
+    The full size of a file being downloaded from `offset`, from the
+    response's Content-Range or Content-Length headers.  None if the server
+    sent neither.
+    '''
+    content_range = headers.get('Content-Range')
+    if offset and content_range:
+        total = content_range.rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+    if headers.get('Content-Length', '').isdigit():
+        return offset + int(headers['Content-Length'])
+    return None
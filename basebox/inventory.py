@@ -0,0 +1,134 @@
+'''
+Inventory of every VM in many vagrant contexts at once.
+
+Asking each VagrantContext for its status() and vminfo() costs a command or
+more per context (or per VM).  inventory() instead reads the contexts'
+Vagrantfiles and .vagrant files, and gets every VM's state and details from
+a single `VBoxManage list -l vms`, however many contexts there are, so it's
+cheap enough to poll:
+
+    directories = discover(['/srv/builds'])
+    while True:
+        for (directory, name), vm in sorted(inventory(directories).items()):
+            print directory, name, vm['status']
+        time.sleep(5)
+
+Everything is read on this machine.
+'''
+import os
+import traceback
+
+from cuisine import mode_local
+from fabric.api import settings
+
+from .util import run
+from .vagrant import VagrantContext, parse_vbox_vms, read_runfile
+
+
+def discover(roots):
+    '''
+    Return the directories of the vagrant contexts in and under `roots`,
+    i.e. those holding a Vagrantfile, sorted.  Hidden directories and those
+    within a context aren't searched.
+    '''
+    directories = set()
+    for root in roots:
+        for directory, subdirs, files in os.walk(os.path.abspath(root)):
+            if 'Vagrantfile' in files:
+                directories.add(directory)
+                subdirs[:] = []
+            else:
+                subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+    return sorted(directories)
+
+
+def inventory(directories):
+    '''
+    Describe every VM in the vagrant contexts in `directories` (see
+    discover()).  Returns a dict keyed by (directory, vm name), whose values
+    are dicts like info()'s with the keys:
+
+     home   -- The context's directory.
+     uuid   -- The VM's UUID, or None if it hasn't been created or the
+               .vagrant file can't be read.
+     status -- The VM's state as vagrant reports it, e.g. 'running',
+               'poweroff' or 'not created', or None if VirtualBox couldn't
+               be asked.
+     vm     -- The VM's details, as for vminfo() but limited to what
+               `VBoxManage list -l vms` shows (see parse_vbox_vms()), or None
+               if it hasn't been created or the .vagrant file can't be read.
+     error  -- None, or for a context that couldn't be described at all, a
+               formatted traceback.  Such contexts get a single entry, keyed
+               by (directory, None), rather than one per VM.
+
+    VMs that haven't been created are only included if the Vagrantfile
+    defines them in a way that can be read without vagrant (see
+    VagrantContext.defined_vms()).  Contexts whose .vagrant file can't be
+    read, such as corrupt ones, cost a `vagrant status` each.
+    '''
+    table = {}
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        machines = read_machine_ids(os.path.join(directory, '.vagrant'))
+        if machines is None:
+            try:
+                with mode_local():
+                    status_map = VagrantContext(directory).status()
+            except (Exception, SystemExit):
+                table[(directory, None)] = _entry(
+                    directory, status=None, error=traceback.format_exc())
+                continue
+            for name, status in status_map.items():
+                table[(directory, name)] = _entry(directory, status=status)
+            continue
+
+        names = VagrantContext(directory).defined_vms() or []
+        for name in names + sorted(set(machines) - set(names)):
+            table[(directory, name)] = _entry(directory,
+                                              uuid=machines.get(name))
+
+    if any(vm['uuid'] for vm in table.values()):
+        with mode_local(), settings(warn_only=True):
+            result = run('VBoxManage list -l vms')
+        vms = parse_vbox_vms(result) if result.succeeded else None
+        for vm in table.values():
+            if vms is None and vm['uuid']:
+                vm['status'] = None  # unknown
+            elif vm['uuid'] in (vms or {}):
+                vm['status'] = vms[vm['uuid']]['state']
+                vm['vm'] = vms[vm['uuid']]['vminfo']
+
+    return table
+
+
+def read_machine_ids(path):
+    '''
+    Return the map of VM names to UUIDs in a .vagrant file, as for
+    read_runfile(), or in vagrant 1.1+'s .vagrant directory, where they're
+    kept in machines/<name>/virtualbox/id.
+    '''
+    if not os.path.isdir(path):
+        return read_runfile(path)
+
+    machines = {}
+    machines_dir = os.path.join(path, 'machines')
+    for name in (os.listdir(machines_dir) if os.path.isdir(machines_dir)
+                 else []):
+        try:
+            uuid = open(os.path.join(machines_dir, name, 'virtualbox',
+                                     'id')).read().strip()
+        except IOError:  # not created, or not a VirtualBox VM
+            continue
+        if uuid:
+            machines[name] = uuid
+    return machines
+
+
+def _entry(directory, uuid=None, status='not created', error=None):
+    return {
+        'home': directory,
+        'uuid': uuid,
+        'status': status,
+        'vm': None,
+        'error': error
+        }
@@ -1,24 +1,21 @@
 
-try:
-    from paramiko import io_sleep
-except ImportError:
-    try:
-        from ssh import io_sleep
-    except ImportError:
-        io_sleep = .01
-
+import errno
+import os
+import select
 import subprocess
-import time
+import sys
+import threading
 
 from fabric.api import env, settings
 from fabric.state import output
+from fabric.utils import _AttributeDict
 from fabric.operations import (_shell_wrap, _prefix_commands, _prefix_env_vars,
     _sudo_prefix, _AttributeString)
-from fabric.io import output_loop
-from fabric.thread_handling import ThreadHandler
 
 import cuisine
 
+from .profile import instrument
+
 
 def patch():
     '''
@@ -34,8 +31,159 @@ def patch():
         https://github.com/fabric/fabric/blob/master/fabric/operations.py
 
         https://github.com/sebastien/cuisine/pull/93
+
+    Local commands are also recorded when profiling (see basebox.profile).
+    '''
+    cuisine.run_local = instrument(run_local)
+
+
+def isolate_env():
+    '''
+    Give fabric's env per-thread overlays (see _ThreadLocalEnv).  This is
+    done by isolated_env() in basebox.util the first time it's used, so env
+    is left alone unless something asks for a thread's own view of it.
+    '''
+    with _isolate_lock:
+        if type(env) is not _ThreadLocalEnv:
+            # env maps attribute assignment to items, so go around it
+            object.__setattr__(env, '__class__', _ThreadLocalEnv)
+
+
+_isolate_lock = threading.Lock()
+
+_DELETED = object()
+
+
+class _ThreadLocalEnv(_AttributeDict):
     '''
-    cuisine.run_local = run_local
+    Fabric's env, with an optional stack of overlays per thread.
+
+    Fabric and cuisine keep all of their settings in the one global env dict,
+    which every module imports directly, so rather than replacing it,
+    isolate_env() swaps in this class.  While a thread has an overlay pushed,
+    the thread's writes (including those made by settings(), cd(),
+    mode_local() and the like) go to the overlay, and its reads see the
+    overlay on top of the shared env.  Other threads are unaffected.  Without
+    an overlay, env behaves exactly as before.
+
+    Overlays are copy-on-write for assignment only: mutating a shared value
+    in place (e.g. appending to env.hosts) is still visible to everyone.
+    '''
+    _local = threading.local()
+
+    def _overlay(self):
+        overlays = getattr(self._local, 'overlays', None)
+        return overlays[-1] if overlays else None
+
+    def _push_overlay(self):
+        overlays = self._local.__dict__.setdefault('overlays', [])
+        overlays.append(dict(overlays[-1]) if overlays else {})
+
+    def _pop_overlay(self):
+        self._local.overlays.pop()
+
+    def _merged(self):
+        # Whole-env reads only need a merged copy while an overlay is pushed
+        if self._overlay() is None:
+            return self
+        merged = dict.copy(self)
+        for key, value in (self._overlay() or {}).items():
+            if value is _DELETED:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        return merged
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            if overlay[key] is _DELETED:
+                raise KeyError(key)
+            return overlay[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__setitem__(self, key, value)
+        else:
+            overlay[key] = value
+
+    def __delitem__(self, key):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__delitem__(self, key)
+        elif key not in self:
+            raise KeyError(key)
+        else:
+            overlay[key] = _DELETED
+
+    def __contains__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key] is not _DELETED
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        if self._overlay() is None:
+            dict.clear(self)
+        else:
+            for key in self._merged():
+                del self[key]
+
+    def copy(self):
+        merged = self._merged()
+        return dict.copy(self) if merged is self else merged
+
+    def keys(self):
+        return dict.keys(self._merged())
+
+    def values(self):
+        return dict.values(self._merged())
+
+    def items(self):
+        return dict.items(self._merged())
+
+    def __iter__(self):
+        return dict.__iter__(self._merged())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return dict.itervalues(self._merged())
+
+    def iteritems(self):
+        return dict.iteritems(self._merged())
+
+    def __len__(self):
+        return dict.__len__(self._merged())
 
 
 def run_local(command, sudo=False, shell=True, pty=True, combine_stderr=None):
@@ -122,6 +270,10 @@ def _run_command_local(command, shell=True, combine_stderr=True, sudo=False,
 def _execute_local(command, shell=True, combine_stderr=None):
     '''
     Local implementation of fabric.operations._execute using subprocess.
+
+    Output is multiplexed with select() in this thread rather than polling the
+    process and reading from helper threads, so the call returns as soon as
+    the process closes its output and exits.
     '''
     if combine_stderr is None:
         combine_stderr = env.combine_stderr
@@ -131,44 +283,76 @@ def _execute_local(command, shell=True, combine_stderr=None):
                                stdout=subprocess.PIPE,
                                stderr=stderr)
 
-    # Create handlers to buffer and store output with fabric's output_loop()
     capture_out, capture_err = [], []
-    channel = MockChannel(process.stdout, process.stderr)
-    workers = (
-        ThreadHandler('out', output_loop, channel, "recv", capture_out),
-        ThreadHandler('err', output_loop, channel, "recv_stderr", capture_err),
-    )
-
-    # Wait for process to finish, raising on any errors
-    while process.poll() is None:
-        for worker in workers:
-            e = worker.exception
-            if e:
-                raise e[0], e[1], e[2]
-        time.sleep(io_sleep)
-
-    # Join threads to make sure all output was read
-    for worker in workers:
-        worker.thread.join()
+    streams = {
+        process.stdout.fileno(): _OutputStream('out', sys.stdout,
+                                               output.stdout, capture_out),
+    }
+    if not combine_stderr:
+        streams[process.stderr.fileno()] = _OutputStream(
+            'err', sys.stderr, output.stderr, capture_err)
+
+    # Read until every pipe hits EOF, then reap the process
+    open_fds = list(streams)
+    while open_fds:
+        try:
+            readable, _, _ = select.select(open_fds, [], [])
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in readable:
+            try:
+                data = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if data:
+                streams[fd].write(data)
+            else:
+                streams[fd].close()
+                open_fds.remove(fd)
+
+    process.wait()
+    process.stdout.close()
+    if process.stderr:
+        process.stderr.close()
 
     out = ''.join(capture_out).rstrip('\n')
     err = ''.join(capture_err).rstrip('\n')
     return out, err, process.returncode
 
 
-class MockChannel(object):
+class _OutputStream(object):
     '''
-    Implement just enough of an interface so that we can act as an output
-    channel in fabric's output_loop() function.
-
-    Input is not implemented at this time.
+    Buffers output read from one of a process' pipes, echoing it line by line
+    with fabric's usual '[<host string>] out: ' style prefixes if that output
+    level is enabled.
     '''
-    def __init__(self, stdout, stderr):
-        def reader(buf):
-            def recv(*args, **kwargs):
-                return buf.read(*args, **kwargs)
-            return recv if buf else lambda *a, **kw: ''
-
-        self.recv = reader(stdout)
-        self.recv_stderr = reader(stderr)
-        self.sendall = lambda *a, **kw: None  # no-op
+    def __init__(self, name, stream, printing, capture):
+        self.stream = stream
+        self.printing = printing
+        self.capture = capture
+        self.prefix = ('[%s] %s: ' % (env.host_string, name)
+                       if env.output_prefix else '')
+        self.at_line_start = True
+
+    def write(self, data):
+        self.capture.append(data)
+        if not self.printing:
+            return
+
+        for line in data.splitlines(True):
+            if self.at_line_start:
+                self.stream.write(self.prefix)
+            self.stream.write(line)
+            self.at_line_start = line.endswith(('\n', '\r'))
+        self.stream.flush()
+
+    def close(self):
+        if self.printing and not self.at_line_start:
+            self.stream.write('\n')
+            self.stream.flush()
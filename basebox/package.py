@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import struct
+import tarfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+
+# The Vagrantfile `vagrant package` puts in a box, which points vagrant at
+# the box's network interface and loads the packaged Vagrantfile, if any.
+BOX_VAGRANTFILE = '''Vagrant::Config.run do |config|
+  # This Vagrantfile is auto-generated by basebox to contain
+  # the MAC address of the box. Custom configuration should be placed in
+  # the actual `Vagrantfile` in this box.
+  config.vm.base_mac = "%(mac)s"
+end
+
+# Load include vagrant file if it exists after the auto-generated
+# so it can override any of the settings
+include_vagrantfile = File.expand_path("../include/_Vagrantfile", __FILE__)
+load include_vagrantfile if File.exist?(include_vagrantfile)
+'''
+
+CHUNK_SIZE = 1024 * 1024
+
+
+# Strategies for the Vagrantfile to package with a built box
+VFILE_NONE = 0
+VFILE_USE_CURRENT = 1
+VFILE_COPY_FROM_BASE = 2
+VFILE_STRATEGY_MAP = {
+    'inherit': VFILE_COPY_FROM_BASE,
+    'none': VFILE_NONE,
+    'current': VFILE_USE_CURRENT
+}
+
+
+def write_box(output, files=(), contents=(), compression='none', **options):
+    '''
+    Write a box archive to `output`, which may be a path or a writable file
+    object (e.g. a pipe), containing `files`, a list of (archive name, path)
+    tuples, and `contents`, a list of (archive name, string) tuples.
+
+    `compression` names one of COMPRESSORS, and any other keyword arguments
+    are passed through to it.  The archive is streamed through the
+    compressor as it's written, so there are no intermediate copies, and
+    written to a temporary file beside `output` until complete.
+    '''
+    if hasattr(output, 'write'):
+        _write_archive(output, files, contents, compression, options)
+        return output
+
+    partial = output + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            _write_archive(f, files, contents, compression, options)
+    except:
+        os.unlink(partial)
+        raise
+    os.rename(partial, output)
+    return output
+
+
+def _write_archive(fileobj, files, contents, compression, options):
+    if compression not in COMPRESSORS:
+        raise ValueError('Unknown compression: %s (expected one of %s)' %
+                         (compression, ', '.join(sorted(COMPRESSORS))))
+    writer = COMPRESSORS[compression](fileobj, **options)
+    try:
+        # Tar headers are written by hand so file data can be copied in large
+        # chunks, rather than tarfile's 16K ones.
+        for arcname, path in files:
+            st = os.stat(path)
+            writer.write(_tar_header(arcname, st.st_size, st.st_mtime))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    writer.write(chunk)
+            writer.write(_tar_padding(st.st_size))
+
+        for arcname, data in contents:
+            writer.write(_tar_header(arcname, len(data)))
+            writer.write(data)
+            writer.write(_tar_padding(len(data)))
+
+        writer.write('\0' * (tarfile.BLOCKSIZE * 2))
+    finally:
+        writer.close()
+
+
+def _tar_header(arcname, size, mtime=None):
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mode = 0644
+    if mtime is not None:
+        info.mtime = int(mtime)
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def _tar_padding(size):
+    return '\0' * (-size % tarfile.BLOCKSIZE)
+
+
+class PlainWriter(object):
+    '''Writes the archive uncompressed.'''
+
+    def __init__(self, fileobj, **options):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+class ParallelGzipWriter(object):
+    '''
+    Gzip compresses the archive on a pool of `threads` threads.
+
+    The stream is cut into `block_size` blocks, and each block is compressed
+    independently into its own gzip member.  Concatenated members make a
+    valid gzip file, at the cost of a slightly worse compression ratio.
+    zlib releases the GIL while compressing, so the blocks really are
+    compressed in parallel.
+    '''
+
+    def __init__(self, fileobj, level=6, threads=None,
+                 block_size=4 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.pool = ThreadPool(self.threads)
+        self.pending = []
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def close(self):
+        try:
+            if self.buffered:
+                self._submit()
+            while self.pending:
+                self.fileobj.write(self.pending.pop(0).get())
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+    def _submit(self):
+        block = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(
+            _gzip_member, (block, self.level)))
+
+        # Write finished blocks in order, keeping a bounded number in flight
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.pop(0).get())
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([
+        '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',  # header, no mtime
+        compressor.compress(data),
+        compressor.flush(),
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                    len(data) & 0xffffffff)
+        ])
+
+
+# Compression schemes for write_box().  Vagrant 1.0 can only add boxes that
+# are uncompressed tar files; gzipped boxes need vagrant 1.1 or later.
+COMPRESSORS = {
+    'none': PlainWriter,
+    'gzip': ParallelGzipWriter,
+}
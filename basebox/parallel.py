@@ -0,0 +1,73 @@
+import multiprocessing
+import Queue
+import traceback
+
+from fabric import state
+
+from . import profile
+
+
+def parallel_map(func, items, pool_size=None):
+    '''
+    Apply `func` to each of `items` in forked worker processes, running at most
+    `pool_size` of them at once (all of them if no size is given).
+
+    Worker processes are forked the same way fabric's own parallel execution
+    is, so each one gets an isolated copy of fabric's global `env` and can
+    freely use context managers like cd() and settings() without stepping on
+    its siblings.  `func` doesn't need to be picklable, but its return value
+    does.
+
+    Returns a list of (item, result, error) tuples in the same order as
+    `items`.  `error` is None on success, or a formatted traceback string if
+    the call raised (including SystemExit from fabric's abort()).  Whatever
+    the workers record with an active profiler or command counter is merged
+    into it.
+    '''
+    items = list(items)
+    pool_size = pool_size or len(items)
+    results = [None] * len(items)
+    queue = multiprocessing.Queue()
+    pending = list(enumerate(items))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < pool_size:
+            idx, item = pending.pop(0)
+            proc = multiprocessing.Process(target=_worker,
+                                           args=(func, idx, item, queue))
+            proc.start()
+            running[idx] = proc
+
+        # Drain the result before joining, otherwise a worker with a large
+        # result can block forever on the queue's pipe.
+        try:
+            idx, result, error, recorded = queue.get(timeout=1)
+        except Queue.Empty:
+            # Catch workers that died without reporting (e.g. were killed)
+            for idx, proc in running.items():
+                if not proc.is_alive() and proc.exitcode != 0:
+                    running.pop(idx)
+                    results[idx] = (items[idx], None, 'Worker exited with '
+                                    'code %s' % proc.exitcode)
+            continue
+        running.pop(idx).join()
+        results[idx] = (items[idx], result, error)
+        profile.merge_results(recorded)
+
+    return results
+
+
+def _worker(func, idx, item, queue):
+    # Connections inherited from the parent share its sockets, so make sure
+    # this process opens its own.
+    state.connections.clear()
+
+    # Send back only what's recorded in this process
+    profile.worker_reset()
+
+    try:
+        result, error = func(item), None
+    except BaseException:
+        result, error = None, traceback.format_exc()
+    queue.put((idx, result, error, profile.worker_results()))
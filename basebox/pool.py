@@ -0,0 +1,150 @@
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import re
+import time
+
+from fabric.colors import green
+
+from .cache import cache_root
+from .util import file_lock
+from .vagrant import _box_registry, installed_boxes, remove_box, vagrant_home
+
+
+class BoxPool(object):
+    '''
+    Pool of temporarily installed base boxes, shared between builds.
+
+    Rather than adding a base box at the start of every build and removing it
+    at the end, builds acquire() a box from the pool, which adds it only if
+    it isn't installed already, and release() it when they're done.  Each
+    box is reference counted by the ids of the processes using it, so
+    concurrent builds can share it, and references held by processes that
+    died are ignored.  Boxes that nobody is using are reaped once they
+    haven't been used for `max_age` seconds, or least recently used first
+    when the pool grows past `max_bytes` on disk.
+
+    The pool's state is kept in $BASEBOX_CACHE_DIR/pool.json, guarded by a
+    lock file.  Its limits can be set with $BASEBOX_POOL_MAX_AGE and
+    $BASEBOX_POOL_BYTES.
+    '''
+    default_max_age = 7 * 24 * 60 * 60
+    default_max_bytes = 20 * 1024 ** 3
+
+    def __init__(self, path=None, max_age=None, max_bytes=None):
+        self.path = path or os.path.join(cache_root(), 'pool.json')
+        if max_age is None:
+            max_age = int(os.environ.get('BASEBOX_POOL_MAX_AGE',
+                                         self.default_max_age))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('BASEBOX_POOL_BYTES',
+                                           self.default_max_bytes))
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def name(self, source, basename):
+        '''The name a box from `source` is installed under in the pool.'''
+        digest = hashlib.sha1(source).hexdigest()[:8]
+        return 'pool-%s-%s' % (re.sub('[^\w.-]', '_', basename), digest)
+
+    def acquire(self, source, basename, install):
+        '''
+        Take a reference to the pooled box for `source`, calling
+        `install(name)` to add it to vagrant first if needed.  Returns the
+        name of the box.
+        '''
+        name = self.name(source, basename)
+
+        # Installs of the same box are serialized by their own lock, so that
+        # slow downloads don't hold up builds from other boxes.
+        with self._locked(self.path + '.%s.lock' % name):
+            # Rescan rather than trust the registry, which can miss a box
+            # another build installed within the same mtime tick.
+            _box_registry.invalidate()
+            with self._state() as state:
+                if name in installed_boxes():
+                    # Adopt the box if the pool lost track of it, say if
+                    # pool.json was removed or $BASEBOX_CACHE_DIR changed.
+                    entry = state.setdefault(source,
+                                             {'name': name, 'refs': []})
+                    print green('Using pooled box: %s' % name)
+                    self._add_ref(entry)
+                    return name
+
+            install(name)
+
+            with self._state() as state:
+                entry = state[source] = {'name': name, 'refs': []}
+                self._add_ref(entry)
+        return name
+
+    def release(self, source):
+        '''Drop this process' reference to the box for `source`.'''
+        with self._state() as state:
+            entry = state.get(source)
+            if entry:
+                if os.getpid() in entry['refs']:
+                    entry['refs'].remove(os.getpid())
+                entry['last_used'] = time.time()
+        self.reap()
+
+    def reap(self):
+        '''Remove unused boxes that are too old or over the disk budget.'''
+        with self._state() as state:
+            unused = []
+            for source, entry in state.items():
+                entry['refs'] = [pid for pid in entry['refs'] if _alive(pid)]
+                if entry['name'] not in installed_boxes():
+                    del state[source]
+                elif not entry['refs']:
+                    unused.append((entry.get('last_used', 0), source))
+
+            total = sum(_box_size(entry['name']) for entry in state.values())
+            for last_used, source in sorted(unused):
+                too_old = time.time() - last_used > self.max_age
+                if not (too_old or total > self.max_bytes):
+                    continue
+                name = state.pop(source)['name']
+                total -= _box_size(name)
+                print green('Removing pooled box: %s' % name)
+                remove_box(name)
+
+    def _add_ref(self, entry):
+        entry['refs'].append(os.getpid())
+        entry['last_used'] = time.time()
+
+    @contextlib.contextmanager
+    def _state(self):
+        with self._locked(self.path + '.lock'):
+            try:
+                state = json.load(open(self.path))
+            except (IOError, ValueError):
+                state = {}
+            yield state
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(self.path + '.tmp', self.path)
+
+    def _locked(self, lockpath):
+        directory = os.path.dirname(lockpath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return file_lock(lockpath)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _box_size(name):
+    box_dir = os.path.join(vagrant_home(), 'boxes',
+                           name.replace('/', '-VAGRANTSLASH-'))
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(box_dir)
+               for filename in filenames)
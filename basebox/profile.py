@@ -0,0 +1,311 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+
+_profiler = None
+_counters = []
+_local = threading.local()
+
+
+class Profiler(object):
+    '''
+    Timeline of the external commands basebox runs (vagrant, VBoxManage,
+    etc.), and the phases of a build they're run in.
+
+    Every command run through an instrument()ed function is recorded with its
+    duration, exit code, output size, and the innermost phase and VM it was
+    run for.  Phases are operations like `up` or `package`, marked with
+    phase() or phased().  Events are stored in Chrome's trace event format,
+    so write() produces a file that can be loaded into chrome://tracing or
+    Perfetto, and summary() totals them up by command.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, name, category, start, duration, **args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args
+            }
+        with self._lock:
+            self.events.append(event)
+
+    def command(self, command, start, duration, result):
+        name, vm = _current_phase()
+        self.record(classify(command), 'command', start, duration,
+                    command=command,
+                    phase=name,
+                    vm=vm,
+                    exit_code=getattr(result, 'return_code', None),
+                    output_bytes=len(result) if result is not None else None)
+
+    def clear(self):
+        self.events = []
+
+    def recorded(self):
+        return self.events
+
+    def merge(self, events):
+        '''Add events recorded elsewhere, e.g. in a worker process.'''
+        with self._lock:
+            self.events.extend(events)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        '''
+        Return a table of the time spent in each kind of command and phase,
+        slowest first.  Durations of commands run concurrently are summed.
+        '''
+        lines = []
+        for category, title in [('command', 'COMMAND'), ('phase', 'PHASE')]:
+            totals = {}
+            for event in self.events:
+                if event['cat'] == category:
+                    total = totals.setdefault(event['name'], [0, 0, 0])
+                    total[0] += 1
+                    total[1] += event['dur']
+                    total[2] = max(total[2], event['dur'])
+            if not totals:
+                continue
+
+            lines.append('%-40s %6s %10s %10s' % (title, 'COUNT', 'SECONDS',
+                                                  'MAX'))
+            for name, (count, total, longest) in sorted(
+                    totals.items(), key=lambda item: -item[1][1]):
+                lines.append('%-40s %6s %10.2f %10.2f' %
+                             (name, count, total / 1e6, longest / 1e6))
+            lines.append('')
+        return os.linesep.join(lines)
+
+
+def active():
+    '''Return the active Profiler, or None if profiling is off.'''
+    return _profiler
+
+
+@contextlib.contextmanager
+def profiling(path=None):
+    '''
+    Profile the commands run within the block, then write a trace of them to
+    `path` and print a summary.  Does nothing if `path` is None, or if a
+    profiler is already active.
+    '''
+    global _profiler
+    if path is None or _profiler is not None:
+        yield _profiler
+        return
+
+    _profiler = Profiler()
+    try:
+        yield _profiler
+    finally:
+        profiler, _profiler = _profiler, None
+        profiler.write(path)
+        print ''
+        print profiler.summary()
+        print 'Wrote profile trace to %s' % path
+
+
+def instrument(func):
+    '''
+    Wrap a run()-like function, taking the command to run as its first
+    argument, so that its calls are recorded by the active profiler and
+    command counters.  Only the outermost of nested instrumented calls (e.g.
+    cuisine's run() calling run_local()) is recorded.
+    '''
+    @wraps(func)
+    def wrapper(command, *args, **kwargs):
+        if ((_profiler is None and not _counters) or
+                getattr(_local, 'depth', 0)):
+            return func(command, *args, **kwargs)
+
+        _local.depth = 1
+        start = time.time()
+        result = None
+        try:
+            result = func(command, *args, **kwargs)
+            return result
+        finally:
+            _local.depth = 0
+            record_command(command, start, time.time() - start, result)
+    return wrapper
+
+
+def record_command(command, start, duration, result):
+    '''
+    Record a command that wasn't run through an instrument()ed function with
+    the active profiler and command counters.
+    '''
+    for listener in _listeners():
+        listener.command(command, start, duration, result)
+
+
+class CommandCounter(object):
+    '''
+    Counts the external commands run while it's active (see
+    count_commands()), so that tests can hold hot paths to a budget:
+
+    >>> with count_commands() as counter:
+    ...     with context.connect():
+    ...         pass
+    >>> counter.assert_at_most(1)
+    >>> counter.assert_at_most(0, 'vagrant')
+
+    Commands are classified as by classify(), e.g. 'vagrant up' or
+    'VBoxManage showvminfo'.
+    '''
+
+    def __init__(self):
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def command(self, command, start, duration, result):
+        with self._lock:
+            self.commands.append(command)
+
+    def clear(self):
+        self.commands = []
+
+    def recorded(self):
+        return self.commands
+
+    def merge(self, commands):
+        with self._lock:
+            self.commands.extend(commands)
+
+    def counts(self):
+        '''Return the number of commands of each kind.'''
+        counts = {}
+        for command in self.commands:
+            kind = classify(command)
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def count(self, kind=None):
+        '''
+        Return the number of commands of `kind`, which may be a whole kind
+        like 'vagrant up' or a prefix like 'vagrant', or of all commands.
+        '''
+        return len(self._matching(kind))
+
+    def assert_at_most(self, limit, kind=None):
+        '''
+        Raise AssertionError if more than `limit` commands of `kind` (as for
+        count()) were run.
+        '''
+        matching = self._matching(kind)
+        if len(matching) > limit:
+            raise AssertionError(
+                'Expected at most %s %scommands, got %s:%s%s' % (
+                    limit, '%s ' % kind if kind else '', len(matching),
+                    os.linesep, os.linesep.join(matching)))
+
+    def _matching(self, kind):
+        return [command for command in self.commands
+                if kind is None or classify(command) == kind or
+                classify(command).startswith(kind + ' ')]
+
+
+@contextlib.contextmanager
+def count_commands():
+    '''Count the external commands run within the block.'''
+    counter = CommandCounter()
+    _counters.append(counter)
+    try:
+        yield counter
+    finally:
+        _counters.remove(counter)
+
+
+def worker_reset():
+    '''
+    In a freshly forked worker process, forget what was recorded before the
+    fork, so that worker_results() only returns what the worker records.
+    '''
+    for listener in _listeners():
+        listener.clear()
+
+
+def worker_results():
+    '''Return what was recorded in this worker, for merge_results().'''
+    return [listener.recorded() for listener in _listeners()]
+
+
+def merge_results(results):
+    '''Merge worker_results() from a worker into the parent's listeners.'''
+    for listener, recorded in zip(_listeners(), results or []):
+        if recorded:
+            listener.merge(recorded)
+
+
+def _listeners():
+    return ([_profiler] if _profiler is not None else []) + _counters
+
+
+@contextlib.contextmanager
+def phase(name, vm=None):
+    '''Mark the commands run within the block as belonging to phase `name`.'''
+    if _profiler is None:
+        yield
+        return
+
+    phases = _local.__dict__.setdefault('phases', [])
+    phases.append((name, vm or (phases[-1][1] if phases else None)))
+    start = time.time()
+    try:
+        yield
+    finally:
+        _, vm = phases.pop()
+        _profiler.record(name, 'phase', start, time.time() - start, vm=vm)
+
+
+def phased(name):
+    '''
+    Decorator version of phase(), which takes the VM from the decorated
+    function's `vm` keyword argument.
+    '''
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name, vm=kwargs.get('vm')):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def classify(command):
+    '''
+    Reduce a command to the program and, for vagrant and VBoxManage, the
+    subcommand it runs, e.g. 'vagrant up', 'vagrant box add' or 'VBoxManage
+    showvminfo'.
+    '''
+    words = command.split()
+    if not words:
+        return command
+    program = os.path.basename(words[0])
+    if program in ('vagrant', 'VBoxManage') and len(words) > 1:
+        if words[1:2] == ['box'] and len(words) > 2:
+            return '%s %s %s' % (program, words[1], words[2])
+        return '%s %s' % (program, words[1])
+    return program
+
+
+def _current_phase():
+    phases = getattr(_local, 'phases', None)
+    return phases[-1] if phases else (None, None)
@@ -0,0 +1,117 @@
+import contextlib
+import json
+import os
+import tempfile
+import time
+
+from .util import file_lock
+
+
+class ContextState(object):
+    '''
+    On-disk cache of facts about the VMs in a vagrant context (uuid, ip,
+    ssh-config, status, vminfo, etc.), so that they survive across processes
+    and don't have to be rediscovered with slow vagrant/VBoxManage calls.
+
+    The cache lives in a JSON file next to the context's '.vagrant' file.
+    Every value is stored with the time it was recorded, so callers can ask
+    for values no older than `max_age` seconds.  The whole cache is dropped
+    whenever the '.vagrant' file changes underneath it, which catches VMs
+    created or destroyed outside of basebox.  Writes are serialized between
+    processes with a lock file.
+
+    Values are keyed per VM, plus a context-wide entry (vm=ALL) for facts that
+    cover every VM at once.
+    '''
+    filename = '.basebox-state'
+    ALL = '*'
+
+    def __init__(self, directory, enabled=True):
+        self.path = os.path.join(directory, self.filename)
+        self.lockpath = self.path + '.lock'
+        self.runfile = os.path.join(directory, '.vagrant')
+        self.enabled = enabled
+
+    def get(self, vm, key, max_age=None):
+        if not self.enabled:
+            return None
+        entry = self._load().get(self._vm_key(vm), {}).get(key)
+        if entry is None:
+            return None
+        if max_age is not None and time.time() - entry['timestamp'] > max_age:
+            return None
+        return entry['value']
+
+    def set(self, vm, key, value):
+        self.set_many(vm, {key: value})
+
+    def set_many(self, vm, values):
+        if not self.enabled:
+            return
+        with self._update() as vms:
+            entries = vms.setdefault(self._vm_key(vm), {})
+            for key, value in values.items():
+                entries[key] = {'value': value, 'timestamp': time.time()}
+
+    def invalidate(self, vm=None, keep=()):
+        '''
+        Drop cached values for `vm`, or for every VM if `vm` is None.  Keys
+        listed in `keep` are retained.  Context-wide values are always
+        dropped, since they include the invalidated VMs.
+        '''
+        if not self.enabled:
+            return
+        with self._update() as vms:
+            targets = vms.keys() if vm is None else [self._vm_key(vm),
+                                                     self.ALL]
+            for target in targets:
+                entries = vms.pop(target, {})
+                kept = dict((k, v) for k, v in entries.items() if k in keep)
+                if kept and target != self.ALL:
+                    vms[target] = kept
+
+    def forget(self, vm, keys):
+        '''
+        Drop the cached values for `vm` whose keys start with any of `keys`.
+        '''
+        if not self.enabled:
+            return
+        with self._update() as vms:
+            entries = vms.get(self._vm_key(vm), {})
+            for key in entries.keys():
+                if key.startswith(tuple(keys)):
+                    del entries[key]
+
+    def _vm_key(self, vm):
+        return vm or 'default'
+
+    def _runfile_mtime(self):
+        try:
+            return os.stat(self.runfile).st_mtime
+        except OSError:
+            return None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get('runfile_mtime') != self._runfile_mtime():
+            return {}
+        return data.get('vms', {})
+
+    @contextlib.contextmanager
+    def _update(self):
+        with file_lock(self.lockpath):
+            vms = self._load()
+            yield vms
+
+            # Write to a temp file and rename it into place, so readers
+            # never see a partially written cache.
+            fd, tmppath = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), prefix=self.filename)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'runfile_mtime': self._runfile_mtime(),
+                           'vms': vms}, f)
+            os.rename(tmppath, self.path)
@@ -0,0 +1,142 @@
+import hashlib
+import inspect
+import os
+import re
+
+from fabric.colors import green, red
+
+from .build import (Base, VFILE_COPY_FROM_BASE, render_vagrantfile,
+    resolve_package_vagrantfile)
+from .cache import cache_root
+from .profile import phase
+from .vagrant import VagrantBox
+from .util import default_to_local, run
+
+
+class StepBuild(object):
+    '''
+    A box build split into a sequence of named steps, which can be rerun
+    incrementally.
+
+    Unlike tempbox(), the build VM is kept in a persistent directory between
+    runs, and a VirtualBox snapshot is taken after each step.  Each snapshot
+    is tagged with a fingerprint of the base box, the Vagrantfile, and the
+    source of every step up to and including its own.  On a rerun, the
+    deepest snapshot whose fingerprint still matches is restored and only
+    the steps after it are executed, so a failure in the last step or a
+    change to it doesn't mean rebuilding from the base box.
+
+    >>> build = StepBuild('web', [('packages', install_packages),
+    ...                           ('app', deploy_app)], base='precise64')
+    >>> build.run(install_as='web')
+
+    Steps are callables (such as fabric tasks) executed while connected to
+    the build VM, given either as (name, callable) tuples or bare callables
+    named after their function.  Only the steps' own source is
+    fingerprinted, not the source of functions they call.
+    '''
+    snapshot_prefix = 'basebox-step'
+
+    def __init__(self, name, steps, base='http://files.vagrantup.com/precise64.box',
+                 directory=None, vfile_template='Vagrantfile.default',
+                 vfile_template_context=None):
+        self.name = name
+        self.steps = [step if isinstance(step, tuple) else
+                      (getattr(step, '__name__', str(step)), step)
+                      for step in steps]
+        self.base = base if isinstance(base, Base) else Base(base)
+        self.directory = directory or os.path.join(cache_root(), 'steps', name)
+        self.vfile_template = vfile_template
+        self.vfile_template_context = vfile_template_context
+
+    def fingerprints(self):
+        '''Return the fingerprint of each prefix of the step sequence.'''
+        digest = hashlib.sha1(repr((
+            self.base.identity(),
+            render_vagrantfile(self.base, self.vfile_template,
+                               self.vfile_template_context, for_key=True))))
+
+        fingerprints = []
+        for step_name, step in self.steps:
+            func = getattr(step, 'wrapped', step)  # unwrap fabric tasks
+            try:
+                source = inspect.getsource(func)
+            except (IOError, TypeError):
+                source = repr(func)
+            digest.update(repr((step_name, source)))
+            fingerprints.append(digest.hexdigest())
+        return fingerprints
+
+    def snapshot_names(self):
+        return ['%s-%s-%s-%s' % (self.snapshot_prefix, idx,
+                                 re.sub('[^\w.-]', '_', step_name),
+                                 fingerprint[:12])
+                for idx, ((step_name, _), fingerprint)
+                in enumerate(zip(self.steps, self.fingerprints()))]
+
+    @default_to_local
+    def run(self, install_as=None, package_as=None,
+            package_vagrantfile=VFILE_COPY_FROM_BASE):
+        '''
+        Run every step that isn't covered by an up-to-date snapshot, then
+        package the result.  The build VM and its snapshots are kept for the
+        next run; use clean() to remove them.
+        '''
+        run('mkdir -p %s' % self.directory)
+        box = VagrantBox(self.directory)
+        snapshot_names = self.snapshot_names()
+
+        try:
+            self.base.ensure()
+            box.basebox = self.base.name
+
+            existing = box.snapshots() if box._machine_id() else []
+            completed = 0
+            for snapshot_name in snapshot_names:
+                if snapshot_name not in existing:
+                    break
+                completed += 1
+
+            if completed:
+                print green('Restoring snapshot after step %s of %s: %s' %
+                            (completed, len(self.steps),
+                             self.steps[completed - 1][0]))
+                if box.is_running():
+                    box.control('poweroff')
+                box.snapshot('restore', snapshot_names[completed - 1])
+            else:
+                if box._machine_id():
+                    print red('No reusable snapshots, rebuilding from base')
+                    box.destroy(force=True)
+                box.rewrite_vagrantfile(render_vagrantfile(
+                    self.base, self.vfile_template,
+                    self.vfile_template_context))
+
+            for idx in range(completed, len(self.steps)):
+                step_name, step = self.steps[idx]
+                print green('Running step %s of %s: %s' %
+                            (idx + 1, len(self.steps), step_name))
+                with box.connect(), phase('step %s' % step_name):
+                    step()
+                box.snapshot('take', snapshot_names[idx])
+
+            vfile_text = resolve_package_vagrantfile(package_vagrantfile, box)
+            box.package(vagrantfile=vfile_text,
+                        install_as=install_as,
+                        output=package_as)
+
+            # Drop snapshots left over from earlier versions of the steps
+            for snapshot_name in box.snapshots():
+                if (snapshot_name.startswith(self.snapshot_prefix) and
+                        snapshot_name not in snapshot_names):
+                    box.snapshot('delete', snapshot_name)
+        finally:
+            self.base.clean()
+
+    @default_to_local
+    def clean(self):
+        '''Destroy the build VM and its snapshots.'''
+        box = VagrantBox(self.directory)
+        if box._machine_id():
+            box.destroy(force=True)
+        run('rm -rf %s' % self.directory)
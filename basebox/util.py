@@ -1,17 +1,72 @@
 import contextlib
+import fcntl
 
-from fabric.api import env
+import cuisine
+from fabric.api import env, settings
 from cuisine import mode_local
 
+from . import monkey
+from .profile import instrument
+
+# basebox runs its commands through these rather than cuisine's own, so that
+# they're recorded when profiling (see basebox.profile)
+run = instrument(cuisine.run)
+sudo = instrument(cuisine.sudo)
+
 
 @contextlib.contextmanager
 def shell_env(**env_vars):
-    orig_shell = env['shell']
     env_vars_str = ' '.join('{0}={1}'.format(key, value)
                                        for key, value in env_vars.items())
-    env['shell'] = '{0} {1}'.format(env_vars_str, orig_shell)
-    yield
-    env['shell'] = orig_shell
+    with settings(shell='{0} {1}'.format(env_vars_str, env['shell'])):
+        yield
+
+
+@contextlib.contextmanager
+def isolated_env(**overrides):
+    '''
+    Give the current thread its own view of fabric's env for the duration of
+    the block, with `overrides` applied.  Changes made to env within the
+    block, by this code or by context managers like settings() and cd(), are
+    only seen by this thread, and are discarded on exit, so several threads
+    can each work against a different host at once:
+
+    def deploy(box):
+        with isolated_env(), box.connect():
+            sudo('apt-get install -y nginx')
+
+    Threads started within the block see the shared env, not this view.  The
+    first call makes env support per-thread views (see basebox.monkey).
+    '''
+    monkey.isolate_env()
+    env._push_overlay()
+    try:
+        env.update(overrides)
+        yield
+    finally:
+        env._pop_overlay()
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False, blocking=True):
+    '''
+    Hold an flock on `path`, creating the file if needed, for the duration
+    of the block.  The lock is exclusive unless `shared` is given.  Yields
+    whether the lock was taken, which without `blocking` it may not be.
+    '''
+    with open(path, 'a') as lock:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(lock, flags if blocking else flags | fcntl.LOCK_NB)
+        except IOError:
+            if blocking:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
 def default_to_local(f):
@@ -1,29 +1,426 @@
 import contextlib
-import copy
 import json
+import multiprocessing
 import os
 import re
+import shutil
+import StringIO
+import sys
 import tempfile
+import threading
+import time
+import traceback
 import types
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
 
 from fabric.api import *
 from fabric.colors import *
-from cuisine import run, file_exists, is_local, mode_remote, mode_local
-from .util import shell_env
+from cuisine import file_exists, is_local, mode_remote, mode_local
+from .package import BOX_VAGRANTFILE, write_box
+from .parallel import parallel_map
+from .profile import phased
+from .state import ContextState
+from .util import file_lock, isolated_env, run, shell_env, sudo
+
+
+def vagrant_home():
+    return os.environ.get('VAGRANT_HOME') or os.path.expanduser('~/.vagrant.d')
 
 
 def installed_boxes():
+    return _box_registry.boxes()
+
+
+def add_box(name, source):
+    '''Install a box with `vagrant box add`, keeping the box registry current.'''
+    result = run('vagrant box add %s %s' % (name, source))
+    _box_registry.update(added=name)
+    return result
+
+
+def remove_box(name):
+    '''Remove a box with `vagrant box remove`, keeping the box registry current.'''
+    result = run('vagrant box remove %s' % name)
+    _box_registry.update(removed=name)
+    return result
+
+
+def replace_box(name, source):
+    '''Install a box with add_box(), removing any existing box of that name.'''
+    if name in installed_boxes():
+        print red('Removing existing box: %s' % name)
+        remove_box(name)
+    print green('Installing box: %s' % name)
+    return add_box(name, source)
+
+
+def vagrant_version():
+    '''
+    Return the version of vagrant installed on the local machine, as a tuple
+    of ints, or () if it can't be told.
+    '''
+    global _vagrant_version
+    if _vagrant_version is None:
+        with settings(hide('running', 'stdout'), mode_local()):
+            match = re.search(r'(\d+(?:\.\d+)+)', run('vagrant --version'))
+        _vagrant_version = (tuple(int(part) for part in
+                                  match.group(1).split('.')) if match else ())
+    return _vagrant_version
+
+
+def direct_box_installs():
+    '''
+    Whether boxes can be installed with install_box_dir(), which needs the
+    box layout of vagrant 1.0 on the local machine.
+    '''
+    return is_local() and vagrant_version()[:2] == (1, 0)
+
+
+def box_staging_dir():
+    '''
+    Create a directory to unpack a box into for install_box_dir(), on the
+    same filesystem as the installed boxes.
+    '''
+    boxes_dir = os.path.join(vagrant_home(), 'boxes')
+    _makedirs(boxes_dir)
+    return tempfile.mkdtemp(prefix='.basebox-install-', dir=boxes_dir)
+
+
+def install_box_dir(name, directory):
+    '''
+    Install the unpacked box in `directory` (see box_staging_dir()) as `name`,
+    replacing any existing box of that name, by moving it into vagrant's box
+    directory.  This skips the copying and unpacking that `vagrant box add`
+    does, but only works locally, and with vagrant 1.0's box layout (see
+    direct_box_installs()).
+    '''
+    if not direct_box_installs():
+        raise ValueError('Boxes can only be installed directly with vagrant '
+                         '1.0 on the local machine')
+    boxes_dir = os.path.join(vagrant_home(), 'boxes')
+    box_dir = os.path.join(boxes_dir, name.replace('/', '-VAGRANTSLASH-'))
+
+    old = None
+    if os.path.exists(box_dir):
+        print red('Replacing existing box: %s' % name)
+        old = tempfile.mkdtemp(prefix='.basebox-old-', dir=boxes_dir)
+        os.rename(box_dir, os.path.join(old, 'box'))
+    shutil.move(directory, box_dir)
+    if old:
+        shutil.rmtree(old)
+    _box_registry.update(added=name)
+
+
+def ssh_config_entry(ssh_settings):
+    '''
+    Convert `ssh_settings`, a map of lowercased ssh_config options including
+    'host', to an entry for the SSHConfig fabric uses.  The ssh library keeps
+    entries as flat maps, but newer versions of paramiko keep the host
+    patterns and options apart, with identity files in a list.
+    '''
+    from fabric.network import ssh
+    sample = ssh.SSHConfig()
+    sample.parse(StringIO.StringIO('Host sample\n'))
+    if 'config' not in sample._config[-1]:
+        return ssh_settings
+
+    options = dict(ssh_settings)
+    host = options.pop('host')
+    if 'identityfile' in options:
+        options['identityfile'] = [options['identityfile']]
+    return {'host': [host], 'config': options}
+
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+class _BoxRegistry(object):
+    '''
+    In-process registry of installed vagrant boxes, so that repeated lookups
+    don't each pay for a `vagrant box list`.
+
+    Boxes are tracked per host (vagrant may be running remotely).  Locally,
+    the registry is filled by scanning $VAGRANT_HOME/boxes directly and is
+    refreshed whenever that directory's mtime changes, which picks up boxes
+    added or removed outside of basebox.  Remotely, it's filled by a single
+    `vagrant box list` and only changes through add_box()/remove_box().
+    '''
+    def __init__(self):
+        self._boxes = {}
+
+    def boxes(self):
+        key = self._host_key()
+        mtime = self._mtime() if key is None else None
+        cached = self._boxes.get(key)
+        if cached is None or (mtime is not None and cached[0] != mtime):
+            self._boxes[key] = (mtime, self._load(local=key is None))
+        return sorted(self._boxes[key][1])
+
+    def update(self, added=None, removed=None):
+        key = self._host_key()
+        if key not in self._boxes:
+            return
+        boxes = set(self._boxes[key][1])
+        if added:
+            boxes.add(added)
+        if removed:
+            boxes.discard(removed)
+        mtime = self._mtime() if key is None else None
+        self._boxes[key] = (mtime, boxes)
+
+    def invalidate(self):
+        self._boxes.clear()
+
+    def _host_key(self):
+        return None if is_local() else env.host_string
+
+    def _mtime(self):
+        try:
+            return os.stat(os.path.join(vagrant_home(), 'boxes')).st_mtime
+        except OSError:
+            return None
+
+    def _load(self, local=True):
+        boxes_dir = os.path.join(vagrant_home(), 'boxes')
+        if local:
+            if not os.path.isdir(boxes_dir):
+                return set()  # nothing has been installed yet
+
+            # Newer vagrant versions escape slashes in box names
+            return set(name.replace('-VAGRANTSLASH-', '/')
+                       for name in os.listdir(boxes_dir)
+                       if os.path.isdir(os.path.join(boxes_dir, name)) and
+                       not name.startswith('.'))  # skip staging directories
+
+        # Match lines like 'box-name (virtualbox)' with the parenthetical box
+        # type being optional (added in vagrant 1.1 dev version)
+        line_pattern = re.compile('^(?P<name>[^\s]+)(?:\s+\((?P<type>.*)\))?$')
+        matches = [re.match(line_pattern, line)
+                   for line in run('vagrant box list').splitlines()]
+        return set(m.group('name') for m in matches if m)
+
+
+_box_registry = _BoxRegistry()
+
+
+class _ConnectionPool(object):
+    '''
+    In-process pool of SSH connections to VMs, so that connect() blocks reuse
+    an open connection rather than each paying for a new handshake.
+
+    The connections themselves stay in fabric's cache (fabric.state.connections),
+    keyed by the user, host and port that the VM's SSH settings resolve to
+    (typically a port forwarded on 127.0.0.1, which another VM may get once
+    this one is gone).  The pool remembers the VM and SSH settings, including
+    the VM's UUID, that each one was opened for, and closes it before it could
+    be reused stale:
+
+     - when the VM is halted, destroyed, reloaded, etc. through its context
+       (see VagrantContext._invalidating()),
+     - when the VM's SSH settings have changed,
+     - when its transport is no longer active, or
+     - once nobody has used it for `max_idle` seconds, which can be set with
+       $BASEBOX_CONNECTION_IDLE.
+    '''
+    default_max_idle = 5 * 60
+
+    def __init__(self, max_idle=None):
+        if max_idle is None:
+            max_idle = float(os.environ.get('BASEBOX_CONNECTION_IDLE',
+                                            self.default_max_idle))
+        self.max_idle = max_idle
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def checkout(self, host_string, directory, vm, ssh_settings):
+        '''
+        Note that `host_string` is about to be used for `vm` in `directory`,
+        dropping its cached connection if that can't be reused.
+        '''
+        fingerprint = json.dumps(ssh_settings, sort_keys=True)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(host_string)
+            if entry and (entry['fingerprint'] != fingerprint or
+                          not self._alive(host_string)):
+                self._drop(host_string)
+                entry = None
+            if entry is None:
+                entry = self._entries[host_string] = {
+                    'directory': directory,
+                    'vm': vm or 'default',
+                    'fingerprint': fingerprint,
+                    'users': 0
+                    }
+            entry['users'] += 1
+            entry['last_used'] = time.time()
+
+    def checkin(self, host_string):
+        '''Note that a user of `host_string` is done with it'''
+        with self._lock:
+            entry = self._entries.get(host_string)
+            if entry:
+                entry['users'] -= 1
+                entry['last_used'] = time.time()
+
+    def invalidate(self, directory, vm=None):
+        '''Close the connections to `vm` (or all VMs) in `directory`'''
+        with self._lock:
+            for host_string, entry in self._entries.items():
+                if (entry['directory'] == directory and
+                        (vm is None or entry['vm'] == vm)):
+                    self._drop(host_string)
+
+    def clear(self):
+        with self._lock:
+            for host_string in self._entries.keys():
+                self._drop(host_string)
+
+    def _expire(self):
+        cutoff = time.time() - self.max_idle
+        for host_string, entry in self._entries.items():
+            if not entry['users'] and entry['last_used'] < cutoff:
+                self._drop(host_string)
+
+    def _alive(self, host_string):
+        from fabric.state import connections
+        # dict.get() rather than [] so that nothing is connected here
+        client = dict.get(connections, host_string)
+        if client is None:
+            return True  # nothing to go stale; fabric connects on first use
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _drop(self, host_string):
+        from fabric.state import connections
+        self._entries.pop(host_string, None)
+        client = dict.pop(connections, host_string, None)
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass  # it's being discarded either way
+
+
+_connection_pool = _ConnectionPool()
+
+
+# Whether `vagrant status --machine-readable` works (vagrant 1.2 and later),
+# once it's been tried
+_machine_readable_status = None
+
+# The local vagrant's version (see vagrant_version()), once it's been asked
+_vagrant_version = None
+
 
-    # Match lines like 'box-name (virtualbox)' with the parenthetical box type
-    # being optional (added in vagrant 1.1 dev version)
-    line_pattern = re.compile('^(?P<name>[^\s]+)(?:\s+\((?P<type>.*)\))?$')
-    return [re.match(line_pattern, line).group('name')
-            for line in run('vagrant box list').splitlines()]
+# Fields gathered by VagrantContext.info() and info_many()
+INFO_FIELDS = ('ssh_config', 'status', 'home', 'uuid', 'ip', 'vm')
+
+
+def info_many(targets, fields=None, parallel=None):
+    '''
+    Collect info() for many VMs at once.  `targets` may contain
+    VagrantContexts or directories (meaning every VM they define) and
+    VagrantBoxes.  `fields` selects which of INFO_FIELDS to gather.
+
+    Status is read with one status() call per context, and the remaining
+    probes for every VM run concurrently, at most `parallel` at a time (the
+    number of CPUs by default; see basebox.parallel).  Unlike info(), VMs
+    are never created or booted: the SSH config and IP of a VM that isn't
+    running are reported as None.
+
+    Returns a dict keyed by (directory, vm name).  Each value is an info()
+    style dict plus an 'errors' dict holding a traceback for every field
+    that couldn't be gathered.
+    '''
+    fields = fields or INFO_FIELDS
+    for field in fields:
+        if field not in INFO_FIELDS:
+            raise ValueError('Unknown info field: %s' % field)
+
+    # Resolve targets to (context, vm name) pairs
+    boxes = []
+    for target in targets:
+        if isinstance(target, VagrantBox):
+            boxes.append((target.context, target.box_name or 'default'))
+        else:
+            if not isinstance(target, VagrantContext):
+                target = VagrantContext(target)
+            boxes.extend((target, name) for name in target.list_boxes())
+
+    # Cheap fields come from one status call per context and the state files
+    statuses = {}
+    for ctx, name in boxes:
+        if ctx not in statuses:
+            statuses[ctx] = ctx.status()
+
+    results = {}
+    probes = []
+    for ctx, name in boxes:
+        vm = None if name == 'default' else name
+        status = statuses[ctx].get(name)
+        info = results[(ctx.directory, name)] = {'errors': {}}
+        if 'status' in fields:
+            info['status'] = status
+        if 'home' in fields:
+            info['home'] = ctx.directory
+        if 'uuid' in fields or 'vm' in fields:
+            try:
+                uuid = ctx._machine_id(vm=vm)
+            except Exception:  # e.g. an unreadable .vagrant file
+                uuid = None
+                info['errors']['uuid'] = traceback.format_exc()
+        if 'uuid' in fields:
+            info['uuid'] = uuid
+
+        running = (status or '').startswith('running')
+        if 'ssh_config' in fields and running:
+            probes.append((ctx, vm, name, 'ssh_config'))
+        if 'ip' in fields:
+            if running:
+                probes.append((ctx, vm, name, 'ip'))
+            else:
+                info['ip'] = None
+        if 'vm' in fields:
+            if uuid:
+                probes.append((ctx, vm, name, 'vm'))
+            else:
+                info['vm'] = None
+
+    # Fan out the probes that need vagrant, VBoxManage, or SSH
+    def probe(task):
+        ctx, vm, name, field = task
+        return ctx._info_probe(field, vm=vm)
+
+    for (ctx, vm, name, field), value, error in parallel_map(
+            probe, probes, pool_size=parallel or multiprocessing.cpu_count()):
+        info = results[(ctx.directory, name)]
+        if error:
+            info['errors'][field] = error
+        elif field == 'ssh_config':
+            info.update(value)
+        else:
+            info[field] = value
+
+    return results
 
 
 class VagrantContext(object):
-    _uuid = {}
-    _ip = {}
+
+    # Maximum age, in seconds, of cached values that can change outside of
+    # basebox's control (e.g. a VM crashing or being halted by hand)
+    state_ttl = {
+        'status': 10,
+        'vminfo': 10
+        }
+
+    # Cached values that only hold until the VM is next booted, which can
+    # happen outside of basebox's control without the .vagrant file changing
+    # (e.g. vagrant 1.0 moving the forwarded SSH port).  See _check_boot().
+    boot_keys = ('ssh_config', 'ip:')
 
     def __init__(self, directory=None):
         self.directory = os.path.abspath(directory or run('pwd'))
@@ -31,6 +428,13 @@ class VagrantContext(object):
         self.execmode = mode_local if is_local() else mode_remote
         self.loglevel = 'ERROR'
 
+        # State is cached next to the .vagrant file, which is only reachable
+        # when the context is on this machine.
+        self.state = ContextState(self.directory, enabled=is_local())
+
+    def cached(self, vm, key):
+        return self.state.get(vm, key, max_age=self.state_ttl.get(key))
+
     @contextlib.contextmanager
     def execution_context(self, loglevel=None):
         loglevel = loglevel or self.loglevel
@@ -43,51 +447,133 @@ class VagrantContext(object):
         Determine the underlying VM's UUID, which is useful for purposes like
         performing low-level control tasks via VBoxManage.
         '''
-        if not self._uuid.get(vm):
+        uuid = self._machine_id(vm=vm)
+        if not uuid:
+            self.up(vm=vm)
+            uuid = self._machine_id(vm=vm)
+        return uuid
+
+    def _machine_id(self, vm=None):
+        '''
+        Look up the VM's UUID from the cache or the .vagrant file, without
+        creating the VM if it doesn't exist yet.
+        '''
+        uuid = self.cached(vm, 'uuid')
+        if not uuid:
             runfile = os.path.join(self.directory, '.vagrant')
             if not file_exists(runfile):
-                self.up(vm=vm)
+                return None
 
             runinfo = json.load(open(runfile, 'r'))
-            self._uuid[vm] = runinfo['active'].get(vm or 'default')
-
-        return self._uuid.get(vm)
-
-    def ip(self, vm=None, iface=None):
-        if not self._ip.get((vm, iface)):
-            with self.connect(vm=vm):
-
-                def get_ip(ifc):
-                    output = run('ifconfig %s' % ifc)
-                    m = re.search('inet addr:(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})',
-                                  output)
-                    return m.group(1)
-
-                # Pick up the first interface if none is specified
-                ip = None
-                if iface:
-                    ip = get_ip(iface)
-                else:
-                    for iface in run('ifconfig -s | cut -d" " -f 1 -').splitlines()[1:]:
-                        _ip = get_ip(iface)
-                        if _ip not in ['10.0.2.15', '127.0.0.1']:
-                            ip = _ip
-                            break
-
-                self._ip[(vm, iface)] = ip
-        return self._ip.get((vm, iface))
-
-    def info(self, vm=None):
-        info = self.ssh_config(vm=vm)
-        info['status'] = self.status(vm=vm)
-        info['home'] = self.directory
-        info['uuid'] = self.uuid(vm=vm)
-        info['ip'] = self.ip(vm=vm)
-        info['vm'] = self.vminfo(vm=vm)
+            uuid = runinfo['active'].get(vm or 'default')
+            if uuid:
+                self.state.set(vm, 'uuid', uuid)
+
+        return uuid
+
+    def is_running(self, vm=None):
+        '''
+        Check whether the VM is running by asking VirtualBox directly, which
+        is much cheaper than a round trip through `vagrant status`.
+        '''
+        return self._booted(vm=vm) is not None
+
+    def _booted(self, vm=None):
+        '''
+        Return when the VM was booted, as VirtualBox reports it, or None if
+        it isn't running.
+        '''
+        uuid = self._machine_id(vm=vm)
+        if not uuid:
+            return None
+
+        with self.execution_context(), settings(warn_only=True):
+            result = run('VBoxManage list -l runningvms')
+        if result.failed:
+            return None
+        running = parse_vbox_vms(result).get(uuid)
+        return (running['since'] or '') if running else None
+
+    def _check_boot(self, vm=None, booted=None):
+        '''
+        Drop the VM's cached values in `boot_keys` if it has been booted
+        since they were cached.  `booted` is as returned by _booted().
+        '''
+        if self.cached(vm, 'booted') != booted:
+            self.state.forget(vm, self.boot_keys)
+            self.state.set(vm, 'booted', booted)
+
+    def ip(self, vm=None, iface=None, method='ssh'):
+        '''
+        Determine the VM's IP address on `iface`, or the first address that
+        isn't on the loopback or NAT interfaces if no interface is given.
+
+        All of the guest's addresses are discovered at once and cached per
+        interface.  With method='ssh' (the default) they're dumped by a single
+        remote command; with method='guestproperty' they're read from the
+        VirtualBox guest additions without connecting to the VM at all.
+        '''
+        key = 'ip:%s' % (iface or '')
+        ip = self.cached(vm, key)
+        if not ip:
+            if method == 'ssh':
+                with self.connect(vm=vm):
+                    output = run('ip -o -4 addr show 2>/dev/null || '
+                                 '/sbin/ifconfig -a')
+                addresses = _parse_addresses(output)
+            elif method == 'guestproperty':
+                with self.execution_context():
+                    output = run('VBoxManage guestproperty enumerate %s '
+                                 '--patterns "/VirtualBox/GuestInfo/Net/*"' %
+                                 self.uuid(vm=vm))
+                addresses = _parse_guest_addresses(output)
+            else:
+                raise ValueError('Unknown IP discovery method: %s' % method)
+
+            # Cache every interface's address, keeping the first address
+            # found on each interface.
+            public = [addr for ifc, addr in addresses
+                      if addr not in ['10.0.2.15', '127.0.0.1']]
+            found = dict(('ip:%s' % ifc, addr)
+                         for ifc, addr in reversed(addresses))
+            if public:
+                found['ip:'] = public[0]
+            self.state.set_many(vm, found)
+
+            ip = found.get(key)
+        return ip
+
+    def info(self, vm=None, fields=None):
+        '''
+        Collect information about a VM.  `fields` selects which of INFO_FIELDS
+        to gather (all of them by default).  SSH config entries are merged
+        into the top level of the result, the rest are stored under their
+        field names.
+        '''
+        fields = fields or INFO_FIELDS
+        info = self.ssh_config(vm=vm) if 'ssh_config' in fields else {}
+        for field in fields:
+            if field != 'ssh_config':
+                info[field] = self._info_probe(field, vm=vm)
         return info
 
+    def _info_probe(self, field, vm=None):
+        probes = {
+            'ssh_config': self.ssh_config,
+            'status': self.status,
+            'home': lambda vm=None: self.directory,
+            'uuid': self.uuid,
+            'ip': self.ip,
+            'vm': self.vminfo
+            }
+        if field not in probes:
+            raise ValueError('Unknown info field: %s' % field)
+        return probes[field](vm=vm)
+
     def list_boxes(self):
-        return self.status().keys()
+        # The Vagrantfile can only be read here for contexts on this machine
+        return ((self.state.enabled and self.defined_vms()) or
+                self.status().keys())
 
     def __getitem__(self, idx):
         '''Use [] lookup to retrieve individual boxes by name.'''
@@ -95,22 +581,27 @@ class VagrantContext(object):
             return VagrantBox(self, box_name=idx)
         raise KeyError(idx)
 
+    @phased('up')
     def up(self, *args, **kwargs):
         result = self._up('vagrant up', *args, **kwargs)
-        self.uuid(vm=kwargs.get('vm'))  # cache UUID
+        self._machine_id(vm=kwargs.get('vm'))  # cache UUID
         return result
 
+    @phased('reload')
     def reload(self, *args, **kwargs):
         return self._up('vagrant reload', *args, **kwargs)
 
+    @phased('halt')
     def halt(self, *args, **kwargs):
         return self._down('vagrant halt', *args, **kwargs)
 
+    @phased('destroy')
     def destroy(self, *args, **kwargs):
         return self._down('vagrant destroy', *args, **kwargs)
 
     def _up(self, cmd, vm=None, provision=False, provision_with=None):
-        with self.execution_context():
+        with self.execution_context(), self._runfile_lock(), \
+                self._invalidating(vm=vm):
             if vm:
                 cmd += ' ' + vm
             cmd += ' --%sprovision' % ('' if provision else 'no-',)
@@ -126,7 +617,13 @@ class VagrantContext(object):
                 return result
 
     def _down(self, cmd, vm=None, force=False):
-        with self.execution_context(), settings(warn_only=True):
+        destroy = cmd == 'vagrant destroy'
+        keep = () if destroy else ('uuid',)
+        with self.execution_context(), settings(warn_only=True), \
+                self._runfile_lock(needed=destroy), \
+                self._invalidating(vm=vm, keep=keep):
+            if vm:
+                cmd += ' ' + vm
             if force:
                 cmd += ' --force'
             result = run(cmd)
@@ -135,7 +632,42 @@ class VagrantContext(object):
             else:
                 return result
 
+    @contextlib.contextmanager
+    def _runfile_lock(self, needed=True):
+        '''
+        Hold an exclusive lock while vagrant may rewrite the .vagrant file.
+        Vagrant 1.0 keeps every VM's UUID in that one file and rewrites it
+        whole, so concurrent `vagrant up`s or `vagrant destroy`s in the same
+        directory, from threads or processes, lose each other's VMs.  Later
+        versions keep a directory per VM there, which needs no lock, and
+        remote contexts can't be locked from here.
+        '''
+        runfile = os.path.join(self.directory, '.vagrant')
+        if not (needed and self.state.enabled) or os.path.isdir(runfile):
+            yield
+            return
+
+        with file_lock(runfile + '.lock'):
+            yield
+
+    @contextlib.contextmanager
+    def _invalidating(self, vm=None, keep=('uuid',)):
+        '''
+        Drop cached state for `vm` (or all VMs) around an operation that
+        changes it, whether or not the operation succeeds.
+        '''
+        try:
+            yield
+        finally:
+            self.state.invalidate(vm=vm, keep=keep)
+            _connection_pool.invalidate(self.directory, vm=vm)
+
+    @phased('ssh config')
     def ssh_config(self, vm=None, host=None):
+        cached = self.cached(vm, 'ssh_config')
+        if cached:
+            return dict(cached)
+
         with self.execution_context():
             # load info about the box to use as its context var
             with settings(warn_only=True):
@@ -144,109 +676,408 @@ class VagrantContext(object):
                     modes = run('ls -la /usr/local/jenkins/jobs/build-vagrant-boxes/workspace/credentials/fabric_rsa')
                     abort(modes + self.read_vagrantfile() + output.stdout + output.stderr)
 
-            ssh_info = output.splitlines()[1:]
-            ssh_info = dict([l.strip().split(' ', 1)
-                             for l in ssh_info if l.strip()])
-            return {k.lower(): v for k, v in ssh_info.items()}
+            ssh_info = parse_ssh_config(output)
+            if self.cached(vm, 'booted') is None:
+                self._check_boot(vm=vm, booted=self._booted(vm=vm))
+            self.state.set(vm, 'ssh_config', ssh_info)
+            return dict(ssh_info)
 
+    @phased('package')
     def package(self, vm=None, base=None, output=None, include=None,
-                vagrantfile=None, install_as=None):
+                vagrantfile=None, install_as=None, compression=None,
+                zerofill=False, native=False):
+        '''
+        Package the VM as a box file, `output` (package.box in the context's
+        directory by default), and install it as `install_as` if given.
+
+        With `native`, the VM is exported with VBoxManage and archived by
+        basebox itself (see basebox.package) instead of with `vagrant
+        package`, which is much faster for large disks and supports
+        `compression` ('none' or 'gzip', which is done on several threads).
+        If `install_as` is given and vagrant 1.0 is installed, the exported
+        files are moved straight into vagrant's box directory instead of being
+        archived and unpacked again by `vagrant box add` (see
+        install_box_dir()), and no package file is written unless `output` is
+        given.  Native packaging only works locally, and not with `base`.
+
+        `zerofill` fills the free space on the VM's disk with zeros before
+        packaging, so that the exported disk image, which skips zeroed
+        blocks, is no bigger than the data on it.
+        '''
+        if native and (base or not is_local()):
+            raise ValueError('Native packaging only works locally, for the '
+                             "context's own VMs")
+        if not native and compression not in (None, 'none'):
+            raise ValueError('Compression requires native packaging')
+
         with self.execution_context():
-            cmd = 'vagrant package %s' % (vm or '',)
-            tmpfile = None
-            try:
-                if base:
-                    cmd += ' --base %s' % base
-                if output:
-                    cmd += ' --output %s' % output
-                if include:
-                    cmd += ' --include %s' % ','.join("%s" % i for i in include),
-                if vagrantfile:
-                    if type(getattr(vagrantfile, 'read', None)) == types.FunctionType:
-                        # If  the specified vagrantfile appears to be a
-                        # readable filelike, write it to a temp file and
-                        # add to the command.
+            if zerofill:
+                with self.connect(vm=vm):
+                    with settings(warn_only=True):  # dd stops at a full disk
+                        sudo('dd if=/dev/zero of=/EMPTY bs=1M')
+                    sudo('rm -f /EMPTY')
+
+            if native:
+                self._package_native(vm=vm, output=output, include=include,
+                                     vagrantfile=vagrantfile,
+                                     compression=compression or 'none',
+                                     install_as=install_as)
+                return
+
+            self._package_vagrant(vm=vm, base=base, output=output,
+                                  include=include, vagrantfile=vagrantfile)
+
+            # Install locally if a target is specified, overwriting any
+            # existing box with the target name
+            if install_as:
+                package_file = output or 'package.box'
+                replace_box(install_as,
+                            os.path.join(self.directory, package_file))
+
+    def _package_native(self, vm=None, output=None, include=None,
+                        vagrantfile=None, compression='none', install_as=None):
+        self.halt(vm=vm)
+        mac = self.vminfo(vm=vm).get('macaddress1')
+
+        # When installing directly, export into a staging directory beside
+        # the boxes, so installing is just a rename.
+        direct = install_as and direct_box_installs()
+        if direct:
+            export_dir = box_staging_dir()
+        else:
+            export_dir = tempfile.mkdtemp(prefix='.export-', dir=self.directory)
+            output = output or 'package.box'
+
+        try:
+            run('VBoxManage export %s --output %s' %
+                (self.uuid(vm=vm), os.path.join(export_dir, 'box.ovf')))
+
+            files = [(name, os.path.join(export_dir, name))
+                     for name in sorted(os.listdir(export_dir))]
+            files += [('include/%s' % os.path.basename(path),
+                       os.path.join(self.directory, path))
+                      for path in include or []]
+            contents = [('Vagrantfile', BOX_VAGRANTFILE % {'mac': mac})]
+            if vagrantfile:
+                if hasattr(vagrantfile, 'read'):
+                    vagrantfile = vagrantfile.read()
+                elif 'Vagrant::Config' not in vagrantfile:
+                    vagrantfile = open(vagrantfile).read()  # a filename
+                contents.append(('include/_Vagrantfile', vagrantfile))
+
+            if output:
+                print green('Writing box: %s' % output)
+                write_box(os.path.join(self.directory, output),
+                          files=files, contents=contents,
+                          compression=compression)
+
+            if install_as and not direct:
+                replace_box(install_as, os.path.join(self.directory, output))
+            elif install_as:
+                for arcname, path in files:
+                    target = os.path.join(export_dir, arcname)
+                    if path != target:
+                        _makedirs(os.path.dirname(target))
+                        shutil.copyfile(path, target)
+                for arcname, data in contents:
+                    target = os.path.join(export_dir, arcname)
+                    _makedirs(os.path.dirname(target))
+                    open(target, 'w').write(data)
+
+                print green('Installing box: %s' % install_as)
+                install_box_dir(install_as, export_dir)
+        finally:
+            if os.path.exists(export_dir):
+                shutil.rmtree(export_dir)
+
+    def _package_vagrant(self, vm=None, base=None, output=None, include=None,
+                         vagrantfile=None):
+        cmd = 'vagrant package %s' % (vm or '',)
+        tmpfile = None
+        try:
+            if base:
+                cmd += ' --base %s' % base
+            if output:
+                cmd += ' --output %s' % output
+            if include:
+                cmd += ' --include %s' % ','.join("%s" % i for i in include),
+            if vagrantfile:
+                if type(getattr(vagrantfile, 'read', None)) == types.FunctionType:
+                    # If  the specified vagrantfile appears to be a
+                    # readable filelike, write it to a temp file and
+                    # add to the command.
+                    fd, tmpfile = tempfile.mkstemp()
+                    os.fdopen(fd, 'w').write(vagrantfile.read())
+                    cmd += ' --vagrantfile %s' % tmpfile
+                elif type(vagrantfile) in types.StringTypes:
+                    if 'Vagrant::Config' in vagrantfile:
+                        # If this appears to be the string representation
+                        # of a Vagrantfile, write it to a temp file and
+                        # add it to the command.
                         fd, tmpfile = tempfile.mkstemp()
-                        os.fdopen(fd, 'w').write(vagrantfile.read())
+                        os.fdopen(fd, 'w').write(vagrantfile)
                         cmd += ' --vagrantfile %s' % tmpfile
-                    elif type(vagrantfile) in types.StringTypes:
-                        if 'Vagrant::Config' in vagrantfile:
-                            # If this appears to be the string representation
-                            # of a Vagrantfile, write it to a temp file and
-                            # add it to the command.
-                            fd, tmpfile = tempfile.mkstemp()
-                            os.fdopen(fd, 'w').write(vagrantfile)
-                            cmd += ' --vagrantfile %s' % tmpfile
-                        else:
-                            # Otherwise, treat it as a filename
-                            cmd += ' --vagrantfile %s' % vagrantfile
-
-                run(cmd)
-
-                # Install locally if a target is specified
-                if install_as:
-                    package_file = output or 'package.box'
-
-                    # Overwrite any existing box with the target name
-                    if install_as in installed_boxes():
-                        print red('Removing existing box: %s' % install_as)
-                        run('vagrant box remove %s' % install_as)
-
-                    print green('Installing box: %s' % install_as)
-                    run('vagrant box add %s %s' %
-                        (install_as, os.path.join(self.directory, package_file)))
+                    else:
+                        # Otherwise, treat it as a filename
+                        cmd += ' --vagrantfile %s' % vagrantfile
 
-            finally:
-                if tmpfile:
-                    os.unlink(tmpfile)
+            run(cmd)
+        finally:
+            if tmpfile:
+                os.unlink(tmpfile)
 
+    @phased('resume')
     def resume(self, vm=None):
-        with self.execution_context():
+        with self.execution_context(), self._invalidating(vm=vm):
             return run('vagrant resume %s' % (vm or '',))
 
+    @phased('suspend')
     def suspend(self, vm=None):
-        with self.execution_context():
+        with self.execution_context(), self._invalidating(vm=vm):
             return run('vagrant suspend %s' % (vm or '',))
 
+    @phased('status')
     def status(self, vm=None):
-        with self.execution_context():
-            lines = run('vagrant status %s' % (vm or '',)).splitlines()
-
-            # The output has some presentation text around the states we're
-            # interested in, so we have to extract the appropriate lines.
-            start, end = [idx for idx, x in enumerate(lines) if x == ''][:2]
-            status_parts = [re.split('\s+', line)
-                            for line in lines[start + 1:end]]
-            status_map = {x[0]: ' '.join(x[1:]) for x in status_parts}
+        '''
+        Return the state of `vm` as vagrant reports it (e.g. 'running',
+        'poweroff' or 'not created'), or a map of every VM's name to its
+        state.
+
+        Rather than paying for `vagrant status`, the states of all the
+        context's VMs are worked out at once from the Vagrantfile, the
+        .vagrant file and a single `VBoxManage list -l vms`.  Vagrant is
+        only asked when that isn't possible, e.g. for remote contexts or
+        Vagrantfiles that define their VMs in a loop.
+        '''
+        status_map = self.cached(ContextState.ALL, 'status')
+        if status_map and (not vm or vm in status_map):
             return status_map.get(vm) if vm else status_map
 
+        status_map = self._native_status()
+        if status_map is not None:
+            self.state.set(ContextState.ALL, 'status', status_map)
+        else:
+            status_map = self._vagrant_status(vm=vm)
+            if not vm:
+                self.state.set(ContextState.ALL, 'status', status_map)
+        return status_map.get(vm) if vm else status_map
+
+    def defined_vms(self):
+        '''
+        Return the names of the VMs defined in the Vagrantfile, in order, or
+        None if they can't be read from it reliably (e.g. they're defined in
+        a loop) and vagrant has to be asked instead.
+        '''
+        try:
+            vagrantfile = self.read_vagrantfile()
+        except IOError:
+            return None
+
+        names = []
+        for line in vagrantfile.splitlines():
+            if line.strip().startswith('#'):
+                continue
+            for definition in re.findall(r'\.vm\.define\b(.*)', line):
+                m = re.match(r'\s*\(?\s*(?::(\w+)|"(\w+)"|\'(\w+)\')\s*'
+                             r'(?:[,)]|do\b|\{|$)', definition)
+                if not m:
+                    return None
+                names.append(m.group(1) or m.group(2) or m.group(3))
+        return names or ['default']
+
+    def _native_status(self):
+        '''
+        Work out every VM's status without vagrant (see status()), or return
+        None if that isn't possible.
+        '''
+        if not self.state.enabled:
+            return None
+        names = self.defined_vms()
+        machines = read_runfile(os.path.join(self.directory, '.vagrant'))
+        if names is None or machines is None or set(machines) - set(names):
+            return None
+
+        status_map = dict.fromkeys(names, 'not created')
+        if machines:
+            with self.execution_context(), settings(warn_only=True):
+                result = run('VBoxManage list -l vms')
+            if result.failed:
+                return None
+            vms = parse_vbox_vms(result)
+            for name, uuid in machines.items():
+                if uuid in vms:
+                    status_map[name] = vms[uuid]['state']
+        return status_map
+
+    def _vagrant_status(self, vm=None):
+        '''
+        Ask vagrant for the status of `vm`, or of every VM, preferring its
+        machine-readable output where the installed version supports it.
+        '''
+        global _machine_readable_status
+        with self.execution_context():
+            if _machine_readable_status is not False:
+                with settings(warn_only=True):
+                    output = run('vagrant status --machine-readable %s' %
+                                 (vm or '',))
+                if output.succeeded:
+                    return (parse_machine_readable_status(output) or
+                            parse_status(output))
+                _machine_readable_status = False
+            return parse_status(run('vagrant status %s' % (vm or '',)))
+
     def connect(self, vm=None, **ssh_config_overrides):
         '''Context manager that sets the vagrant box as the current host'''
         return _VagrantConnectionManager(self, vm=vm, **ssh_config_overrides)
 
-    def _connection_settings(self, vm=None, **ssh_config_overrides):
+    def execute_all(self, func, vms=None, roles=None, parallel=None):
+        '''
+        Call `func()` while connected to each of `vms` (every VM the context
+        defines by default), or to the VMs with any of `roles` (see
+        vms_with_roles()).  The VMs are connected to from threads, at most
+        `parallel` at a time (all at once by default), each with its own view
+        of env and its own pooled connection (see connect()), so the whole
+        takes about as long as the slowest VM.  VMs that aren't running are
+        brought up first, one at a time.
+
+        Returns a dict keyed by VM name, whose values are dicts with the keys:
+
+         result  -- What func() returned, or None if it raised.
+         elapsed -- How long, in seconds, connecting and calling func() took,
+                    or bringing the VM up if that failed.
+         error   -- None on success, or a formatted traceback if bringing the
+                    VM up, connecting or func() raised (including SystemExit
+                    from fabric's abort()).  func() isn't called on VMs that
+                    failed to come up.
+        '''
+        if vms is None:
+            vms = (self.list_boxes() if roles is None else
+                   self.vms_with_roles(roles))
+        if not vms:
+            return {}
+
+        # Read every VM's state once up front, rather than from each thread,
+        # and bring up the VMs that aren't running one at a time from here, as
+        # vagrant can't safely boot several VMs of a context at once
+        status = self.status()
+        results = {}
+        for name in vms:
+            if not (status.get(name) or '').startswith('running'):
+                start = time.time()
+                try:
+                    self.up(vm=None if name == 'default' else name)
+                except (Exception, SystemExit):
+                    results[name] = {
+                        'result': None,
+                        'elapsed': time.time() - start,
+                        'error': traceback.format_exc()
+                        }
+
+        def call(name):
+            start = time.time()
+            try:
+                with self.connect(vm=None if name == 'default' else name):
+                    result, error = func(), None
+            except (Exception, SystemExit):
+                result, error = None, traceback.format_exc()
+            return name, {
+                'result': result,
+                'elapsed': time.time() - start,
+                'error': error
+                }
+
+        booted = [name for name in vms if name not in results]
+        if booted:
+            pool = ThreadPool(parallel or len(booted))
+            try:
+                results.update(pool.map(call, booted))
+            finally:
+                pool.close()
+                pool.join()
+        return results
+
+    def run_all(self, command, vms=None, roles=None, parallel=None,
+                use_sudo=False):
+        '''
+        Run `command` on many VMs at once (see execute_all() for the
+        arguments and what's returned), with sudo if `use_sudo` is set.
+        Commands run with warn_only, so each VM's result is the command's
+        output, whose `failed` and `return_code` attributes tell whether it
+        succeeded on that VM.
+        '''
+        def run_command():
+            with settings(warn_only=True):
+                return (sudo if use_sudo else run)(command)
+
+        return self.execute_all(run_command, vms=vms, roles=roles,
+                                parallel=parallel)
+
+    def vms_with_roles(self, roles, roledefs=None):
+        '''
+        Return the names of the VMs with any of `roles` (a role name or a
+        list of them) in `roledefs`, which defaults to env.roledefs.  Under
+        the basebox command, env.roledefs is filled from its hosts' roles,
+        e.g. `basebox -H web1:web web2:web db:db,cache`.
+        '''
+        if isinstance(roles, basestring):
+            roles = [roles]
+        roledefs = env.roledefs if roledefs is None else roledefs
+
+        names = []
+        for role in roles:
+            if role not in roledefs:
+                raise ValueError('Unknown role: %s' % role)
+
+            # Fabric allows roles to be defined lazily, or as dicts
+            hosts = roledefs[role]
+            if callable(hosts):
+                hosts = hosts()
+            if isinstance(hosts, dict):
+                hosts = hosts.get('hosts', [])
+
+            for host in hosts:
+                if host not in names:
+                    names.append(host)
+        return names
+
+    def _ssh_settings(self, vm=None, **ssh_config_overrides):
+        # Only pay for a `vagrant up` if the VM isn't already running; the SSH
+        # settings of a running VM come straight from the state cache, as
+        # long as it hasn't been rebooted since.
+        booted = self._booted(vm=vm)
+        if booted is None:
+            self.up(vm=vm)
+        else:
+            self._check_boot(vm=vm, booted=booted)
         host = 'vagrant-temporary-%s' % self.uuid(vm=vm)
 
         # Extract current SSH settings
-        self.up(vm=vm)
         ssh_settings = self.ssh_config(vm=vm)
         ssh_settings.update({
             'host': host,
             'stricthostkeychecking': 'no'
             })
         ssh_settings.update(ssh_config_overrides)
+        return ssh_settings
 
+    def _connection_settings(self, ssh_settings):
         # Ensure that SSH config is being picked up and update it with the
         # connection settings for the vagrant box
         with settings(use_ssh_config=True):
-            from fabric.network import ssh_config
+            from fabric.network import ssh, ssh_config
             ssh_config('test')  # ensure that ssh config is in use and cached
-            modified_config = copy.deepcopy(env._ssh_config)
-            modified_config._config.append(ssh_settings)
+
+            # Build a new config that shares the parsed entries of the
+            # original, rather than deep copying the whole thing.
+            modified_config = ssh.SSHConfig()
+            base_config = env.get('_ssh_config')
+            modified_config._config = (
+                (base_config._config if base_config else []) +
+                [ssh_config_entry(ssh_settings)])
 
         return {
             'use_ssh_config': True,
-            'host': host,
+            'host': ssh_settings['host'],
             'host_string': '%(user)s@%(host)s:%(port)s' % ssh_settings,
             '_ssh_config': modified_config,
             'cwd': '',
@@ -266,10 +1097,15 @@ class VagrantContext(object):
     # provide low-level control over virtual machines.
     # ----------------------------------------------------------------------
 
+    @phased('vminfo')
     def vminfo(self, vm=None, details=True):
         '''
         Parse showvminfo output into an attribute map.
         '''
+        infomap = self.cached(vm, 'vminfo')
+        if infomap:
+            return infomap
+
         with self.execution_context():
             result = run('VBoxManage showvminfo %s --machinereadable' %
                          self.uuid(vm=vm))
@@ -280,51 +1116,306 @@ class VagrantContext(object):
             m = pattern.match(line)
             infomap[m.group('attribute')] = m.group('quoted') or m.group('unquoted')
 
+        self.state.set(vm, 'vminfo', infomap)
         return infomap
 
+    @phased('unregister')
     def unregister(self, vm=None, delete=False):
         cmd = 'VBoxManage unregistervm %s' % self.uuid(vm=vm)
         if delete:
             cmd += ' --delete'
-        with self.execution_context():
+        with self.execution_context(), self._invalidating(vm=vm, keep=()):
             result = run(cmd)
             return result
 
+    @phased('modify')
     def modify(self, vm=None, **options):
         uuid = self.uuid(vm=vm)
         opts = ['--%s %s' % (k, v) for k, v in options.iteritems()]
-        with self.execution_context():
+        with self.execution_context(), self._invalidating(vm=vm):
             cmd = 'VBoxManage modifyvm %s %s' % (uuid, ' '.join(opts))
             run(cmd)
 
+    @phased('snapshot')
+    def snapshot(self, command, paramstring=None, vm=None):
+        '''
+        Run a `VBoxManage snapshot` subcommand (take, restore, delete, etc.)
+        against the VM.
+        '''
+        with self.execution_context(), self._invalidating(vm=vm):
+            cmd = ('VBoxManage snapshot %s %s %s' %
+                    (self.uuid(vm=vm), command, paramstring or ''))
+            return run(cmd)
+
+    def snapshots(self, vm=None):
+        '''
+        List the names of the VM's snapshots, from the root of the snapshot
+        tree down.
+        '''
+        with self.execution_context(), settings(warn_only=True):
+            result = run('VBoxManage snapshot %s list --machinereadable' %
+                         self.uuid(vm=vm))
+
+        # VBoxManage fails if there aren't any snapshots
+        if result.failed:
+            return []
+        return re.findall('^SnapshotName[-\d]*="(.*)"$', result, re.M)
+
+    @phased('link clone')
+    def link_clone(self, source, snapshot, vm=None):
+        '''
+        Create the VM as a VirtualBox linked clone of `snapshot` of the
+        `source` VM, and register it with vagrant as this context's VM.  The
+        clone shares the source's disk copy-on-write, so it's created almost
+        instantly instead of importing the box's disk; `vagrant up` then boots
+        it like any other previously created VM.  The clone keeps the source's
+        MAC addresses, which the box's network configuration expects.
+        '''
+        vm_uuid = str(uuid4())
+        name = 'basebox-%s-%s-%s' % (os.path.basename(self.directory),
+                                     vm or 'default', vm_uuid[:8])
+        with self.execution_context(), self._invalidating(vm=vm, keep=()):
+            run('VBoxManage clonevm %s --snapshot %s '
+                '--options link,keepallmacs '
+                '--name %s --uuid %s --register' %
+                (source, snapshot, name, vm_uuid))
+
+            runfile = os.path.join(self.directory, '.vagrant')
+            with self._runfile_lock():
+                runinfo = (json.load(open(runfile))
+                           if os.path.exists(runfile) else {'active': {}})
+                runinfo['active'][vm or 'default'] = vm_uuid
+                with open(runfile, 'w') as f:
+                    json.dump(runinfo, f)
+        return vm_uuid
+
+    @phased('control')
     def control(self, command, paramstring=None, vm=None):
-        with self.execution_context():
+        with self.execution_context(), self._invalidating(vm=vm):
             cmd = ('VBoxManage controlvm %s %s %s' % 
                     (self.uuid(vm=vm), command, paramstring or ''))
             run(cmd)
 
 
+def parse_status(output):
+    '''Parse `vagrant status` output into a map of VM names to states.'''
+    lines = output.splitlines()
+
+    # The output has some presentation text around the states we're
+    # interested in, so we have to extract the appropriate lines.
+    start, end = [idx for idx, x in enumerate(lines) if x == ''][:2]
+    status_parts = [re.split('\s+', line) for line in lines[start + 1:end]]
+    return {x[0]: ' '.join(x[1:]) for x in status_parts}
+
+
+def parse_machine_readable_status(output):
+    '''
+    Parse `vagrant status --machine-readable` output into a map of VM names
+    to states, named as in vagrant's human-readable output.
+    '''
+    status_map = {}
+    for line in output.splitlines():
+        fields = line.strip().split(',', 3)
+        if len(fields) == 4 and fields[1] and fields[2] == 'state':
+            status_map[fields[1]] = fields[3].replace('_', ' ')
+    return status_map
+
+
+# VirtualBox's long-form VM states, as shown by `VBoxManage list -l vms`,
+# that aren't simply the short form (as vagrant reports them) with spaces
+VBOX_STATES = {
+    'powered off': 'poweroff',
+    'stuck': 'gurumeditation'
+    }
+
+# Fields of `VBoxManage list -l vms`, and their names in `VBoxManage
+# showvminfo --machinereadable` (and so in vminfo())
+VBOX_LIST_FIELDS = {
+    'Name': 'name',
+    'Guest OS': 'ostype',
+    'UUID': 'UUID',
+    'Config file': 'CfgFile',
+    'Memory size': 'memory',
+    'Number of CPUs': 'cpus',
+    'State': 'VMState'
+    }
+
+# NIC attachment types, as shown by `VBoxManage list -l vms`, and as named by
+# `VBoxManage showvminfo --machinereadable`
+VBOX_ATTACHMENTS = {
+    'NAT': 'nat',
+    'NAT Network': 'natnetwork',
+    'Bridged Interface': 'bridged',
+    'Host-only Interface': 'hostonly',
+    'Internal Network': 'intnet',
+    'Generic Driver': 'generic'
+    }
+
+
+def parse_vbox_vms(output):
+    '''
+    Parse `VBoxManage list -l vms` output into a map of VM UUIDs to their
+    names, states, when they entered that state, and details, as in {uuid:
+    {'name': name, 'state': state, 'since': timestamp, 'vminfo': details}}.
+    States are named as vagrant reports them, e.g. 'running' or 'poweroff'.  The details are the subset of vminfo() that
+    the listing includes, under the same names: name, UUID, ostype, CfgFile,
+    memory, cpus, VMState, and nic<N> and macaddress<N> for each NIC.
+    '''
+    vms = {}
+    info = None
+    for line in output.splitlines():
+        # Only unindented lines describe the VM itself, rather than e.g. its
+        # snapshots.  Each VM starts with its name.
+        key, _, value = line.partition(':')
+        value = value.strip()
+        if key == 'Name':
+            info = {}
+        if info is None:
+            continue
+
+        nic = re.match('^NIC (\d+)$', key)
+        if key in VBOX_LIST_FIELDS and VBOX_LIST_FIELDS[key] not in info:
+            info[VBOX_LIST_FIELDS[key]] = value
+            if key == 'UUID':
+                vms[value] = info
+        elif nic and value == 'disabled':
+            info['nic%s' % nic.group(1)] = 'none'
+        elif nic:
+            settings = dict(part.split(': ', 1) for part in value.split(', ')
+                            if ': ' in part)
+            attachment = re.sub(" '.*'$", '', settings.get('Attachment', ''))
+            info['nic%s' % nic.group(1)] = VBOX_ATTACHMENTS.get(
+                attachment, attachment.lower())
+            if 'MAC' in settings:
+                info['macaddress%s' % nic.group(1)] = settings['MAC']
+
+    for uuid, info in vms.items():
+        since = None
+        if 'VMState' in info:
+            m = re.match('^(.*?)\s*(?:\(since (.*)\))?$', info['VMState'])
+            state, since = m.groups()
+            info['VMState'] = VBOX_STATES.get(state, state.replace(' ', ''))
+        if 'memory' in info:
+            info['memory'] = re.sub('\s*MB$', '', info['memory'])
+        vms[uuid] = {'name': info.get('name'), 'state': info.get('VMState'),
+                     'since': since, 'vminfo': info}
+    return vms
+
+
+def read_runfile(path):
+    '''
+    Return the map of VM names to UUIDs in a vagrant 1.0 .vagrant file (empty
+    if there isn't one), or None if it can't be read.
+    '''
+    if not os.path.exists(path):
+        return {}
+    try:
+        return json.load(open(path)).get('active', {})
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def parse_ssh_config(output):
+    '''
+    Parse `vagrant ssh-config` output into a map of lowercased option names
+    to values.
+    '''
+    ssh_info = output.splitlines()[1:]
+    ssh_info = dict([l.strip().split(' ', 1) for l in ssh_info if l.strip()])
+    return {k.lower(): v for k, v in ssh_info.items()}
+
+
+def _parse_addresses(output):
+    '''
+    Parse a list of (interface, IPv4 address) tuples from the output of either
+    `ip -o -4 addr show` or `ifconfig -a`.
+    '''
+    addresses = []
+    iface = None
+    for line in output.splitlines():
+        # ip: '2: eth0    inet 10.0.2.15/24 brd 10.0.2.255 scope global eth0'
+        m = re.match('^\d+:\s+(\S+)\s+inet\s+(\d{1,3}(?:\.\d{1,3}){3})', line)
+        if m:
+            addresses.append((m.group(1), m.group(2)))
+            continue
+
+        # ifconfig: interface blocks start with an unindented name, followed
+        # by 'inet addr:10.0.2.15' or 'inet 10.0.2.15' lines
+        if line and not line[0].isspace():
+            iface = line.split()[0].rstrip(':')
+        m = re.search('inet (?:addr:)?(\d{1,3}(?:\.\d{1,3}){3})', line)
+        if m and iface:
+            addresses.append((iface, m.group(1)))
+    return addresses
+
+
+def _parse_guest_addresses(output):
+    '''
+    Parse a list of (interface, IPv4 address) tuples from the output of
+    `VBoxManage guestproperty enumerate`.  Interfaces are named by the guest
+    additions where they report it, and 'eth<N>' otherwise.
+    '''
+    props = {}
+    for line in output.splitlines():
+        # Older releases: 'Name: <prop>, value: <value>, timestamp: ...'
+        # Newer releases: "<prop> = '<value>' @ ..."
+        m = (re.match('^Name: (\S+), value: ([^,]*),', line) or
+             re.match("^(\S+) = '([^']*)'", line))
+        if m:
+            props[m.group(1)] = m.group(2)
+
+    addresses = []
+    for idx in range(int(props.get('/VirtualBox/GuestInfo/Net/Count', 0))):
+        base = '/VirtualBox/GuestInfo/Net/%d' % idx
+        addr = props.get(base + '/V4/IP')
+        if addr:
+            addresses.append((props.get(base + '/Name') or 'eth%d' % idx, addr))
+    return addresses
+
+
 class _VagrantConnectionManager(object):
+    '''
+    Points fabric at the VM for the duration of a with block.  The connection
+    settings are applied on entry, to this thread's own view of env (see
+    isolated_env()), so threads can be connected to different VMs at once.
+    The SSH connection itself is left open for later blocks to reuse (see
+    _ConnectionPool).
+    '''
 
     def __init__(self, context, vm=None, **ssh_config_overrides):
-        overrides = context._connection_settings(vm=vm, **ssh_config_overrides)
-        self.original_settings = dict(env)
-        env.update(overrides)
-        mode_remote()
+        self.context = context
+        self.vm = vm
+        self.ssh_config_overrides = ssh_config_overrides
+        self.host_string = None
+        self.isolation = None
 
     def __enter__(self, *args, **kwargs):
-        pass
+        # Isolate first, so that asking vagrant for the settings doesn't
+        # touch the env other threads see either
+        self.isolation = isolated_env()
+        self.isolation.__enter__()
+        try:
+            ssh_settings = self.context._ssh_settings(
+                vm=self.vm, **self.ssh_config_overrides)
+            env.update(self.context._connection_settings(ssh_settings))
+        except:
+            isolation, self.isolation = self.isolation, None
+            isolation.__exit__(*sys.exc_info())
+            raise
+        mode_remote()
 
-    def __exit__(self, *args, **kwargs):
-        # Clear any cached connections - vagrant boxes are more transient
-        # than other connections, and there are cases where caching connections
-        # leads to mistakenly reusing stale connections.
-        from fabric.state import connections
-        if env.host_string in connections:
-            del connections[env.host_string]
+        # Fabric caches connections by where the host string resolves to
+        # through the SSH config, so that's what the pool tracks
+        from fabric.network import normalize_to_string
+        self.host_string = normalize_to_string(env.host_string)
+        _connection_pool.checkout(self.host_string, self.context.directory,
+                                  self.vm, ssh_settings)
+        return self
 
-        env.clear()
-        env.update(self.original_settings)
+    def __exit__(self, *args, **kwargs):
+        _connection_pool.checkin(self.host_string)
+        isolation, self.isolation = self.isolation, None
+        return isolation.__exit__(*args, **kwargs)
 
 
 class VagrantBox(object):
@@ -343,7 +1434,8 @@ class VagrantBox(object):
     # Proxy methods to underlying context
     def __getattr__(self, attr):
         f = getattr(self.context, attr)
-        if attr in ['list_boxes']:
+        if attr in ['list_boxes', 'execute_all', 'run_all',
+                    'vms_with_roles']:
             return f
         else:
             return lambda *a, **kw: f(*a, vm=self.box_name, **kw)
@@ -0,0 +1,413 @@
+'''
+Stand-in for the vagrant and VBoxManage commands, for benchmarking basebox
+without VirtualBox.  The `vagrant` and `VBoxManage` scripts beside this
+module call main() with their own name.
+
+Only what basebox uses is implemented.  VMs are just records in a JSON
+registry, so nothing actually boots, but each command's output is shaped like
+vagrant 1.0's and VirtualBox 4's.  State lives in $FAKEBOX_HOME (default
+/tmp/fakebox), where every command is also appended to commands.log.
+
+Each command sleeps for $FAKEBOX_LATENCY seconds (default 0), or for
+$FAKEBOX_LATENCY_<PROGRAM>_<SUBCOMMAND> seconds if set, e.g.
+FAKEBOX_LATENCY_VAGRANT_UP=2 or FAKEBOX_LATENCY_VBOXMANAGE_SHOWVMINFO=0.1.
+'''
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import uuid
+
+
+def home():
+    return os.environ.get('FAKEBOX_HOME') or '/tmp/fakebox'
+
+
+def main(program, args):
+    if not os.path.isdir(home()):
+        os.makedirs(home())
+    with open(os.path.join(home(), 'commands.log'), 'a') as log:
+        log.write(' '.join([program] + args) + '\n')
+
+    subcommand = args[0] if args else ''
+    latency = os.environ.get('FAKEBOX_LATENCY_%s_%s' %
+                             (program.upper(), subcommand.upper()),
+                             os.environ.get('FAKEBOX_LATENCY', 0))
+    time.sleep(float(latency))
+
+    commands = VAGRANT if program == 'vagrant' else VBOXMANAGE
+    command = commands.get(subcommand)
+    if not command:
+        return 0
+    with registry() as vms:
+        return command(vms, args[1:]) or 0
+
+
+@contextlib.contextmanager
+def registry():
+    '''The registered VMs, as {uuid: {name, state, directory, snapshots}}'''
+    path = os.path.join(home(), 'vms.json')
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            vms = json.load(open(path)) if os.path.exists(path) else {}
+            yield vms
+            with open(path, 'w') as f:
+                json.dump(vms, f)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def fail(message):
+    sys.stderr.write(message + '\n')
+    return 1
+
+
+def print_(line):
+    print(line)
+
+
+#---------------------------------------------------
+#  vagrant
+#---------------------------------------------------
+def defined_vms():
+    '''Names of the VMs defined in the Vagrantfile, in order.'''
+    try:
+        vagrantfile = open('Vagrantfile').read()
+    except IOError:
+        return []
+    return (re.findall(r'config\.vm\.define\s+[:"\']?(\w+)', vagrantfile) or
+            ['default'])
+
+
+def active():
+    machines_dir = os.path.join('.vagrant', 'machines')
+    if os.path.isdir(machines_dir):  # vagrant 1.1+'s layout
+        machines = {}
+        for name in os.listdir(machines_dir):
+            id_path = os.path.join(machines_dir, name, 'virtualbox', 'id')
+            if os.path.exists(id_path):
+                machines[name] = open(id_path).read().strip()
+        return machines
+    try:
+        return json.load(open('.vagrant'))['active']
+    except (IOError, ValueError):
+        return {}
+
+
+def write_active(machines):
+    if machines:
+        with open('.vagrant', 'w') as f:
+            json.dump({'active': machines}, f)
+    elif os.path.exists('.vagrant'):
+        os.unlink('.vagrant')
+
+
+def targets(args):
+    names = [arg for arg in args if not arg.startswith('-')]
+    return names[:1] or defined_vms()
+
+
+def vagrant_up(vms, args):
+    machines = active()
+    for name in targets(args):
+        machine_id = machines.get(name)
+        if machine_id not in vms:
+            machine_id = machines[name] = str(uuid.uuid4())
+            vms[machine_id] = {
+                'name': 'fake_%s_%s' % (os.path.basename(os.getcwd()), name),
+                'directory': os.getcwd(),
+                'snapshots': []
+                }
+        if vms[machine_id].get('state') != 'running':
+            vms[machine_id]['since'] = '%.9f' % time.time()  # boot time
+        vms[machine_id]['state'] = 'running'
+        print('[%s] VM booted and ready for use!' % name)
+    write_active(machines)
+
+
+def vagrant_set_state(state):
+    def command(vms, args):
+        machines = active()
+        for name in targets(args):
+            if machines.get(name) in vms:
+                vms[machines[name]]['state'] = state
+    return command
+
+
+def vagrant_destroy(vms, args):
+    machines = active()
+    for name in targets(args):
+        vms.pop(machines.pop(name, None), None)
+        print('[%s] Destroying VM and associated drives...' % name)
+    write_active(machines)
+
+
+def vagrant_status(vms, args):
+    machines = active()
+    states = {'running': 'running', 'poweroff': 'poweroff',
+              'saved': 'saved'}
+    print('Current VM states:\n')
+    for name in targets(args):
+        vm = vms.get(machines.get(name))
+        print('%-25s %s' % (name, states[vm['state']] if vm else
+                            'not created'))
+    print('\nThis environment represents multiple VMs. The VMs are all listed'
+          '\nabove with their current state.')
+
+
+def vagrant_ssh_config(vms, args):
+    machines = active()
+    name = targets(args)[0]
+    vm = vms.get(machines.get(name))
+    if not vm or vm['state'] != 'running':
+        return fail('The VM must be running to get its SSH config.')
+    print('Host %s' % name)
+    print('  HostName 127.0.0.1')
+    print('  User vagrant')
+    print('  Port %s' % (2200 + defined_vms().index(name)
+                         if name in defined_vms() else 2222))
+    print('  UserKnownHostsFile /dev/null')
+    print('  StrictHostKeyChecking no')
+    print('  PasswordAuthentication no')
+    print('  IdentityFile %s' % os.path.expanduser(
+        '~/.vagrant.d/insecure_private_key'))
+    print('  IdentitiesOnly yes')
+
+
+def vagrant_package(vms, args):
+    output = 'package.box'
+    if '--output' in args:
+        output = args[args.index('--output') + 1]
+    vagrant_set_state('poweroff')(vms, args)
+    directory = tempfile.mkdtemp()
+    try:
+        with tarfile.open(output, 'w') as box:
+            for name in write_box_files(directory):
+                box.add(os.path.join(directory, name), name)
+    finally:
+        shutil.rmtree(directory)
+
+
+def vagrant_box(vms, args):
+    boxes_dir = os.path.join(os.environ.get('VAGRANT_HOME') or
+                             os.path.expanduser('~/.vagrant.d'), 'boxes')
+    action, names = args[0], args[1:]
+    if action == 'list':
+        if os.path.isdir(boxes_dir):
+            for name in sorted(os.listdir(boxes_dir)):
+                if not name.startswith('.'):
+                    print(name)
+    elif action == 'add':
+        box_dir = os.path.join(boxes_dir, names[0])
+        if os.path.exists(box_dir):
+            return fail('A box already exists under the name of `%s`.' %
+                        names[0])
+        os.makedirs(box_dir)
+        if os.path.isfile(names[1]) and tarfile.is_tarfile(names[1]):
+            tarfile.open(names[1]).extractall(box_dir)
+        else:
+            write_box_files(box_dir)
+    elif action == 'remove':
+        box_dir = os.path.join(boxes_dir, names[0])
+        if not os.path.isdir(box_dir):
+            return fail('The box you\'re attempting to remove does not exist!')
+        shutil.rmtree(box_dir)
+
+
+def vagrant_version(vms, args):
+    # $FAKEBOX_VAGRANT_VERSION can pose as another version of vagrant
+    version = os.environ.get('FAKEBOX_VAGRANT_VERSION', '1.0.7')
+    print_(('Vagrant version %s' if version.startswith('1.0.') else
+            'Vagrant %s') % version)
+
+
+def write_box_files(directory):
+    files = {'box.ovf': '<Envelope/>\n',
+             'box-disk1.vmdk': '\0' * 4096,
+             'Vagrantfile': 'Vagrant::Config.run do |config|\nend\n'}
+    for name, contents in files.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(contents)
+    return sorted(files)
+
+
+VAGRANT = {
+    'up': vagrant_up,
+    'reload': vagrant_up,
+    'halt': vagrant_set_state('poweroff'),
+    'suspend': vagrant_set_state('saved'),
+    'resume': vagrant_set_state('running'),
+    'destroy': vagrant_destroy,
+    'status': vagrant_status,
+    'ssh-config': vagrant_ssh_config,
+    'package': vagrant_package,
+    'box': vagrant_box,
+    '--version': vagrant_version,
+    }
+
+
+#---------------------------------------------------
+#  VBoxManage
+#---------------------------------------------------
+def find_vm(vms, ref):
+    for machine_id, vm in vms.items():
+        if ref in (machine_id, vm['name']):
+            return machine_id, vm
+    return None, None
+
+
+def mac_address(machine_id, vm=None):
+    return ((vm or {}).get('mac') or
+            '080027%s' % machine_id.replace('-', '')[:6].upper())
+
+
+def vbox_list(vms, args):
+    verbose = '-l' in args or '--long' in args
+    what = [arg for arg in args if not arg.startswith('-')][0]
+    for machine_id, vm in sorted(vms.items(), key=lambda item: item[1]['name']):
+        if what == 'runningvms' and vm['state'] != 'running':
+            continue
+        if verbose:
+            print('Name:            %s' % vm['name'])
+            print('Guest OS:        Ubuntu (64 bit)')
+            print('UUID:            %s' % machine_id)
+            print('Memory size:     512MB')
+            print('Number of CPUs:  1')
+            print('State:           %s (since %s)' % (
+                {'running': 'running', 'poweroff': 'powered off',
+                 'saved': 'saved'}[vm['state']],
+                vm.get('since', '2013-05-10T10:25:19.000000000')))
+            print('NIC 1:           MAC: %s, Attachment: NAT, Cable '
+                  'connected: on' % mac_address(machine_id, vm))
+            print('NIC 2:           disabled')
+            print('')
+        else:
+            print('"%s" {%s}' % (vm['name'], machine_id))
+
+
+def vbox_showvminfo(vms, args):
+    machine_id, vm = find_vm(vms, args[0])
+    if not vm:
+        return fail('VBoxManage: error: Could not find a registered machine '
+                    'named \'%s\'' % args[0])
+    print('name="%s"' % vm['name'])
+    print('UUID="%s"' % machine_id)
+    print('VMState="%s"' % vm['state'])
+    print('memory=512')
+    print('cpus=1')
+    print('macaddress1="%s"' % mac_address(machine_id, vm))
+    print('nic1="nat"')
+    for idx, snapshot in enumerate(vm['snapshots']):
+        print('SnapshotName%s="%s"' % ('-%s' % idx if idx else '', snapshot))
+
+
+def vbox_guestproperty(vms, args):
+    machine_id, vm = find_vm(vms, args[1])
+    if not vm or vm['state'] != 'running':
+        return
+    # $FAKEBOX_GUEST_ADDRESSES can list the guest's addresses, e.g.
+    # 'eth0=10.0.2.15 eth1=192.168.33.10'
+    index = sorted(vms).index(machine_id)
+    addresses = [address.split('=') for address in
+                 os.environ.get('FAKEBOX_GUEST_ADDRESSES', '').split()]
+    addresses = addresses or [('eth0', '10.0.2.15'),
+                              ('eth1', '192.168.33.%s' % (10 + index))]
+    for idx, (name, ip) in enumerate(addresses):
+        print('Name: /VirtualBox/GuestInfo/Net/%s/V4/IP, value: %s, '
+              'timestamp: 1, flags: ' % (idx, ip))
+        print('Name: /VirtualBox/GuestInfo/Net/%s/Name, value: %s, '
+              'timestamp: 1, flags: ' % (idx, name))
+    print('Name: /VirtualBox/GuestInfo/Net/Count, value: %s, timestamp: 1, '
+          'flags: ' % len(addresses))
+
+
+def vbox_snapshot(vms, args):
+    machine_id, vm = find_vm(vms, args[0])
+    if not vm:
+        return fail('VBoxManage: error: Could not find a registered machine')
+    action = args[1]
+    if action == 'take':
+        vm['snapshots'].append(args[2])
+    elif action == 'delete' and args[2] in vm['snapshots']:
+        vm['snapshots'].remove(args[2])
+    elif action == 'restore':
+        vm['state'] = 'poweroff'
+    elif action == 'list':
+        if not vm['snapshots']:
+            return fail('This machine does not have any snapshots')
+        for idx, snapshot in enumerate(vm['snapshots']):
+            print('SnapshotName%s="%s"' % ('-%s' % idx if idx else '',
+                                           snapshot))
+
+
+def vbox_register(vms, machine_id, name):
+    vms[machine_id] = {'name': name, 'state': 'poweroff',
+                       'directory': None, 'snapshots': []}
+
+
+def vbox_clonevm(vms, args):
+    source_id, source = find_vm(vms, args[0])
+    if not source:
+        return fail('VBoxManage: error: Could not find a registered machine')
+    name = args[args.index('--name') + 1]
+    machine_id = (args[args.index('--uuid') + 1] if '--uuid' in args
+                  else str(uuid.uuid4()))
+    options = (args[args.index('--options') + 1].split(',')
+               if '--options' in args else [])
+    vbox_register(vms, machine_id, name)
+
+    # Clones get new MAC addresses unless asked to keep them, and linked
+    # clones keep their source from being deleted
+    if 'keepallmacs' in options:
+        vms[machine_id]['mac'] = mac_address(source_id, source)
+    if 'link' in options:
+        vms[machine_id]['linked_to'] = source_id
+
+
+def vbox_import(vms, args):
+    vbox_register(vms, str(uuid.uuid4()), args[args.index('--vmname') + 1])
+
+
+def vbox_export(vms, args):
+    output = args[args.index('--output') + 1]
+    directory = os.path.dirname(output) or '.'
+    write_box_files(directory)
+    os.unlink(os.path.join(directory, 'Vagrantfile'))
+    if os.path.basename(output) != 'box.ovf':
+        os.rename(os.path.join(directory, 'box.ovf'), output)
+
+
+def vbox_controlvm(vms, args):
+    machine_id, vm = find_vm(vms, args[0])
+    if vm and args[1] in ('poweroff', 'acpipowerbutton'):
+        vm['state'] = 'poweroff'
+    elif vm and args[1] == 'savestate':
+        vm['state'] = 'saved'
+
+
+def vbox_unregistervm(vms, args):
+    machine_id, vm = find_vm(vms, args[0])
+    if any(other.get('linked_to') == machine_id for other in vms.values()):
+        return fail('VBoxManage: error: Cannot unregister the machine '
+                    '\'%s\' while it has linked clones' % args[0])
+    vms.pop(machine_id, None)
+
+
+VBOXMANAGE = {
+    'list': vbox_list,
+    'showvminfo': vbox_showvminfo,
+    'guestproperty': vbox_guestproperty,
+    'snapshot': vbox_snapshot,
+    'clonevm': vbox_clonevm,
+    'import': vbox_import,
+    'export': vbox_export,
+    'controlvm': vbox_controlvm,
+    'unregistervm': vbox_unregistervm,
+    }
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+'''
+Benchmarks for basebox's own overhead, run against the stand-in vagrant and
+VBoxManage commands in benchmarks/bin (see fakebox.py), so they need neither
+VirtualBox nor any real VMs.
+
+Each scenario drives basebox through a typical operation with 1, 5 and 20 VMs
+by default, and reports the number of external commands each step issued and
+how long it took.  Since the stand-in commands are nearly free (unless
+latencies are configured with $FAKEBOX_LATENCY...), command counts are the
+figure to watch:
+
+    python benchmarks/run.py --json results.json
+    python benchmarks/run.py --compare benchmarks/baseline.json
+
+--compare exits with an error if any step issues more commands than it did
+in the given results.
+'''
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from cuisine import mode_local
+from fabric.api import hide
+
+from basebox import cli
+from basebox.aio import AsyncVagrantContext, gather
+from basebox.build import basebox, tempbox
+from basebox.inventory import discover, inventory
+from basebox.profile import classify
+from basebox.vagrant import VagrantBox, VagrantContext, add_box, info_many
+
+
+BASE_BOX = 'bench-base'
+FABFILE = '''
+from fabric.api import task
+
+@task
+def noop():
+    pass
+'''
+
+
+class Benchmark(object):
+    '''Runs scenarios in a scratch environment and collects measurements.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.results = []
+        self.scenario = None
+        self.size = None
+
+    def log_lines(self):
+        try:
+            return open(os.path.join(os.environ['FAKEBOX_HOME'],
+                                     'commands.log')).read().splitlines()
+        except IOError:
+            return []
+
+    @contextlib.contextmanager
+    def measure(self, step):
+        '''Record the commands issued and time taken within the block.'''
+        before = len(self.log_lines())
+        start = time.time()
+        yield
+        elapsed = time.time() - start
+        commands = self.log_lines()[before:]
+
+        breakdown = {}
+        for command in commands:
+            name = classify(command)
+            breakdown[name] = breakdown.get(name, 0) + 1
+        self.results.append({
+            'scenario': self.scenario,
+            'vms': self.size,
+            'step': step,
+            'commands': len(commands),
+            'seconds': elapsed,
+            'breakdown': breakdown
+            })
+
+    def workdir(self, hosts):
+        directory = tempfile.mkdtemp(dir=self.directory)
+        with open(os.path.join(directory, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            f.write('  config.vm.box = "%s"\n' % BASE_BOX)
+            for host in hosts:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+        return directory
+
+
+def context_scenario(bench, hosts):
+    '''Bring up a multi-VM environment, query it, and connect to it.'''
+    context = VagrantContext(bench.workdir(hosts))
+    boxes = [VagrantBox(context, host) for host in hosts]
+
+    with bench.measure('up'):
+        context.up()
+    with bench.measure('uuid'):
+        for box in boxes:
+            box.uuid()
+    with bench.measure('status'):
+        for box in boxes:
+            box.status()
+    with bench.measure('is_running'):
+        for box in boxes:
+            box.is_running()
+    with bench.measure('ssh_config'):
+        for box in boxes:
+            box.ssh_config()
+    with bench.measure('connect x10'):
+        for box in boxes:
+            for _ in range(10):
+                with box.connect():
+                    pass
+    with bench.measure('info_many'):
+        info_many([context])
+    with bench.measure('destroy'):
+        context.destroy(force=True)
+
+
+def tempbox_scenario(bench, hosts):
+    '''Build and install a box with tempbox().'''
+    with bench.measure('tempbox build'):
+        with tempbox(base=BASE_BOX,
+                     vfile_template_context={'hosts': hosts}) as box:
+            box.up()
+            for host in hosts:
+                with VagrantBox(box.context, host).connect():
+                    pass
+            VagrantBox(box.context, hosts[0]).package(
+                install_as='bench-tempbox')
+
+
+def basebox_scenario(bench, hosts):
+    '''Build and install a box with the @basebox decorator.'''
+    if len(hosts) > 1:
+        return  # the decorator only builds single VM boxes
+
+    @basebox(base=BASE_BOX, install_as='bench-basebox', use_cache=False)
+    def build():
+        pass
+
+    with bench.measure('basebox build'):
+        build()
+
+
+def cli_scenario(bench, hosts):
+    '''Build and install a box with the basebox command.'''
+    if len(hosts) > 1:
+        return  # the command only packages single VM builds
+
+    fabfile = os.path.join(bench.workdir(hosts), 'fabfile.py')
+    with open(fabfile, 'w') as f:
+        f.write(FABFILE)
+
+    with bench.measure('cli build'):
+        cli.main(['--base', BASE_BOX, '--install-as', 'bench-cli', '-f',
+                  fabfile, '--', 'noop'])
+
+
+def async_scenario(bench, hosts):
+    '''Drive one single VM context per host from one event loop.'''
+    contexts = [AsyncVagrantContext(bench.workdir(['default']))
+                for host in hosts]
+
+    with bench.measure('up'):
+        gather(*[ctx.up() for ctx in contexts])
+    with bench.measure('status'):
+        gather(*[ctx.status() for ctx in contexts])
+    with bench.measure('ssh_config'):
+        gather(*[ctx.ssh_config() for ctx in contexts])
+    with bench.measure('destroy'):
+        gather(*[ctx.destroy(force=True) for ctx in contexts])
+
+
+def startup_scenario(bench, hosts):
+    '''Run the basebox command's metadata options in a fresh interpreter.'''
+    if len(hosts) > 1:
+        return  # no VMs involved
+
+    for option in ['--version', '--help']:
+        with bench.measure('cli %s' % option):
+            subprocess.check_call(
+                [sys.executable, '-m', 'basebox.cli', option],
+                cwd=os.path.dirname(BENCHMARKS_DIR),
+                stdout=open(os.devnull, 'w'))
+
+
+def inventory_scenario(bench, hosts):
+    '''Poll the state of one single VM context per host.'''
+    root = tempfile.mkdtemp(dir=bench.directory)
+    contexts = []
+    for host in hosts:
+        directory = os.path.join(root, host)
+        os.rename(bench.workdir(['default']), directory)
+        contexts.append(VagrantContext(directory))
+        contexts[-1].up()
+
+    with bench.measure('discover'):
+        directories = discover([root])
+    with bench.measure('inventory'):
+        inventory(directories)
+    with bench.measure('status+vminfo'):
+        for context in contexts:
+            context.state.invalidate()
+            context.status()
+            context.vminfo()
+
+    for context in contexts:
+        context.destroy(force=True)
+
+
+SCENARIOS = [
+    ('context', context_scenario),
+    ('async', async_scenario),
+    ('inventory', inventory_scenario),
+    ('tempbox', tempbox_scenario),
+    ('basebox', basebox_scenario),
+    ('cli', cli_scenario),
+    ('startup', startup_scenario),
+    ]
+
+
+def report(results, out=sys.stdout):
+    out.write('%-10s %4s %-16s %9s %9s\n' % ('SCENARIO', 'VMS', 'STEP',
+                                              'COMMANDS', 'SECONDS'))
+    for result in results:
+        out.write('%-10s %4s %-16s %9s %9.3f\n' % (
+            result['scenario'], result['vms'], result['step'],
+            result['commands'], result['seconds']))
+
+
+def compare(results, baseline):
+    '''Return descriptions of steps that issue more commands than before.'''
+    expected = dict(((r['scenario'], r['vms'], r['step']), r['commands'])
+                    for r in baseline)
+    regressions = []
+    for result in results:
+        key = (result['scenario'], result['vms'], result['step'])
+        if key in expected and result['commands'] > expected[key]:
+            regressions.append('%s/%s VMs/%s: %s commands (was %s)' % (
+                key + (result['commands'], expected[key])))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark basebox against stand-in vagrant/VBoxManage.')
+    parser.add_argument('--sizes',
+        help='Comma-separated numbers of VMs to run each scenario with.',
+        default='1,5,20')
+    parser.add_argument('--scenarios',
+        help='Comma-separated scenarios to run (default: all of %s).' %
+            ', '.join(name for name, _ in SCENARIOS))
+    parser.add_argument('--json',
+        help='Write the results to this file.',
+        metavar='FILE')
+    parser.add_argument('--compare',
+        help='Fail if any step issues more commands than in these results.',
+        metavar='FILE')
+    args = parser.parse_args(args)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    selected = args.scenarios.split(',') if args.scenarios else None
+
+    # Run everything against the stand-in commands, in a scratch directory
+    directory = tempfile.mkdtemp(prefix='basebox-bench-')
+    os.environ['PATH'] = os.pathsep.join([os.path.join(BENCHMARKS_DIR, 'bin'),
+                                          os.environ['PATH']])
+    for var, name in [('FAKEBOX_HOME', 'fakebox'),
+                      ('VAGRANT_HOME', 'vagrant.d'),
+                      ('BASEBOX_CACHE_DIR', 'cache')]:
+        os.environ[var] = os.path.join(directory, name)
+
+    bench = Benchmark(directory)
+    stdout = sys.stdout
+    try:
+        mode_local()
+        with hide('running', 'stdout', 'stderr'):
+            sys.stdout = open(os.devnull, 'w')
+            add_box(BASE_BOX, 'bench-base.box')
+            for name, scenario in SCENARIOS:
+                if selected and name not in selected:
+                    continue
+                for size in sizes:
+                    bench.scenario, bench.size = name, size
+                    scenario(bench, ['vm%s' % idx for idx in range(size)])
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+
+    report(bench.results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(bench.results, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if args.compare:
+        regressions = compare(bench.results, json.load(open(args.compare)))
+        for regression in regressions:
+            sys.stderr.write('More commands than before: %s\n' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
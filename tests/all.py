@@ -109,12 +109,25 @@ class TestMulti(ExecutionTestCase):
     def testListBoxes(self):
         self.assertEqual(set(self.ctx.list_boxes()), set(['box1', 'box2']))
 
+    def testUp(self):
+        '''up() without a VM name brings up every VM, without recursing'''
+        self.ctx.up()
+        self.assertTrue(self.ctx.is_running(vm='box1'))
+        self.assertTrue(self.ctx.is_running(vm='box2'))
+
     def testBoxAccess(self):
         '''Access individual boxes with [] lookup'''
         box1 = self.ctx['box1']
         box2 = self.ctx['box2']
         self.assertNotEqual(box1.info()['port'], box2.info()['port'])
 
+    def testRunAll(self):
+        results = self.ctx.run_all('hostname')
+        self.assertEqual(set(results), set(['box1', 'box2']))
+        for name, result in results.items():
+            self.assertEqual(result['error'], None)
+            self.assertTrue(result['result'].succeeded)
+
     @unittest.skip('Too dependent upon external network settings for now, '
                    'needs work')
     def testIPs(self):
@@ -0,0 +1,128 @@
+'''
+Shared fixtures for the tests that run against the benchmark suite's fakebox
+stand-ins for vagrant and VBoxManage (benchmarks/bin), so they need neither
+VirtualBox nor Vagrant, and for the tests that download boxes from a local
+HTTP server.
+'''
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cuisine import mode_local
+from fabric.api import hide
+
+from basebox import vagrant
+
+FAKE_BIN = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'bin')
+
+
+class FakeboxTestCase(unittest.TestCase):
+    '''
+    Base test case for tests using the fakebox stand-ins.  Each test gets a
+    temporary directory, self.directory, holding the stand-ins' VM registry,
+    $VAGRANT_HOME and $BASEBOX_CACHE_DIR, and runs in cuisine's local mode
+    with the `hidden` fabric output groups hidden.  The environment, mode and
+    basebox's module-level caches are restored afterwards.
+    '''
+
+    hidden = ('running', 'stdout')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join([FAKE_BIN, os.environ['PATH']])
+        for var in ['FAKEBOX_HOME', 'VAGRANT_HOME', 'BASEBOX_CACHE_DIR']:
+            os.environ[var] = os.path.join(self.directory, var.lower())
+
+        self.mode = mode_local()
+        self.hide = hide(*self.hidden)
+        self.hide.__enter__()
+        vagrant._box_registry.invalidate()
+        vagrant._vagrant_version = None
+
+    def tearDown(self):
+        vagrant._box_registry.invalidate()
+        vagrant._vagrant_version = None
+        self.hide.__exit__(None, None, None)
+        self.mode.__exit__(None, None, None)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+
+class BoxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves `server.content`, honouring conditional and range requests.'''
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        server = self.server
+        server.requests.append((self.command, dict(self.headers)))
+        etag = '"%s"' % hashlib.md5(server.content).hexdigest()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        content = server.content
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == etag:
+            offset = int(range_header.split('=')[1].rstrip('-'))
+            content = content[offset:]
+            status = 206
+
+        self.send_response(status)
+        if server.validators:
+            self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                offset, len(server.content) - 1, len(server.content)))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            # Close the connection partway through if told to
+            self.wfile.write(content[:server.truncate])
+
+    def log_message(self, *args):
+        pass
+
+
+class BoxServer(BaseHTTPServer.HTTPServer):
+    '''
+    Local HTTP server standing in for a box host, serving `content` at every
+    path from a background thread until stop() is called.  The method and
+    headers of each request are recorded in `requests`.  Set `validators` to
+    False to leave out ETags, or `truncate` to a number of bytes to close the
+    connection after sending that much of a body.
+    '''
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), BoxHandler)
+        self.content = content
+        self.requests = []
+        self.validators = True
+        self.truncate = None
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s/%s' % (self.server_port, path)
+
+    def methods(self):
+        return [method for method, _ in self.requests]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
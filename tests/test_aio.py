@@ -0,0 +1,123 @@
+'''
+Tests for the non-blocking lifecycle operations, run against the stand-in
+vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import os
+import time
+import unittest
+
+from fabric.api import env
+
+from basebox.aio import AsyncVagrantContext, Command, Return, gather
+from basebox.profile import count_commands
+from basebox.vagrant import read_runfile
+from support import FakeboxTestCase
+
+
+class TestAsync(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestAsync, self).setUp()
+
+        self.contexts = []
+        for idx in range(3):
+            workdir = os.path.join(self.directory, 'box%s' % idx)
+            os.mkdir(workdir)
+            open(os.path.join(workdir, 'Vagrantfile'), 'w').write(
+                'Vagrant::Config.run do |config|\nend\n')
+            self.contexts.append(AsyncVagrantContext(workdir))
+
+    def testLifecycle(self):
+        '''Operations over many contexts run from one loop, without env'''
+        fabric_env = dict(env)
+        gather(*[ctx.up() for ctx in self.contexts])
+        self.assertTrue(all(ctx.uuid() for ctx in self.contexts))
+        self.assertEqual(gather(*[ctx.status() for ctx in self.contexts]),
+                         [{'default': 'running'}] * 3)
+
+        ssh_configs = gather(*[ctx.ssh_config() for ctx in self.contexts])
+        self.assertEqual([c['hostname'] for c in ssh_configs],
+                         ['127.0.0.1'] * 3)
+
+        gather(*[ctx.halt() for ctx in self.contexts])
+        self.assertEqual(gather(*[ctx.status('default')
+                                  for ctx in self.contexts]),
+                         ['poweroff'] * 3)
+
+        gather(*[ctx.destroy(force=True) for ctx in self.contexts])
+        self.assertFalse(any(ctx.uuid() for ctx in self.contexts))
+        self.assertEqual(dict(env), fabric_env)
+
+    def testCached(self):
+        '''Cached status and SSH config don't run any commands'''
+        ctx = self.contexts[0]
+        gather(ctx.up())
+        gather(ctx.status(), ctx.ssh_config())
+        with count_commands() as counter:
+            gather(ctx.status(), ctx.ssh_config())
+        counter.assert_at_most(0)
+
+    def testSameContext(self):
+        '''vagrant 1.0 ups in one context don't overlap, or lose VMs'''
+        hosts = ['web', 'db', 'cache']
+        workdir = os.path.join(self.directory, 'cluster')
+        os.mkdir(workdir)
+        with open(os.path.join(workdir, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            for host in hosts:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+        cluster = AsyncVagrantContext(workdir)
+        os.environ['FAKEBOX_LATENCY_VAGRANT_UP'] = '0.3'
+
+        start = time.time()
+        gather(*[cluster.up(vm=host) for host in hosts])
+        self.assertTrue(time.time() - start >= 0.3 * len(hosts))
+        machines = read_runfile(os.path.join(workdir, '.vagrant'))
+        self.assertEqual(sorted(machines), sorted(hosts))
+
+        # Other contexts' ups still run alongside
+        start = time.time()
+        gather(*[ctx.up() for ctx in self.contexts])
+        self.assertTrue(time.time() - start < 0.3 * len(self.contexts))
+        gather(*[cluster.destroy(vm=host, force=True) for host in hosts])
+        self.assertEqual(read_runfile(os.path.join(workdir, '.vagrant')), {})
+
+    def testConcurrent(self):
+        '''Commands run concurrently, at most `limit` at a time'''
+        commands = [Command('sleep 0.5') for _ in range(4)]
+        start = time.time()
+        gather(*commands)
+        self.assertTrue(time.time() - start < 1.5)
+
+        start = time.time()
+        gather(*commands, limit=2)
+        self.assertTrue(time.time() - start >= 1)
+
+    def testCompose(self):
+        def both(ctx):
+            results = yield [Command('echo a'), Command('echo b >&2')]
+            raise Return([results[0], results[1].stderr])
+
+        self.assertEqual(gather(both(self.contexts[0])), [['a', 'b']])
+
+    def testErrors(self):
+        failing = Command('exit 3')
+        self.assertRaises(Exception, gather, failing)
+
+        result, error = gather(Command('exit 3', warn_only=True), failing,
+                               return_exceptions=True)
+        self.assertEqual(result.return_code, 3)
+        self.assertTrue(isinstance(error, Exception))
+
+        def recover():
+            try:
+                yield failing
+            except Exception:
+                raise Return('recovered')
+        self.assertEqual(gather(recover()), ['recovered'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+Command budgets for basebox's hot paths, checked against the stand-in
+vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import os
+import unittest
+
+from basebox.profile import count_commands
+from basebox.vagrant import VagrantContext, installed_boxes
+from support import FakeboxTestCase
+
+
+class TestBudgets(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestBudgets, self).setUp()
+
+        workdir = os.path.join(self.directory, 'box')
+        os.mkdir(workdir)
+        open(os.path.join(workdir, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\nend\n')
+
+        self.context = VagrantContext(workdir)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestBudgets, self).tearDown()
+
+    def testConnect(self):
+        '''Connecting to a running VM only checks that it's running'''
+        self.context.ssh_config()
+        with count_commands() as counter:
+            with self.context.connect():
+                pass
+        counter.assert_at_most(1)
+        counter.assert_at_most(0, 'vagrant')
+
+    def testUuid(self):
+        with count_commands() as counter:
+            self.context.uuid()
+        counter.assert_at_most(0)
+
+    def testStatus(self):
+        self.context.status()
+        with count_commands() as counter:
+            self.context.status()
+        counter.assert_at_most(0)
+
+    def testSshConfig(self):
+        self.context.ssh_config()
+        with count_commands() as counter:
+            self.context.ssh_config()
+        counter.assert_at_most(0)
+
+    def testInstalledBoxes(self):
+        with count_commands() as counter:
+            installed_boxes()
+            installed_boxes()
+        counter.assert_at_most(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
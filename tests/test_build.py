@@ -0,0 +1,40 @@
+'''
+Tests for the @basebox decorator, run against the stand-in vagrant and
+VBoxManage commands from the benchmark suite (see benchmarks/bin/fakebox.py),
+so they don't need VirtualBox.  The builds don't run any commands, so they
+don't need SSH either.
+'''
+import os
+import unittest
+
+from basebox.build import basebox
+from basebox.vagrant import add_box, installed_boxes, remove_box
+from support import FakeboxTestCase
+
+BASE_BOX = 'decorator-base'
+
+
+class TestBaseboxDecorator(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestBaseboxDecorator, self).setUp()
+        add_box(BASE_BOX, os.path.join(self.directory, 'base.box'))
+
+    def testRepeatedBuilds(self):
+        '''A decorated build keeps its options from one call to the next'''
+        bases = []
+
+        @basebox(base=BASE_BOX, install_as='decorated')
+        def build():
+            bases.append(basebox.basebox)
+
+        build()
+        remove_box('decorated')
+        build()
+        self.assertTrue('decorated' in installed_boxes())
+        self.assertFalse('build' in installed_boxes())
+        self.assertEqual(bases, [BASE_BOX, BASE_BOX])
+
+
+if __name__ == "__main__":
+    unittest.main()
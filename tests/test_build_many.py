@@ -0,0 +1,106 @@
+'''
+Tests for running builds from a manifest with `basebox build-many`, run
+against the stand-in vagrant and VBoxManage commands from the benchmark suite
+(see benchmarks/bin/fakebox.py), so they don't need VirtualBox.  The builds'
+fabfile doesn't run any commands, so they don't need SSH either.
+'''
+import json
+import os
+import StringIO
+import sys
+import unittest
+
+from basebox import vagrant
+from basebox.cli import build_many
+from basebox.profile import count_commands
+from basebox.vagrant import add_box, installed_boxes
+from support import FakeboxTestCase
+
+BASE_BOX = 'manifest-base'
+
+FABFILE = '''
+from fabric.api import task
+
+@task
+def noop():
+    pass
+'''
+
+
+class TestBuildMany(FakeboxTestCase):
+
+    hidden = ('running', 'stdout', 'stderr')
+
+    def setUp(self):
+        super(TestBuildMany, self).setUp()
+        add_box(BASE_BOX, os.path.join(self.directory, 'base.box'))
+
+        # The fabfile is found relative to the manifest
+        self.manifest_dir = os.path.join(self.directory, 'manifests')
+        os.mkdir(self.manifest_dir)
+        open(os.path.join(self.manifest_dir, 'fabfile.py'), 'w').write(FABFILE)
+
+    def build_many(self, builds):
+        '''Run build-many on `builds`, returning its summary lines'''
+        path = os.path.join(self.manifest_dir, 'manifest.json')
+        json.dump(builds, open(path, 'w'))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            build_many([path, '--parallel', '2'])
+        finally:
+            summary, sys.stdout = sys.stdout.getvalue(), stdout
+        return [line.split()[:2] for line in summary.splitlines()
+                if line.strip()]
+
+    def build(self, **options):
+        build = {'base': BASE_BOX, 'fabfile': 'fabfile.py',
+                 'tasks': ['noop']}
+        build.update(options)
+        return build
+
+    def testBuilds(self):
+        output = os.path.join(self.directory, 'web.box')
+        summary = self.build_many([
+            self.build(name='web', package_as=output),
+            self.build(install_as='db', hosts=['default:db'])
+            ])
+        self.assertEqual(summary[-2:], [['web', 'ok'], ['db', 'ok']])
+        self.assertTrue(os.path.isfile(output))
+        vagrant._box_registry.invalidate()
+        self.assertTrue('db' in installed_boxes())
+
+    def testFailure(self):
+        '''A failed build fails the command, but not the other builds'''
+        builds = [self.build(install_as='web'),
+                  self.build(install_as='broken', tasks=['missing'])]
+        with count_commands() as counter:
+            self.assertRaises(SystemExit, self.build_many, builds)
+        # Only the build that succeeded installs its box
+        self.assertEqual(counter.count('vagrant box add'), 1)
+
+        vagrant._box_registry.invalidate()
+        self.assertTrue('web' in installed_boxes())
+        self.assertFalse('broken' in installed_boxes())
+
+    def testCache(self):
+        '''Builds are only cached, and packaged for it, when asked to'''
+        builds = [self.build(install_as='web', args=[])]
+        cache_dir = os.path.join(os.environ['BASEBOX_CACHE_DIR'], 'builds')
+        for _ in range(2):
+            with count_commands() as counter:
+                self.build_many(builds)
+            self.assertEqual(counter.count('vagrant up'), 1)
+        self.assertFalse(os.path.exists(cache_dir))
+
+        builds = [self.build(install_as='web', args=['--cache'])]
+        self.build_many(builds)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        with count_commands() as counter:
+            self.build_many(builds)
+        self.assertEqual(counter.count('vagrant up'), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
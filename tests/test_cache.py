@@ -0,0 +1,51 @@
+'''
+Tests for the build cache.  Like test_download.py, these don't need vagrant
+or VirtualBox.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from basebox.cache import BuildCache
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = BuildCache(os.path.join(self.directory, 'builds'))
+        self.box = os.path.join(self.directory, 'package.box')
+        open(self.box, 'w').write('box contents')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testUsed(self):
+        with self.cache.used('first') as path:
+            self.assertEqual(path, None)
+        self.cache.put('first', self.box)
+        with self.cache.used('first') as path:
+            self.assertEqual(open(path).read(), 'box contents')
+
+    def testEviction(self):
+        '''Least recently used entries are evicted to stay within budget'''
+        self.cache.max_bytes = len('box contents') + 1
+        first = self.cache.put('first', self.box)
+        second = self.cache.put('second', self.box)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def testEvictionInUse(self):
+        '''Entries in use aren't evicted until they're done with'''
+        self.cache.max_bytes = len('box contents') + 1
+        self.cache.put('first', self.box)
+        with self.cache.used('first') as first:
+            self.cache.put('second', self.box)
+            self.assertTrue(os.path.exists(first))
+        self.cache.put('third', self.box)
+        self.assertFalse(os.path.exists(first))
+
+
+if __name__ == "__main__":
+    unittest.main()
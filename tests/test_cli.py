@@ -0,0 +1,61 @@
+'''
+Startup budget for the CLI's metadata commands, which shouldn't load fabric,
+cuisine, jinja2 or anything else that's only needed to build.  Like
+test_download.py, these don't need vagrant or VirtualBox.
+'''
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['fabric', 'cuisine', 'jinja2', 'ssh', 'paramiko',
+                 'basebox.build', 'basebox.vagrant']
+
+SCRIPT = '''
+import sys
+from basebox.cli import main
+main(sys.argv[1:])
+print sorted(name for name in %r if name in sys.modules)
+''' % HEAVY_MODULES
+
+
+def run_cli(*args):
+    '''Run the CLI in a fresh interpreter, returning its output lines.'''
+    process = subprocess.Popen([sys.executable, '-c', SCRIPT] + list(args),
+                               cwd=ROOT, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    return output.splitlines()
+
+
+class TestStartup(unittest.TestCase):
+
+    def testVersion(self):
+        output = run_cli('--version')
+        self.assertTrue(output[0].startswith('basebox '))
+        self.assertEqual(output[-1], '[]')
+
+    def testHelp(self):
+        output = run_cli('--help')
+        self.assertTrue(any('--install-as' in line for line in output))
+        self.assertEqual(output[-1], '[]')
+
+
+class TestImport(unittest.TestCase):
+
+    def testPatch(self):
+        '''Importing basebox patches cuisine once it's imported'''
+        process = subprocess.Popen([sys.executable, '-c', '''
+import sys
+import basebox
+print 'cuisine' in sys.modules
+import cuisine
+print cuisine.run_local.__module__
+'''], cwd=ROOT, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(output.splitlines(), ['False', 'basebox.monkey'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+'''
+Tests for running work on many VMs at once, run against the stand-in vagrant
+and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.  There's no SSH
+server behind the stand-ins, so the work here only looks at env rather than
+running remote commands (see TestMulti.testRunAll in all.py for that).
+'''
+import os
+import threading
+import time
+import unittest
+
+from cuisine import is_local
+from fabric.api import abort, env, hide, settings
+
+from basebox.vagrant import VagrantBox, VagrantContext
+from support import FakeboxTestCase
+
+HOSTS = ['web1', 'web2', 'db', 'cache']
+
+ROLEDEFS = {
+    'web': ['web1', 'web2'],
+    'db': ['db'],
+    'storage': lambda: ['db', 'cache'],
+    'all': {'hosts': HOSTS}
+    }
+
+
+class TestCluster(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestCluster, self).setUp()
+
+        workdir = os.path.join(self.directory, 'box')
+        os.mkdir(workdir)
+        with open(os.path.join(workdir, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            for host in HOSTS:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+
+        self.context = VagrantContext(workdir)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestCluster, self).tearDown()
+
+    def host_string(self, vm):
+        return 'vagrant@vagrant-temporary-%s:%s' % (
+            self.context.uuid(vm=vm), self.context.ssh_config(vm=vm)['port'])
+
+    def testExecuteAll(self):
+        '''VMs are worked on at once, each in its own env'''
+        def work():
+            time.sleep(0.5)
+            return env.host_string, is_local()
+
+        start = time.time()
+        results = self.context.execute_all(work)
+        elapsed = time.time() - start
+
+        self.assertEqual(sorted(results), sorted(HOSTS))
+        for name, result in results.items():
+            self.assertEqual(result['result'], (self.host_string(name), False))
+            self.assertEqual(result['error'], None)
+            self.assertTrue(result['elapsed'] >= 0.5)
+        self.assertTrue(elapsed < 0.5 * len(HOSTS))
+        self.assertTrue(is_local())
+
+    def testStoppedVMs(self):
+        '''VMs that aren't running are brought up one at a time, up front'''
+        self.context.halt(vm='db')
+        self.context.halt(vm='cache')
+        up, ups = self.context.up, []
+
+        def record_up(*args, **kwargs):
+            ups.append((kwargs.get('vm'), threading.current_thread()))
+            return up(*args, **kwargs)
+
+        self.context.up = record_up
+        results = self.context.execute_all(lambda: 'ok')
+        self.assertEqual(ups, [('db', threading.current_thread()),
+                               ('cache', threading.current_thread())])
+        self.assertEqual([result['result'] for result in results.values()],
+                         ['ok'] * len(HOSTS))
+
+    def testFailedUp(self):
+        '''A VM that fails to come up is reported, and the others still run'''
+        self.context.halt(vm='db')
+        self.context.halt(vm='cache')
+        up = self.context.up
+
+        def failing_up(*args, **kwargs):
+            if kwargs.get('vm') == 'db':
+                raise Exception('vagrant up db failed')
+            return up(*args, **kwargs)
+
+        self.context.up = failing_up
+        called = []
+        results = self.context.execute_all(
+            lambda: called.append(env.host_string) or 'ok')
+        self.assertEqual(sorted(results), sorted(HOSTS))
+        self.assertEqual(results['db']['result'], None)
+        self.assertTrue('vagrant up db failed' in results['db']['error'])
+        self.assertEqual(len(called), len(HOSTS) - 1)
+        self.assertEqual([results[vm]['result'] for vm in HOSTS
+                          if vm != 'db'], ['ok'] * (len(HOSTS) - 1))
+
+    def testErrors(self):
+        '''A failure on one VM doesn't stop the others'''
+        cache, db = self.host_string('cache'), self.host_string('db')
+
+        def work():
+            if env.host_string == cache:
+                raise ValueError('cache failed')
+            if env.host_string == db:
+                abort('db failed')
+            return 'ok'
+
+        vms = ['web1', 'db', 'cache']
+        with hide('aborts'):
+            results = self.context.execute_all(work, vms=vms, parallel=2)
+        self.assertEqual(sorted(results), sorted(vms))
+        self.assertEqual(results['web1']['result'], 'ok')
+        self.assertEqual(results['db']['result'], None)
+        self.assertTrue('SystemExit' in results['db']['error'])
+        self.assertTrue('cache failed' in results['cache']['error'])
+
+    def testRoles(self):
+        self.assertEqual(self.context.vms_with_roles('web', ROLEDEFS),
+                         ['web1', 'web2'])
+        self.assertEqual(self.context.vms_with_roles(['db', 'storage'],
+                                                     ROLEDEFS),
+                         ['db', 'cache'])
+        self.assertEqual(self.context.vms_with_roles('all', ROLEDEFS), HOSTS)
+        self.assertRaises(ValueError, self.context.vms_with_roles, 'mail',
+                          ROLEDEFS)
+
+        # Roles come from env.roledefs by default, as the CLI sets them
+        with settings(roledefs=ROLEDEFS):
+            results = VagrantBox(self.context, 'web1').execute_all(
+                lambda: None, roles='storage')
+        self.assertEqual(sorted(results), ['cache', 'db'])
+
+    def testNoVMs(self):
+        self.assertEqual(self.context.execute_all(lambda: None, vms=[]), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
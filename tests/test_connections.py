@@ -0,0 +1,133 @@
+'''
+Tests for reusing SSH connections to VMs, run against the stand-in vagrant and
+VBoxManage commands from the benchmark suite (see benchmarks/bin/fakebox.py).
+Fake connections are put in fabric's cache in place of real ones, so they
+don't need VirtualBox or an SSH server either.
+'''
+import os
+import subprocess
+import unittest
+
+from fabric.api import env
+from fabric.state import connections
+
+from basebox import vagrant
+from basebox.profile import count_commands
+from basebox.vagrant import VagrantContext
+from support import FakeboxTestCase
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient(object):
+    '''Stands in for the SSH client fabric caches per host string'''
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+
+        workdir = os.path.join(self.directory, 'box')
+        os.mkdir(workdir)
+        open(os.path.join(workdir, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\n'
+            '  config.vm.define :web\n'
+            '  config.vm.define :db\n'
+            'end\n')
+
+        self.context = VagrantContext(workdir)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        vagrant._connection_pool.clear()
+        super(TestConnectionPool, self).tearDown()
+
+    def connect(self, vm, **ssh_config_overrides):
+        '''
+        Enter and leave a connect() block, opening a fake connection if
+        there isn't one cached.  Returns the connection the block used.
+        '''
+        with self.context.connect(vm=vm, **ssh_config_overrides):
+            if env.host_string not in connections:
+                connections[env.host_string] = FakeClient()
+            return connections[env.host_string]
+
+    def testReuse(self):
+        client = self.connect('web')
+        self.assertTrue(self.connect('web') is client)
+        self.assertFalse(client.closed)
+        self.assertFalse(self.connect('db') is client)
+
+    def testSettingsChanged(self):
+        client = self.connect('web')
+        self.assertFalse(self.connect('web', identityfile='/tmp/key')
+                         is client)
+        self.assertTrue(client.closed)
+
+    def testDead(self):
+        client = self.connect('web')
+        client.transport.active = False
+        self.assertFalse(self.connect('web') is client)
+        self.assertTrue(client.closed)
+
+    def testIdle(self):
+        max_idle = vagrant._connection_pool.max_idle
+        client = self.connect('web')
+        try:
+            vagrant._connection_pool.max_idle = -1
+            self.assertFalse(self.connect('web') is client)
+        finally:
+            vagrant._connection_pool.max_idle = max_idle
+        self.assertTrue(client.closed)
+
+    def testInvalidate(self):
+        '''Changing a VM's state closes its connections, and only its'''
+        web, db = self.connect('web'), self.connect('db')
+        self.context.halt(vm='web')
+        self.assertTrue(web.closed)
+        self.assertFalse(db.closed)
+        self.assertTrue(self.connect('db') is db)
+
+        self.context.reload()
+        self.assertTrue(db.closed)
+
+    def testRebooted(self):
+        '''VMs rebooted outside of basebox have their SSH config reread'''
+        runfile = os.path.join(self.context.directory, '.vagrant')
+        os.utime(runfile, (1000000000, 1000000000))
+        self.connect('web')
+
+        # vagrant 1.0 may not rewrite the .vagrant file when rebooting
+        for command in ['halt', 'up']:
+            subprocess.check_call(['vagrant', command, 'web'],
+                                  cwd=self.context.directory,
+                                  stdout=open(os.devnull, 'w'))
+        os.utime(runfile, (1000000000, 1000000000))
+
+        with count_commands() as counter:
+            self.connect('web')
+        self.assertEqual(counter.count('vagrant ssh-config'), 1)
+        with count_commands() as counter:
+            self.connect('web')
+        self.assertEqual(counter.count('vagrant ssh-config'), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+'''
+Tests for the box download cache, run against a local HTTP server standing in
+for a box host.  Unlike the tests in all.py, these don't need vagrant or
+VirtualBox.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from basebox.download import DownloadCache
+from support import BoxServer
+
+
+class TestDownloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BoxServer('box contents ' * 1000)
+        self.url = self.server.url('test.box')
+        self.directory = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.directory)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def testDownload(self):
+        path = self.cache.fetch(self.url)
+        self.assertEqual(open(path).read(), self.server.content)
+        self.assertEqual(self.server.methods(), ['GET'])
+
+    def testRevalidate(self):
+        '''Unchanged files are reused after a conditional request'''
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.cache.fetch(self.url), path)
+        self.assertEqual(self.server.methods(), ['GET', 'HEAD'])
+
+    def testChanged(self):
+        '''Changed files are downloaded again'''
+        self.cache.fetch(self.url)
+        self.server.content = 'new box contents'
+        path = self.cache.fetch(self.url)
+        self.assertEqual(open(path).read(), 'new box contents')
+        self.assertEqual(self.server.methods(), ['GET', 'HEAD', 'GET'])
+
+    def testResume(self):
+        '''Interrupted downloads pick up where they left off'''
+        path = self.cache.fetch(self.url)
+        os.rename(path, path + '.part')
+        os.rename(path + '.json', path + '.part.json')
+        open(path + '.part', 'r+').truncate(100)
+
+        self.assertEqual(open(self.cache.fetch(self.url)).read(),
+                         self.server.content)
+        method, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('range'), 'bytes=100-')
+
+    def testIncomplete(self):
+        '''Downloads cut short by the server are resumed, not cached'''
+        self.server.truncate = 10
+        self.assertRaises(IOError, self.cache.fetch, self.url)
+        path = self.cache.path(self.url)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.path.getsize(path + '.part'), 10)
+
+        self.server.truncate = None
+        self.assertEqual(open(self.cache.fetch(self.url)).read(),
+                         self.server.content)
+        method, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('range'), 'bytes=10-')
+
+    def testInterruptedUpdate(self):
+        '''An interrupted download of a new version keeps the old one's
+        validators apart from it'''
+        path = self.cache.fetch(self.url)
+        old_etag = self.cache.version(self.url)
+
+        self.server.content = 'new box contents ' * 1000
+        self.server.truncate = 10
+        self.assertRaises(IOError, self.cache.fetch, self.url)
+        self.assertEqual(self.cache.version(self.url), old_etag)
+        self.assertEqual(open(path).read(), 'box contents ' * 1000)
+
+        self.server.truncate = None
+        self.assertEqual(open(self.cache.fetch(self.url)).read(),
+                         self.server.content)
+        self.assertEqual(self.cache.version(self.url), '"%s"' %
+                         hashlib.md5(self.server.content).hexdigest())
+        method, headers = self.server.requests[-1]
+        self.assertEqual(headers.get('range'), 'bytes=10-')
+
+    def testChecksum(self):
+        digest = hashlib.sha256(self.server.content).hexdigest()
+        self.cache.fetch(self.url, checksum=digest)
+        self.assertRaises(ValueError, self.cache.fetch, self.url,
+                          checksum='0' * 64)
+
+    def testVersion(self):
+        '''Cached files are identified by ETag, or failing that by digest'''
+        self.assertEqual(self.cache.version(self.url), None)
+        self.cache.fetch(self.url)
+        etag = '"%s"' % hashlib.md5(self.server.content).hexdigest()
+        self.assertEqual(self.cache.version(self.url), etag)
+
+        self.server.validators = False
+        self.server.content = 'new box contents'
+        self.cache.fetch(self.url)
+        self.assertEqual(self.cache.version(self.url), 'sha256:' +
+                         hashlib.sha256('new box contents').hexdigest())
+
+    def testEviction(self):
+        '''Least recently used files are evicted to stay within budget'''
+        self.cache.max_bytes = len(self.server.content) + 1
+        first = self.cache.fetch(self.url)
+        second = self.cache.fetch(self.url + '?v=2')
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def testEvictionInUse(self):
+        '''Files in use aren't evicted until they're done with'''
+        self.cache.max_bytes = len(self.server.content) + 1
+        with self.cache.fetched(self.url) as first:
+            self.cache.fetch(self.url + '?v=2')
+            self.assertTrue(os.path.exists(first))
+        self.cache.fetch(self.url + '?v=3')
+        self.assertFalse(os.path.exists(first))
+
+    def testNoValidators(self):
+        '''Files without validators are reused until their TTL runs out'''
+        self.server.validators = False
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.cache.fetch(self.url), path)
+        self.assertEqual(self.server.methods(), ['GET'])
+
+        self.cache.ttl = 0
+        self.server.content = 'new box contents'
+        self.assertEqual(open(self.cache.fetch(self.url)).read(),
+                         'new box contents')
+        self.assertEqual(self.server.methods(), ['GET', 'GET'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+Tests for gathering info on many VMs at once, run against the stand-in
+vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from basebox.profile import count_commands
+from basebox.vagrant import VagrantBox, VagrantContext, info_many
+from support import FakeboxTestCase
+
+
+class TestInfoMany(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestInfoMany, self).setUp()
+        self.contexts = []
+
+    def tearDown(self):
+        for context in self.contexts:
+            context.destroy(force=True)
+        super(TestInfoMany, self).tearDown()
+
+    def context(self, hosts):
+        workdir = tempfile.mkdtemp(dir=self.directory)
+        with open(os.path.join(workdir, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            for host in hosts:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+        context = VagrantContext(workdir)
+        self.contexts.append(context)
+        return context
+
+    def testFields(self):
+        context = self.context(['web', 'db', 'cache'])
+        context.up(vm='web')
+        context.up(vm='db')
+        context.halt(vm='db')
+
+        info = info_many([context], fields=['status', 'uuid', 'ssh_config',
+                                            'vm'])
+        self.assertEqual(sorted(info), [(context.directory, 'cache'),
+                                        (context.directory, 'db'),
+                                        (context.directory, 'web')])
+        web = info[(context.directory, 'web')]
+        self.assertEqual(web['status'], 'running')
+        self.assertEqual(web['uuid'], context.uuid(vm='web'))
+        self.assertEqual(web['vm']['UUID'], web['uuid'])
+        self.assertTrue('port' in web)
+        self.assertEqual(web['errors'], {})
+        self.assertFalse('home' in web)
+
+        # VMs that aren't running aren't connected to, or created
+        db = info[(context.directory, 'db')]
+        self.assertEqual(db['status'], 'poweroff')
+        self.assertFalse('port' in db)
+        cache = info[(context.directory, 'cache')]
+        self.assertEqual((cache['uuid'], cache['vm']), (None, None))
+
+    def testTargets(self):
+        web = self.context(['web'])
+        db = self.context(['db1', 'db2'])
+        info = info_many([VagrantBox(web, 'web'), db.directory],
+                         fields=['home'])
+        self.assertEqual(sorted(info), sorted([(db.directory, 'db1'),
+                                               (db.directory, 'db2'),
+                                               (web.directory, 'web')]))
+        self.assertEqual(info[(web.directory, 'web')]['home'], web.directory)
+
+    def testOneStatus(self):
+        '''Contexts without a state cache are asked for status once'''
+        context = self.context(['web', 'db', 'cache'])
+        context.state.enabled = False
+        boxes = [VagrantBox(context, name) for name in ['web', 'db', 'cache']]
+        with count_commands() as counter:
+            info_many(boxes, fields=['status'])
+        self.assertEqual(counter.count('vagrant status'), 1)
+
+    def testUnreadableRunfile(self):
+        context = self.context(['web'])
+        open(os.path.join(context.directory, '.vagrant'), 'w').write('{')
+        info = info_many([context], fields=['uuid', 'vm'])
+        web = info[(context.directory, 'web')]
+        self.assertEqual((web['uuid'], web['vm']), (None, None))
+        self.assertTrue('ValueError' in web['errors']['uuid'])
+
+    def testUnknownField(self):
+        self.assertRaises(ValueError, info_many, [], fields=['color'])
+
+    def testParallel(self):
+        '''Probes run at most `parallel` (by default, CPUs) at a time'''
+        os.environ['FAKEBOX_LATENCY_VBOXMANAGE_SHOWVMINFO'] = '0.3'
+        hosts = ['vm%d' % idx
+                 for idx in range(multiprocessing.cpu_count() + 1)]
+        context = self.context(hosts)
+        context.up()
+
+        start = time.time()
+        info = info_many([context], fields=['vm'])
+        self.assertTrue(time.time() - start >= 0.6)
+        self.assertTrue(all(vm['vm'] for vm in info.values()))
+
+        context.state.invalidate(keep=('uuid',))
+        start = time.time()
+        info_many([context], fields=['vm'], parallel=1)
+        self.assertTrue(time.time() - start >= 0.3 * len(hosts))
+
+
+class TestIP(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestIP, self).setUp()
+        os.environ['FAKEBOX_GUEST_ADDRESSES'] = (
+            'lo=127.0.0.1 eth0=10.0.2.15 eth1=192.168.33.10 '
+            'eth1=192.168.33.11')
+
+        open(os.path.join(self.directory, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\nend\n')
+        self.context = VagrantContext(self.directory)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestIP, self).tearDown()
+
+    def testSameAddress(self):
+        '''Cold and cached lookups pick an interface's first address'''
+        for iface in ['eth1', None]:
+            self.context.state.invalidate(keep=('uuid',))
+            cold = self.context.ip(iface=iface, method='guestproperty')
+            warm = self.context.ip(iface=iface, method='guestproperty')
+            self.assertEqual((cold, warm), ('192.168.33.10', '192.168.33.10'))
+        self.assertEqual(self.context.ip(iface='eth2', method='guestproperty'),
+                         None)
+
+
+if __name__ == "__main__":
+    unittest.main()
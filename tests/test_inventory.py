@@ -0,0 +1,115 @@
+'''
+Tests for the multi-context inventory, run against the stand-in vagrant and
+VBoxManage commands from the benchmark suite (see benchmarks/bin/fakebox.py),
+so they don't need VirtualBox.
+'''
+import os
+import unittest
+
+from basebox.inventory import discover, inventory
+from basebox.profile import count_commands
+from basebox.vagrant import VagrantContext, read_runfile
+from support import FAKE_BIN, FakeboxTestCase
+
+
+class TestInventory(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestInventory, self).setUp()
+
+        # Two contexts under one root (plus a hidden one that's skipped), and
+        # one under another
+        self.root = os.path.join(self.directory, 'builds')
+        self.web = self.context('builds/web', ['web1', 'web2'])
+        self.db = self.context('builds/nested/db', [])
+        self.context('builds/.hidden', [])
+        self.other = self.context('other', [])
+
+    def tearDown(self):
+        for directory in [self.web, self.db]:
+            VagrantContext(directory).destroy(force=True)
+        super(TestInventory, self).tearDown()
+
+    def context(self, path, hosts):
+        directory = os.path.join(self.directory, path)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            for host in hosts:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+        return directory
+
+    def testDiscover(self):
+        self.assertEqual(discover([self.root]), sorted([self.web, self.db]))
+        self.assertEqual(discover([self.root, self.other]),
+                         sorted([self.web, self.db, self.other]))
+
+    def testInventory(self):
+        VagrantContext(self.web).up(vm='web1')
+        VagrantContext(self.db).up()
+        VagrantContext(self.db).halt()
+
+        with count_commands() as counter:
+            table = inventory(discover([self.root]))
+        counter.assert_at_most(1)
+
+        self.assertEqual(sorted(table), [(self.db, 'default'),
+                                         (self.web, 'web1'),
+                                         (self.web, 'web2')])
+        self.assertEqual(table[(self.web, 'web1')]['status'], 'running')
+        self.assertEqual(table[(self.web, 'web2')]['status'], 'not created')
+        self.assertEqual(table[(self.web, 'web2')]['uuid'], None)
+        self.assertEqual(table[(self.db, 'default')]['status'], 'poweroff')
+
+        vm = table[(self.web, 'web1')]['vm']
+        self.assertEqual(vm['UUID'], table[(self.web, 'web1')]['uuid'])
+        self.assertEqual(vm['memory'], '512')
+        self.assertEqual(vm['nic1'], 'nat')
+
+    def testVagrantDirectory(self):
+        '''UUIDs are read from vagrant 1.1+'s .vagrant directory too'''
+        VagrantContext(self.other).up()
+
+        # Move the VM's UUID to where later versions of vagrant keep it
+        runfile = os.path.join(self.other, '.vagrant')
+        uuid = read_runfile(runfile)['default']
+        os.unlink(runfile)
+        id_dir = os.path.join(runfile, 'machines', 'default', 'virtualbox')
+        os.makedirs(id_dir)
+        open(os.path.join(id_dir, 'id'), 'w').write(uuid)
+
+        with count_commands() as counter:
+            table = inventory([self.web, self.other])
+        counter.assert_at_most(1)
+        counter.assert_at_most(0, 'vagrant')
+        self.assertEqual(table[(self.other, 'default')]['uuid'], uuid)
+        self.assertEqual(table[(self.other, 'default')]['status'], 'running')
+        self.assertEqual(table[(self.web, 'web1')]['status'], 'not created')
+
+    def testUnreadable(self):
+        '''Contexts vagrant can't describe don't stop the others'''
+        open(os.path.join(self.db, '.vagrant'), 'w').write('{')
+
+        # Without vagrant on the PATH, asking it about db fails
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join(
+            entry for entry in path.split(os.pathsep) if entry != FAKE_BIN)
+        try:
+            table = inventory([self.web, self.db])
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(table[(self.web, 'web1')]['status'], 'not created')
+        self.assertEqual(table[(self.web, 'web1')]['error'], None)
+        self.assertEqual(table[(self.db, None)]['status'], None)
+        self.assertTrue(table[(self.db, None)]['error'])
+
+    def testNothingCreated(self):
+        with count_commands() as counter:
+            table = inventory([self.web])
+        counter.assert_at_most(0)
+        self.assertEqual(len(table), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
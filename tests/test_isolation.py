@@ -0,0 +1,149 @@
+'''
+Tests for per-thread views of fabric's env.  The connection tests run against
+the stand-in vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+from cuisine import is_local
+from fabric.api import cd, env, settings
+
+from basebox.util import isolated_env, shell_env
+from basebox.vagrant import VagrantContext
+from support import FakeboxTestCase
+
+
+def in_threads(func, args):
+    '''Run func(arg) for each of `args` at once, returning the results.'''
+    results = {}
+    barrier = threading.Semaphore(0)
+
+    def target(arg):
+        try:
+            results[arg] = func(arg, barrier)
+        except Exception as e:
+            results[arg] = e
+
+    threads = [threading.Thread(target=target, args=(arg,)) for arg in args]
+    for thread in threads:
+        thread.start()
+    for _ in args:
+        barrier.release()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Reports the class of fabric's env after importing basebox, and after
+# isolated_env() is first used
+OPT_IN_SCRIPT = '''
+from fabric.api import env
+import basebox.build, basebox.vagrant
+from basebox.util import isolated_env
+print type(env).__name__
+with isolated_env():
+    pass
+print type(env).__name__
+'''
+
+
+class TestIsolatedEnv(unittest.TestCase):
+
+    def testOptIn(self):
+        '''Fabric's env is left alone until isolated_env() is used'''
+        process = subprocess.Popen([sys.executable, '-c', OPT_IN_SCRIPT],
+                                   cwd=ROOT, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(output.split(), ['_AttributeDict', '_ThreadLocalEnv'])
+
+    def testOverlay(self):
+        shell = env.shell
+        with isolated_env(host_string='web'):
+            self.assertEqual(env.host_string, 'web')
+            env.basebox_test = 1
+            with settings(user='deploy'), cd('/srv'):
+                self.assertEqual(env.user, 'deploy')
+            self.assertTrue('basebox_test' in env)
+            self.assertTrue('basebox_test' in env.keys())
+            del env['shell']
+            self.assertFalse('shell' in env)
+            self.assertEqual(env.get('shell'), None)
+
+            with isolated_env():
+                env.basebox_test = 2
+            self.assertEqual(env.basebox_test, 1)
+            self.assertEqual(env.copy(), dict(env.items()))
+
+        self.assertNotEqual(env.host_string, 'web')
+        self.assertFalse('basebox_test' in env)
+        self.assertEqual(env.shell, shell)
+
+    def testThreads(self):
+        '''Each thread sees only its own changes'''
+        def work(name, barrier):
+            with isolated_env(host_string=name), shell_env(VM=name):
+                barrier.acquire()
+                with cd('/home/%s' % name):
+                    return env.host_string, env.shell.split()[0], env.cwd
+
+        results = in_threads(work, ['web', 'db', 'cache'])
+        for name in ['web', 'db', 'cache']:
+            self.assertEqual(results[name],
+                             (name, 'VM=%s' % name, '/home/%s' % name))
+        self.assertFalse(env.shell.startswith('VM='))
+
+
+class TestConnections(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestConnections, self).setUp()
+
+        workdir = os.path.join(self.directory, 'box')
+        os.mkdir(workdir)
+        open(os.path.join(workdir, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\n'
+            '  config.vm.define :web\n'
+            '  config.vm.define :db\n'
+            'end\n')
+
+        self.context = VagrantContext(workdir)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestConnections, self).tearDown()
+
+    def host_string(self, vm, port):
+        return 'vagrant@vagrant-temporary-%s:%s' % (self.context.uuid(vm=vm),
+                                                    port)
+
+    def testConnect(self):
+        '''Connection settings apply on entry, and only in this thread'''
+        host_string = env.host_string
+        manager = self.context.connect(vm='web')
+        self.assertEqual(env.host_string, host_string)
+        with manager:
+            self.assertEqual(env.host_string, self.host_string('web', 2200))
+            self.assertFalse(is_local())
+        self.assertEqual(env.host_string, host_string)
+        self.assertTrue(is_local())
+
+    def testConcurrentConnect(self):
+        def connect(vm, barrier):
+            with self.context.connect(vm=vm):
+                barrier.acquire()
+                return env.host_string
+
+        self.assertEqual(in_threads(connect, ['web', 'db']),
+                         {'web': self.host_string('web', 2200),
+                          'db': self.host_string('db', 2201)})
+
+
+if __name__ == "__main__":
+    unittest.main()
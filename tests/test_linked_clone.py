@@ -0,0 +1,101 @@
+'''
+Tests for building in linked clones of a master VM, run against the stand-in
+vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import fcntl
+import os
+import threading
+import time
+import unittest
+
+from cuisine import run
+
+from basebox.build import (MASTER_SNAPSHOT, ensure_master, reap_masters,
+    tempbox)
+from basebox.util import isolated_env
+from basebox.vagrant import (VagrantContext, add_box, read_runfile,
+    remove_box)
+from support import FakeboxTestCase
+
+BASE_BOX = 'linked-base'
+
+
+class TestLinkedClone(FakeboxTestCase):
+
+    hidden = ('running', 'stdout', 'stderr', 'warnings')
+
+    def setUp(self):
+        super(TestLinkedClone, self).setUp()
+        add_box(BASE_BOX, os.path.join(self.directory, 'base.box'))
+
+    def vms(self):
+        return [line.split('"')[1] for line in
+                run('VBoxManage list vms').splitlines() if line.strip()]
+
+    def mac(self, vm):
+        for line in run('VBoxManage showvminfo %s --machinereadable' %
+                        vm).splitlines():
+            if line.startswith('macaddress1='):
+                return line.split('"')[1]
+
+    def readd(self):
+        '''Re-add the base box, as a newer version of it'''
+        remove_box(BASE_BOX)
+        time.sleep(0.01)
+        add_box(BASE_BOX, os.path.join(self.directory, 'base.box'))
+
+    def testKeepsMacs(self):
+        '''Clones keep the master's MAC address, which the box expects'''
+        with tempbox(base=BASE_BOX, linked_clone=True) as box:
+            box.up()
+            master = ensure_master(BASE_BOX)
+            self.assertEqual(self.mac(box.uuid()), self.mac(master))
+
+    def testRunfileLock(self):
+        '''Clones are registered under the lock vagrant 1.0 ups take'''
+        open(os.path.join(self.directory, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\nend\n')
+        context = VagrantContext(self.directory)
+        master = ensure_master(BASE_BOX)
+        runfile = os.path.join(self.directory, '.vagrant')
+
+        uuids = []
+        def clone():
+            with isolated_env():
+                uuids.append(context.link_clone(master, MASTER_SNAPSHOT))
+        thread = threading.Thread(target=clone)
+
+        with open(runfile + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            thread.start()
+            thread.join(1)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(read_runfile(runfile), {})
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        thread.join()
+        self.assertEqual(read_runfile(runfile), {'default': uuids[0]})
+
+    def testReapMasters(self):
+        '''Masters of re-added or removed boxes are deleted'''
+        master = ensure_master(BASE_BOX)
+        self.readd()
+        fresh = ensure_master(BASE_BOX)
+        self.assertNotEqual(fresh, master)
+        self.assertEqual([vm for vm in self.vms()
+                          if vm.startswith('basebox-master-')], [fresh])
+
+        # Masters are kept while linked clones depend on them
+        run('VBoxManage clonevm %s --snapshot %s --options link '
+            '--name clone --register' % (fresh, MASTER_SNAPSHOT))
+        remove_box(BASE_BOX)
+        reap_masters()
+        self.assertTrue(fresh in self.vms())
+
+        run('VBoxManage unregistervm clone --delete')
+        reap_masters()
+        self.assertEqual(self.vms(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
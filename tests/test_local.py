@@ -0,0 +1,72 @@
+'''
+Tests for running commands locally through cuisine's mode_local (see
+basebox.monkey).  Like test_download.py, these don't need vagrant or
+VirtualBox.
+'''
+import StringIO
+import sys
+import unittest
+
+from cuisine import mode_local, run
+from fabric.api import hide, settings, show
+
+from basebox.monkey import _execute_local
+
+
+class TestExecuteLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.mode = mode_local()
+        self.hide = hide('running', 'stdout', 'stderr')
+        self.hide.__enter__()
+
+    def tearDown(self):
+        self.hide.__exit__(None, None, None)
+        self.mode.__exit__(None, None, None)
+
+    def testOutput(self):
+        result = run('printf "one\\ntwo\\n"')
+        self.assertEqual(result, 'one\ntwo')
+        self.assertTrue(result.succeeded)
+        self.assertEqual(result.return_code, 0)
+
+    def testStderr(self):
+        command = 'echo out; echo err >&2'
+        self.assertEqual(_execute_local(command, combine_stderr=False),
+                         ('out', 'err', 0))
+        out, err, status = _execute_local(command, combine_stderr=True)
+        self.assertEqual(sorted(out.splitlines()), ['err', 'out'])
+        self.assertEqual(err, '')
+
+    def testFailure(self):
+        with settings(warn_only=True):
+            result = run('echo partial; exit 3')
+        self.assertEqual(result, 'partial')
+        self.assertTrue(result.failed)
+        self.assertEqual(result.return_code, 3)
+
+    def testLargeOutput(self):
+        '''Output bigger than a pipe's buffer, on both pipes, can't deadlock'''
+        command = ('head -c 200000 /dev/zero | tr "\\0" x; '
+                   'head -c 200000 /dev/zero | tr "\\0" y >&2')
+        out, err, status = _execute_local(command, combine_stderr=False)
+        self.assertEqual((len(out), len(err), status), (200000, 200000, 0))
+
+    def testEcho(self):
+        '''
+        Output is echoed line by line with fabric's prefixes, ending with a
+        newline even if the output doesn't
+        '''
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            with show('stdout'), settings(host_string='box'):
+                _execute_local('printf "one\\ntwo"')
+            echoed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(echoed, '[box] out: one\n[box] out: two\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+'''
+Tests for the box archive writer, which like test_download.py don't need
+vagrant or VirtualBox, and for packaging a context's VM, which run against
+the stand-in vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py).
+'''
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from basebox import vagrant
+from basebox.build import install_box_file
+from basebox.package import write_box
+from basebox.profile import count_commands
+from basebox.vagrant import VagrantContext, installed_boxes
+from support import FakeboxTestCase
+
+
+class TestWriteBox(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.disk = os.path.join(self.directory, 'box-disk1.vmdk')
+        open(self.disk, 'w').write(os.urandom(100000) + '\0' * 5000000)
+        self.output = os.path.join(self.directory, 'package.box')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def contents(self, mode):
+        archive = tarfile.open(self.output, mode)
+        return dict((member.name, archive.extractfile(member).read())
+                    for member in archive.getmembers())
+
+    def write(self, **options):
+        write_box(self.output,
+                  files=[('box-disk1.vmdk', self.disk)],
+                  contents=[('Vagrantfile', 'Vagrant::Config.run {}')],
+                  **options)
+
+    def testPlain(self):
+        self.write()
+        self.assertEqual(self.contents('r:'), {
+            'box-disk1.vmdk': open(self.disk).read(),
+            'Vagrantfile': 'Vagrant::Config.run {}'})
+        self.assertFalse(os.path.exists(self.output + '.part'))
+
+    def testGzip(self):
+        '''Blocks compressed in parallel make a single readable archive'''
+        self.write(compression='gzip', threads=3, block_size=1024 * 1024)
+        self.assertEqual(self.contents('r:gz'), {
+            'box-disk1.vmdk': open(self.disk).read(),
+            'Vagrantfile': 'Vagrant::Config.run {}'})
+        self.assertTrue(os.path.getsize(self.output) <
+                        os.path.getsize(self.disk) / 2)
+
+    def testUnknownCompression(self):
+        self.assertRaises(ValueError, self.write, compression='rar')
+        self.assertFalse(os.path.exists(self.output + '.part'))
+
+
+class TestPackage(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestPackage, self).setUp()
+        open(os.path.join(self.directory, 'Vagrantfile'), 'w').write(
+            'Vagrant::Config.run do |config|\nend\n')
+        self.context = VagrantContext(self.directory)
+        self.context.up()
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestPackage, self).tearDown()
+
+    def package(self, **options):
+        with count_commands() as counter:
+            self.context.package(**options)
+        return (counter.count('vagrant package'),
+                counter.count('VBoxManage export'))
+
+    def box_adds(self, install, *args, **kwargs):
+        with count_commands() as counter:
+            install(*args, **kwargs)
+        vagrant._box_registry.invalidate()
+        self.assertTrue('built' in installed_boxes())
+        return counter.count('vagrant box add')
+
+    def testVagrantByDefault(self):
+        self.assertEqual(self.package(output='vagrant.box'), (1, 0))
+        self.assertEqual(self.package(output='native.box', native=True),
+                         (0, 1))
+        for name in ['vagrant.box', 'native.box']:
+            self.assertTrue(os.path.isfile(os.path.join(self.directory,
+                                                        name)))
+
+    def testCompressionNeedsNative(self):
+        self.assertRaises(ValueError, self.context.package,
+                          output='package.box', compression='gzip')
+
+    def testDirectInstall(self):
+        '''Natively packaged boxes are moved into place with vagrant 1.0'''
+        self.assertEqual(self.box_adds(self.context.package, native=True,
+                                       install_as='built'), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     'package.box')))
+
+    def testNewerVagrantInstall(self):
+        '''Newer versions of vagrant get boxes through `vagrant box add`'''
+        os.environ['FAKEBOX_VAGRANT_VERSION'] = '1.2.2'
+        self.assertEqual(self.box_adds(self.context.package, native=True,
+                                       install_as='built'), 1)
+
+    def testInstallBoxFile(self):
+        '''Box files are only installed directly when asked to'''
+        box_file = os.path.join(self.directory, 'package.box')
+        self.context.package(output='package.box')
+        self.assertEqual(self.box_adds(install_box_file, box_file,
+                                       install_as='built'), 1)
+        self.assertEqual(self.box_adds(install_box_file, box_file,
+                                       install_as='built', direct=True), 0)
+
+        vagrant._vagrant_version = None
+        os.environ['FAKEBOX_VAGRANT_VERSION'] = '1.2.2'
+        self.assertEqual(self.box_adds(install_box_file, box_file,
+                                       install_as='built', direct=True), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
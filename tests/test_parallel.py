@@ -0,0 +1,92 @@
+'''
+Tests for running work in forked worker processes, and for booting a
+context's VMs with it.  The boot tests run against the stand-in vagrant and
+VBoxManage commands from the benchmark suite (see benchmarks/bin/fakebox.py),
+so they don't need VirtualBox.
+'''
+import os
+import time
+import unittest
+
+from fabric.api import abort, hide
+
+from basebox.cli import boot_boxes
+from basebox.parallel import parallel_map
+from basebox.vagrant import VagrantContext, read_runfile
+from support import FakeboxTestCase
+
+
+def double(x):
+    return x * 2
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def testResults(self):
+        self.assertEqual(parallel_map(double, [1, 2, 3]),
+                         [(1, 2, None), (2, 4, None), (3, 6, None)])
+
+    def testErrors(self):
+        def work(x):
+            if x == 2:
+                raise ValueError('two failed')
+            if x == 3:
+                abort('three failed')
+            return x
+
+        with hide('aborts'):
+            results = parallel_map(work, [1, 2, 3])
+        self.assertEqual(results[0], (1, 1, None))
+        self.assertEqual(results[1][1], None)
+        self.assertTrue('two failed' in results[1][2])
+        self.assertTrue('SystemExit' in results[2][2])
+
+    def testPoolSize(self):
+        start = time.time()
+        parallel_map(time.sleep, [0.3] * 4, pool_size=2)
+        self.assertTrue(time.time() - start >= 0.6)
+
+    def testWorkerDied(self):
+        results = parallel_map(os._exit, [3])
+        self.assertEqual(results, [(3, None, 'Worker exited with code 3')])
+
+
+class TestBootBoxes(FakeboxTestCase):
+
+    hosts = ['web', 'db', 'cache']
+
+    def setUp(self):
+        super(TestBootBoxes, self).setUp()
+        os.environ['FAKEBOX_LATENCY_VAGRANT_UP'] = '0.3'
+
+        self.workdir = os.path.join(self.directory, 'box')
+        os.mkdir(self.workdir)
+        with open(os.path.join(self.workdir, 'Vagrantfile'), 'w') as f:
+            f.write('Vagrant::Config.run do |config|\n')
+            for host in self.hosts:
+                f.write('  config.vm.define :%s\n' % host)
+            f.write('end\n')
+
+        self.context = VagrantContext(self.workdir)
+
+    def tearDown(self):
+        self.context.destroy(force=True)
+        super(TestBootBoxes, self).tearDown()
+
+    def testParallel(self):
+        '''vagrant 1.0 ups in one context don't overlap, or lose VMs'''
+        start = time.time()
+        booted = dict(boot_boxes(self.context, parallel=0))
+        self.assertTrue(time.time() - start >= 0.3 * len(self.hosts))
+
+        self.assertEqual(sorted(booted), sorted(self.hosts))
+        self.assertEqual(len(set(ssh_config['port']
+                                 for ssh_config in booted.values())),
+                         len(self.hosts))
+        machines = read_runfile(os.path.join(self.workdir, '.vagrant'))
+        self.assertEqual(sorted(machines), sorted(self.hosts))
+        self.assertEqual(len(set(machines.values())), len(self.hosts))
+
+
+if __name__ == "__main__":
+    unittest.main()
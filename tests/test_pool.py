@@ -0,0 +1,172 @@
+'''
+Tests for the pool of temporarily installed base boxes, run against the
+stand-in vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.  Boxes at URLs are
+served by a local HTTP server.
+'''
+import multiprocessing
+import os
+import time
+import unittest
+
+from cuisine import mode_local
+from fabric.api import hide
+
+from basebox.build import Base
+from basebox.pool import BoxPool
+from basebox.vagrant import add_box, installed_boxes
+from support import BoxServer, FakeboxTestCase
+
+
+def slow_install(name):
+    '''Install a box slowly, recording that it was installed.'''
+    time.sleep(0.2)
+    add_box(name, name)
+    with open(os.path.join(os.environ['BASEBOX_CACHE_DIR'], 'installs'),
+              'a') as f:
+        f.write(name + '\n')
+
+
+def acquire(source):
+    with mode_local(), hide('running', 'stdout'):
+        BoxPool().acquire(source, 'base', slow_install)
+
+
+class TestBoxPool(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestBoxPool, self).setUp()
+        for var in ['FAKEBOX_HOME', 'VAGRANT_HOME', 'BASEBOX_CACHE_DIR']:
+            os.makedirs(os.environ[var])
+
+        self.pool = BoxPool()
+        self.installs = []
+
+    def install(self, name):
+        self.installs.append(name)
+        add_box(name, name)
+
+    def testRefcount(self):
+        '''Boxes are installed once, and kept while they're in use'''
+        self.pool.max_age = 0
+        name = self.pool.acquire('source', 'base', self.install)
+        self.assertEqual(self.pool.acquire('source', 'base', self.install),
+                         name)
+        self.assertEqual(self.installs, [name])
+
+        self.pool.release('source')
+        self.assertTrue(name in installed_boxes())
+        self.pool.release('source')
+        self.assertFalse(name in installed_boxes())
+
+    def testDeadProcess(self):
+        '''References held by processes that died don't keep boxes'''
+        process = multiprocessing.Process(target=acquire, args=('source',))
+        process.start()
+        process.join()
+        name = self.pool.name('source', 'base')
+        self.assertTrue(name in installed_boxes())
+
+        self.pool.max_age = 0
+        self.pool.reap()
+        self.assertFalse(name in installed_boxes())
+
+    def testLock(self):
+        '''Concurrent builds install a box only once'''
+        processes = [multiprocessing.Process(target=acquire, args=('source',))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        installs = open(os.path.join(os.environ['BASEBOX_CACHE_DIR'],
+                                     'installs')).read().split()
+        self.assertEqual(installs, [self.pool.name('source', 'base')])
+
+    def testLostState(self):
+        '''Boxes installed before the pool's state was lost are adopted'''
+        name = self.pool.acquire('source', 'base', self.install)
+        self.pool.release('source')
+        os.unlink(self.pool.path)
+
+        self.assertEqual(self.pool.acquire('source', 'base', self.install),
+                         name)
+        self.assertEqual(self.installs, [name])
+
+        self.pool.max_age = 0
+        self.pool.release('source')
+        self.assertFalse(name in installed_boxes())
+
+    def testInstalledMeanwhile(self):
+        '''Boxes installed by another build are adopted, even if the boxes
+        directory's mtime didn't change'''
+        boxes_dir = os.path.join(os.environ['VAGRANT_HOME'], 'boxes')
+        os.makedirs(boxes_dir)
+        installed_boxes()
+        st = os.stat(boxes_dir)
+        name = self.pool.name('source', 'base')
+        os.makedirs(os.path.join(boxes_dir, name))
+        os.utime(boxes_dir, (st.st_atime, st.st_mtime))
+
+        self.assertEqual(self.pool.acquire('source', 'base', self.install),
+                         name)
+        self.assertEqual(self.installs, [])
+
+    def testMaxAge(self):
+        name = self.pool.acquire('source', 'base', self.install)
+        self.pool.release('source')
+        self.assertTrue(name in installed_boxes())
+        self.pool.max_age = 0
+        self.pool.reap()
+        self.assertFalse(name in installed_boxes())
+
+    def testByteBudget(self):
+        '''Unused boxes are reaped least recently used first'''
+        first = self.pool.acquire('first', 'base', self.install)
+        second = self.pool.acquire('second', 'base', self.install)
+        self.pool.max_bytes = vagrant_box_size(first)
+        self.pool.release('first')
+        time.sleep(0.01)
+        self.pool.release('second')
+        self.assertEqual([name in installed_boxes()
+                          for name in (first, second)], [False, True])
+
+
+def vagrant_box_size(name):
+    box_dir = os.path.join(os.environ['VAGRANT_HOME'], 'boxes', name)
+    return sum(os.path.getsize(os.path.join(box_dir, filename))
+               for filename in os.listdir(box_dir))
+
+
+class TestPooledURL(FakeboxTestCase):
+
+    def setUp(self):
+        self.server = BoxServer('box contents')
+        self.url = self.server.url('base.box')
+
+        super(TestPooledURL, self).setUp()
+
+    def tearDown(self):
+        self.server.stop()
+        super(TestPooledURL, self).tearDown()
+
+    def ensure(self):
+        base = Base(self.url)
+        base.ensure()
+        base.clean()
+        return base.name
+
+    def testRevalidate(self):
+        '''Pooled boxes are revalidated, and changed ones pooled afresh'''
+        name = self.ensure()
+        self.assertEqual(self.ensure(), name)
+        self.assertTrue('HEAD' in self.server.methods()[1:])
+
+        self.server.content = 'new box contents'
+        changed = self.ensure()
+        self.assertNotEqual(changed, name)
+        self.assertTrue(changed in installed_boxes())
+
+
+if __name__ == "__main__":
+    unittest.main()
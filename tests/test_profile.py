@@ -0,0 +1,113 @@
+'''
+Tests for the command profiler.  Like test_download.py, these don't need
+vagrant or VirtualBox.
+'''
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from basebox.profile import (classify, count_commands, instrument, phase,
+    phased, profiling)
+
+
+class Result(str):
+    return_code = 0
+
+
+@instrument
+def run(command):
+    return Result('output of %s' % command)
+
+
+@instrument
+def nested_run(command):
+    return run(command)
+
+
+@phased('up')
+def up(vm=None):
+    run('vagrant up %s' % vm)
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trace.json')
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def events(self):
+        return json.load(open(self.path))['traceEvents']
+
+    def testRecord(self):
+        with profiling(self.path):
+            with phase('build'):
+                up(vm='web')
+            nested_run('VBoxManage list vms')
+
+        commands = [e for e in self.events() if e['cat'] == 'command']
+        self.assertEqual([e['name'] for e in commands],
+                         ['vagrant up', 'VBoxManage list'])
+        self.assertEqual(commands[0]['args']['phase'], 'up')
+        self.assertEqual(commands[0]['args']['vm'], 'web')
+        self.assertEqual(commands[0]['args']['exit_code'], 0)
+        self.assertEqual(commands[0]['args']['output_bytes'],
+                         len('output of vagrant up web'))
+
+        phases = [e['name'] for e in self.events() if e['cat'] == 'phase']
+        self.assertEqual(phases, ['up', 'build'])
+        self.assertTrue('vagrant up' in sys.stdout.getvalue())
+
+    def testInactive(self):
+        '''Nothing is recorded without an active profiler'''
+        up(vm='web')
+        with profiling(None) as profiler:
+            up(vm='web')
+        self.assertEqual(profiler, None)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testClassify(self):
+        self.assertEqual(classify('vagrant box add x x.box'), 'vagrant box add')
+        self.assertEqual(classify('VBoxManage showvminfo abc'),
+                         'VBoxManage showvminfo')
+        self.assertEqual(classify('/bin/rm -rf /tmp/x'), 'rm')
+
+
+class TestCountCommands(unittest.TestCase):
+
+    def testCount(self):
+        with count_commands() as counter:
+            up(vm='web')
+            nested_run('VBoxManage list vms')
+            run('VBoxManage showvminfo web')
+        run('vagrant halt')
+
+        self.assertEqual(counter.count(), 3)
+        self.assertEqual(counter.count('VBoxManage'), 2)
+        self.assertEqual(counter.count('vagrant up'), 1)
+        self.assertEqual(counter.count('vagrant halt'), 0)
+        self.assertEqual(counter.counts(), {'vagrant up': 1,
+                                            'VBoxManage list': 1,
+                                            'VBoxManage showvminfo': 1})
+
+    def testBudget(self):
+        with count_commands() as counter:
+            up(vm='web')
+            up(vm='db')
+        counter.assert_at_most(2)
+        counter.assert_at_most(0, 'VBoxManage')
+        self.assertRaises(AssertionError, counter.assert_at_most, 1)
+        self.assertRaises(AssertionError, counter.assert_at_most, 1,
+                          'vagrant')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+Tests for the in-process registry of installed boxes, run against the
+stand-in vagrant command from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need vagrant.
+'''
+import os
+import time
+import unittest
+
+from basebox import vagrant
+from basebox.profile import count_commands
+from basebox.vagrant import add_box, installed_boxes, remove_box
+from support import FakeboxTestCase
+
+
+class TestBoxRegistry(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestBoxRegistry, self).setUp()
+        self.boxes_dir = os.path.join(os.environ['VAGRANT_HOME'], 'boxes')
+
+    def install(self, dirname):
+        '''Install a box behind basebox's back, as vagrant would'''
+        os.makedirs(os.path.join(self.boxes_dir, dirname))
+
+        # Make sure the change shows even with coarse mtimes
+        mtime = time.time() + 10
+        os.utime(self.boxes_dir, (mtime, mtime))
+
+    def testNothingInstalled(self):
+        with count_commands() as counter:
+            self.assertEqual(installed_boxes(), [])
+        counter.assert_at_most(0)
+
+    def testScan(self):
+        '''Boxes are read from the box directory, without vagrant'''
+        self.install('precise64')
+        self.install('hashicorp-VAGRANTSLASH-precise32')
+        self.install('.basebox-install-abc123')
+        open(os.path.join(self.boxes_dir, 'notes.txt'), 'w').close()
+
+        with count_commands() as counter:
+            self.assertEqual(installed_boxes(),
+                             ['hashicorp/precise32', 'precise64'])
+        counter.assert_at_most(0)
+
+    def testRefresh(self):
+        '''Boxes installed outside of basebox are picked up'''
+        self.install('precise64')
+        self.assertEqual(installed_boxes(), ['precise64'])
+        self.install('lucid32')
+        self.assertEqual(installed_boxes(), ['lucid32', 'precise64'])
+
+    def testAddRemove(self):
+        self.assertEqual(installed_boxes(), [])
+        add_box('sample', 'http://example.com/sample.box')
+        self.assertEqual(installed_boxes(), ['sample'])
+        remove_box('sample')
+        self.assertEqual(installed_boxes(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
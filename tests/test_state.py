@@ -0,0 +1,103 @@
+'''
+Tests for the per-context state cache.  Like test_download.py, these don't
+need vagrant or VirtualBox.
+'''
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from basebox.state import ContextState
+
+
+class TestContextState(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = ContextState(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_runfile(self, mtime):
+        path = os.path.join(self.directory, '.vagrant')
+        open(path, 'w').write('{"active": {}}')
+        os.utime(path, (mtime, mtime))
+
+    def testGetSet(self):
+        self.assertEqual(self.state.get('web', 'uuid'), None)
+        self.state.set('web', 'uuid', 'abc')
+        self.state.set_many(None, {'uuid': 'def', 'ip:': '10.0.0.2'})
+        self.assertEqual(self.state.get('web', 'uuid'), 'abc')
+        self.assertEqual(self.state.get('default', 'ip:'), '10.0.0.2')
+
+        # Values are shared with other processes through the file
+        state = ContextState(self.directory)
+        self.assertEqual(state.get(None, 'uuid'), 'def')
+
+    def testMaxAge(self):
+        self.state.set('web', 'status', 'running')
+        self.assertEqual(self.state.get('web', 'status', max_age=60),
+                         'running')
+        time.sleep(0.05)
+        self.assertEqual(self.state.get('web', 'status', max_age=0.01), None)
+        self.assertEqual(self.state.get('web', 'status'), 'running')
+
+    def testInvalidate(self):
+        for vm in ['web', 'db']:
+            self.state.set_many(vm, {'uuid': vm, 'ip:': vm})
+        self.state.set(ContextState.ALL, 'status', {'web': 'running'})
+
+        # One VM, along with the context-wide values that include it
+        self.state.invalidate(vm='web', keep=('uuid',))
+        self.assertEqual(self.state.get('web', 'uuid'), 'web')
+        self.assertEqual(self.state.get('web', 'ip:'), None)
+        self.assertEqual(self.state.get('db', 'ip:'), 'db')
+        self.assertEqual(self.state.get(ContextState.ALL, 'status'), None)
+
+        # Every VM
+        self.state.invalidate()
+        self.assertEqual(self.state.get('web', 'uuid'), None)
+        self.assertEqual(self.state.get('db', 'uuid'), None)
+
+    def testRunfileChanged(self):
+        '''VMs created or destroyed outside of basebox drop the cache'''
+        self.write_runfile(1000000000)
+        self.state.set('web', 'uuid', 'abc')
+        self.assertEqual(self.state.get('web', 'uuid'), 'abc')
+        self.write_runfile(1000000100)
+        self.assertEqual(self.state.get('web', 'uuid'), None)
+
+    def testCorrupt(self):
+        open(self.state.path, 'w').write('{"vms": ')
+        self.assertEqual(self.state.get('web', 'uuid'), None)
+        self.state.set('web', 'uuid', 'abc')
+        self.assertEqual(self.state.get('web', 'uuid'), 'abc')
+
+    def testDisabled(self):
+        state = ContextState(self.directory, enabled=False)
+        state.set('web', 'uuid', 'abc')
+        state.invalidate()
+        self.assertEqual(state.get('web', 'uuid'), None)
+        self.assertFalse(os.path.exists(state.path))
+
+    def testConcurrentWrites(self):
+        '''Writes from many processes at once don't lose each other'''
+        def write(idx):
+            ContextState(self.directory).set('vm%d' % idx, 'uuid', idx)
+
+        processes = [multiprocessing.Process(target=write, args=(idx,))
+                     for idx in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        for idx in range(8):
+            self.assertEqual(self.state.get('vm%d' % idx, 'uuid'), idx)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+'''
+Tests for reading VM states without `vagrant status`, run against the
+stand-in vagrant and VBoxManage commands from the benchmark suite (see
+benchmarks/bin/fakebox.py), so they don't need VirtualBox.
+'''
+import os
+import tempfile
+import unittest
+
+from basebox.profile import count_commands
+from basebox.vagrant import (VagrantContext, parse_machine_readable_status,
+    parse_vbox_vms)
+from support import FakeboxTestCase
+
+LIST_VMS = '''\
+Name:            basebox_web
+Groups:          /
+Guest OS:        Ubuntu (64 bit)
+UUID:            1b2c3d4e-0000-0000-0000-000000000001
+Config file:     /vms/basebox_web/basebox_web.vbox
+Hardware UUID:   1b2c3d4e-0000-0000-0000-000000000001
+Memory size:     512MB
+Number of CPUs:  2
+State:           powered off (since 2013-05-10T10:25:19.000000000)
+NIC 1:           MAC: 080027C1A2B3, Attachment: NAT, Cable connected: on, Trace: off (file: none), Type: 82540EM, Reported speed: 0 Mbps, Boot priority: 0, Promisc Policy: deny, Bandwidth group: none
+NIC 1 Settings:  MTU: 0, Socket (send: 64, receive: 64), TCP Window (send:64, receive: 64)
+NIC 2:           MAC: 080027D4E5F6, Attachment: Host-only Interface 'vboxnet0', Cable connected: on
+NIC 3:           disabled
+Snapshots:
+
+   Name: clean (UUID: 1b2c3d4e-0000-0000-0000-0000000000aa) *
+
+Name:            basebox_db
+Guest OS:        Ubuntu (64 bit)
+UUID:            1b2c3d4e-0000-0000-0000-000000000002
+State:           running (since 2013-05-10T10:25:19.000000000)
+Shared folders:
+
+Name: 'v-root', Host path: '/srv/db' (machine mapping), writable
+'''
+
+MACHINE_READABLE = '''\
+1371234200,web,provider-name,virtualbox
+1371234200,web,state,poweroff
+1371234200,db,state,not_created
+1371234200,,ui,info,Current machine states:
+'''
+
+
+class TestParse(unittest.TestCase):
+
+    def testVBoxVMs(self):
+        vms = parse_vbox_vms(LIST_VMS)
+        self.assertEqual(sorted((uuid, vm['name'], vm['state'])
+                                for uuid, vm in vms.items()), [
+            ('1b2c3d4e-0000-0000-0000-000000000001', 'basebox_web',
+             'poweroff'),
+            ('1b2c3d4e-0000-0000-0000-000000000002', 'basebox_db',
+             'running')
+            ])
+        self.assertEqual(vms['1b2c3d4e-0000-0000-0000-000000000001']['vminfo'],
+                         {'name': 'basebox_web',
+                          'UUID': '1b2c3d4e-0000-0000-0000-000000000001',
+                          'ostype': 'Ubuntu (64 bit)',
+                          'CfgFile': '/vms/basebox_web/basebox_web.vbox',
+                          'memory': '512',
+                          'cpus': '2',
+                          'VMState': 'poweroff',
+                          'nic1': 'nat',
+                          'macaddress1': '080027C1A2B3',
+                          'nic2': 'hostonly',
+                          'macaddress2': '080027D4E5F6',
+                          'nic3': 'none'})
+
+    def testMachineReadable(self):
+        self.assertEqual(parse_machine_readable_status(MACHINE_READABLE),
+                         {'web': 'poweroff', 'db': 'not created'})
+
+
+class TestStatus(FakeboxTestCase):
+
+    def context(self, vagrantfile):
+        workdir = tempfile.mkdtemp(dir=self.directory)
+        open(os.path.join(workdir, 'Vagrantfile'), 'w').write(vagrantfile)
+        return VagrantContext(workdir)
+
+    def testDefinedVMs(self):
+        context = self.context('Vagrant::Config.run do |config|\n'
+                               '  config.vm.define :web do |web|\n'
+                               '  end\n'
+                               '  # config.vm.define :old\n'
+                               '  config.vm.define "db", primary: true\n'
+                               "  config.vm.define('cache')\n"
+                               'end\n')
+        self.assertEqual(context.defined_vms(), ['web', 'db', 'cache'])
+        self.assertEqual(self.context('Vagrant::Config.run do |config|\n'
+                                      'end\n').defined_vms(), ['default'])
+        self.assertEqual(self.context('%w(a b).each do |name|\n'
+                                      '  config.vm.define name\n'
+                                      'end\n').defined_vms(), None)
+
+    def testNative(self):
+        '''States come from one VBoxManage call, without vagrant'''
+        context = self.context('Vagrant::Config.run do |config|\n'
+                               '  config.vm.define :web\n'
+                               '  config.vm.define :db\n'
+                               '  config.vm.define :cache\n'
+                               'end\n')
+        context.up(vm='web')
+        context.up(vm='db')
+        context.halt(vm='db')
+
+        with count_commands() as counter:
+            self.assertEqual(context.list_boxes(), ['web', 'db', 'cache'])
+            self.assertEqual(context.status(), {'web': 'running',
+                                                'db': 'poweroff',
+                                                'cache': 'not created'})
+            self.assertEqual(context.status('db'), 'poweroff')
+        counter.assert_at_most(1)
+        counter.assert_at_most(0, 'vagrant')
+        context.destroy(force=True)
+
+    def testFallback(self):
+        '''Vagrant is asked when the Vagrantfile can't be read reliably'''
+        context = self.context('Vagrant::Config.run do |config|\n'
+                               '  %w(web db).each do |name|\n'
+                               '    config.vm.define name\n'
+                               '  end\n'
+                               'end\n')
+        with count_commands() as counter:
+            context.status()
+        self.assertEqual(counter.count('vagrant status'), 1)
+
+    def testRemote(self):
+        '''Remote contexts' VMs come from vagrant, not a local Vagrantfile'''
+        context = self.context('Vagrant::Config.run do |config|\n'
+                               '  config.vm.define :web\n'
+                               'end\n')
+        context.state.enabled = False
+        with count_commands() as counter:
+            self.assertEqual(context.list_boxes(), ['web'])
+        self.assertEqual(counter.count('vagrant status'), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+Tests for incremental step builds, run against the stand-in vagrant and
+VBoxManage commands from the benchmark suite (see benchmarks/bin/fakebox.py),
+so they don't need VirtualBox.  The steps only record that they ran.
+'''
+import os
+import unittest
+
+from basebox.steps import StepBuild
+from basebox.vagrant import VagrantBox, add_box
+from support import FakeboxTestCase
+
+BASE_BOX = 'steps-base'
+
+ran = []
+
+
+def packages():
+    ran.append('packages')
+
+
+def app():
+    ran.append('app')
+
+
+def app_changed():
+    ran.append('app changed')
+
+
+class TestStepBuild(FakeboxTestCase):
+
+    def setUp(self):
+        super(TestStepBuild, self).setUp()
+        add_box(BASE_BOX, os.path.join(self.directory, 'base.box'))
+        del ran[:]
+
+    def build(self, steps):
+        return StepBuild('web', steps, base=BASE_BOX,
+                         directory=os.path.join(self.directory, 'web'))
+
+    def testSnapshotNames(self):
+        names = self.build([packages, ('deploy app', app)]).snapshot_names()
+        self.assertTrue(names[0].startswith('basebox-step-0-packages-'))
+        self.assertTrue(names[1].startswith('basebox-step-1-deploy_app-'))
+
+        # A step's fingerprint covers every step up to it
+        changed = self.build([packages, ('deploy app', app_changed)])
+        self.assertEqual(changed.snapshot_names()[0], names[0])
+        self.assertNotEqual(changed.snapshot_names()[1], names[1])
+
+    def testIncremental(self):
+        build = self.build([packages, app])
+        build.run()
+        self.assertEqual(ran, ['packages', 'app'])
+        box = VagrantBox(build.directory)
+        self.assertEqual(box.snapshots(), build.snapshot_names())
+
+        # Nothing changed, so everything comes from the last snapshot
+        del ran[:]
+        build.run()
+        self.assertEqual(ran, [])
+
+        # Only the changed step reruns, and its old snapshot is dropped
+        del ran[:]
+        changed = self.build([packages, app_changed])
+        changed.run()
+        self.assertEqual(ran, ['app changed'])
+        self.assertEqual(box.snapshots(), changed.snapshot_names())
+
+        changed.clean()
+        self.assertFalse(os.path.exists(build.directory))
+
+    def testFailedStep(self):
+        '''Steps that succeeded before a failure aren't rerun'''
+        def broken():
+            raise ValueError('broken')
+
+        build = self.build([packages, ('app', broken)])
+        self.assertRaises(ValueError, build.run)
+        self.assertEqual(ran, ['packages'])
+
+        del ran[:]
+        self.build([packages, app]).run()
+        self.assertEqual(ran, ['app'])
+        build.clean()
+
+
+if __name__ == "__main__":
+    unittest.main()